@@ -16,7 +16,7 @@
 # limitations under the License.
 
 
-import time
+import socket
 import traceback
 from copy import deepcopy
 from logging import getLogger
@@ -25,7 +25,6 @@ from socketserver import (
     TCPServer,
     ThreadingMixIn,
 )
-from sys import stdout
 from threading import (
     Lock,
     Thread,
@@ -56,25 +55,100 @@ class BoltStubServer(TCPServer):
 
     timed_out = False
 
-    def __init__(self, *args, **kwargs):
-        super(BoltStubServer, self).__init__(*args, **kwargs)
+    def __init__(self, server_address, handler_class, listen_socket=None):
+        super(BoltStubServer, self).__init__(
+            server_address, handler_class,
+            bind_and_activate=listen_socket is None
+        )
+        if listen_socket is not None:
+            # already bound and listening, see `listen`
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
 
     def handle_timeout(self):
         self.timed_out = True
 
     def server_activate(self):
         super(BoltStubServer, self).server_activate()
-        # Must be here, testkit waits for something to be written on stdout to
-        # know when the server is listening.
-        print("Listening")
-        stdout.flush()
+        # Must be here, testkit waits for this to know when the server is
+        # listening and on which port.
+        report_listening(self.socket)
 
 
 class ThreadedBoltStubServer(ThreadingMixIn, BoltStubServer):
     pass
 
 
-class BoltStubService:
+def listen(listen_addr=None, out=None):
+    """Open the socket a stub service listens on ahead of the service.
+
+    Lets the stub server report that it's listening before the scripts are
+    loaded. Connections are queued until the service starts serving. Pass
+    the socket to the service as `listen_socket`.
+
+    :param listen_addr: address to listen on, see :class:`.BoltStubService`.
+        Port 0 picks a free port.
+    :param out: where to report that the socket is listening (default stdout)
+    """
+    if listen_addr:
+        listen_addr = Address.parse(listen_addr)
+    else:
+        listen_addr = Address(("localhost",
+                               BoltStubService.default_base_port))
+    address = Address((listen_addr.host, listen_addr.port_number))
+    listen_socket = socket.create_server(address, family=address.family)
+    report_listening(listen_socket, out=out)
+    return listen_socket
+
+
+def report_listening(listen_socket, out=None):
+    """Report that the stub server is listening and on which address.
+
+    testkit waits for this line to know when the server is ready and, when
+    listening on port 0, which port it got.
+
+    :param listen_socket: the bound and listening socket
+    :param out: where to report it (default stdout)
+    """
+    print("Listening on {}".format(Address(listen_socket.getsockname())),
+          file=out, flush=True)
+
+
+def service_exit_code(service, out=None):
+    """Report the outcome of a service that has stopped serving.
+
+    :param service: the finished :class:`.BoltStubService` or
+        :class:`.AsyncBoltStubService`
+    :param out: where to report errors (default stdout)
+    :return: the exit code of the stub server
+    """
+    if service.exceptions:
+        for error in service.exceptions:
+            extra = ""
+            if hasattr(error, "script") and error.script.filename:
+                extra += " in {!r}".format(error.script.filename)
+            if isinstance(error, ScriptFailure):
+                print("Script mismatch{}:\n{}\n".format(extra, error),
+                      file=out)
+            else:
+                print("Error{}:\n{}\n".format(extra, error), file=out)
+        return 1
+    if service.timed_out:
+        print("Timed out", file=out)
+        return 2
+    if not service.ever_acted:
+        print("Script never started", file=out)
+        return 3
+    return 0
+
+
+class BaseBoltStubService:
+    """What the threaded and the asyncio stub service have in common.
+
+    See :class:`.BoltStubService` and
+    :class:`.async_engine.AsyncBoltStubService`.
+    """
 
     default_base_port = 17687
 
@@ -86,7 +160,8 @@ class BoltStubService:
     def load(cls, *script_filenames, **kwargs):
         return cls(*map(parse_file, script_filenames), **kwargs)
 
-    def __init__(self, script: Script, listen_addr=None, timeout=None):
+    def __init__(self, script: Script, listen_addr=None, timeout=None,
+                 precompiled=True, logger=None, events=None):
         if listen_addr:
             listen_addr = Address.parse(listen_addr)
         else:
@@ -94,10 +169,29 @@ class BoltStubService:
         self.host = listen_addr.host
         self.address = Address((listen_addr.host, listen_addr.port_number))
         self.script = script
+        self.precompiled = precompiled
+        self.log = logger or log
+        self.events = events
+        self.timeout = timeout or self.default_timeout
         self.exceptions = []
         self.actors = []
         self._shutting_down = False
         self.ever_acted = False
+
+    def event(self, wire, name, fields=""):
+        # report what the server did with a connection (see `.events`)
+        if self.events is not None:
+            self.events.add(wire, "S", name, fields)
+
+
+class BoltStubService(BaseBoltStubService):
+
+    def __init__(self, script: Script, listen_addr=None, timeout=None,
+                 precompiled=True, listen_socket=None, logger=None,
+                 events=None):
+        super().__init__(script, listen_addr=listen_addr, timeout=timeout,
+                         precompiled=precompiled, logger=logger,
+                         events=events)
         self.actors_lock = Lock()
         service = self
         eval_context = script.context.create_eval_context()
@@ -111,23 +205,30 @@ class BoltStubService:
                 self.wire = create_wire(self.request, read_wake_up=True)
                 self.client_address = self.wire.remote_address
                 self.server_address = self.wire.local_address
-                log.info("[#%04X>#%04X]  S: <ACCEPT> %s -> %s",
-                         self.client_address.port_number,
-                         self.server_address.port_number,
-                         self.client_address, self.server_address)
+                service.log.info("[#%04X>#%04X]  S: <ACCEPT> %s -> %s",
+                                 self.client_address.port_number,
+                                 self.server_address.port_number,
+                                 self.client_address, self.server_address)
+                service.event(self.wire, "<ACCEPT>", "%s -> %s" % (
+                    self.client_address, self.server_address
+                ))
 
             def handle(self) -> None:
                 with service.actors_lock:
                     actor = BoltActor(deepcopy(script), self.wire,
-                                      eval_context)
+                                      eval_context,
+                                      precompiled=service.precompiled,
+                                      logger=service.log,
+                                      events=service.events)
                     service.actors.append(actor)
                     service.ever_acted = True
                 try:
                     actor.play()
                 except ServerExit as e:
-                    log.info("[#%04X>#%04X]  S: <EXIT> %s",
-                             self.client_address.port_number,
-                             self.server_address.port_number, e)
+                    service.log.info("[#%04X>#%04X]  S: <EXIT> %s",
+                                     self.client_address.port_number,
+                                     self.server_address.port_number, e)
+                    service.event(self.wire, "<EXIT>", str(e))
                 except ScriptFailure as e:
                     e.script = script
                     service.exceptions.append(e)
@@ -139,9 +240,16 @@ class BoltStubService:
                         service.actors.remove(actor)
 
             def finish(self):
-                log.info("[#%04X>#%04X]  S: <HANGUP>",
-                         self.client_address.port_number,
-                         self.server_address.port_number)
+                service.log.info("[#%04X>#%04X]  S: <HANGUP>",
+                                 self.client_address.port_number,
+                                 self.server_address.port_number)
+                wire = getattr(self, "wire", None)
+                if wire is not None:
+                    service.event(wire, "<HANGUP>")
+                    service.log.debug("[#%04X>#%04X]  wire stats: %r",
+                                      self.client_address.port_number,
+                                      self.server_address.port_number,
+                                      wire.stats)
                 try:
                     self.wire.close()
                 except OSError:
@@ -153,8 +261,9 @@ class BoltStubService:
             server_cls = ThreadedBoltStubServer
         else:
             server_cls = BoltStubServer
-        self.server = server_cls(self.address, BoltStubRequestHandler)
-        self.server.timeout = timeout or self.default_timeout
+        self.server = server_cls(self.address, BoltStubRequestHandler,
+                                 listen_socket=listen_socket)
+        self.server.timeout = self.timeout
 
     def start(self):
         if self.script.context.restarting or self.script.context.concurrent:
@@ -167,13 +276,21 @@ class BoltStubService:
                 # error when `self._close_socket` just pulls the plug.
                 # Other OSes might also raise an error in this case.
                 # This is fine and we can ignore it.
-                log.warning("Ignored OSError during shutdown", exc_info=exc)
+                self.log.warning("Ignored OSError during shutdown",
+                                 exc_info=exc)
         else:
             self.server.handle_request()
             self.server.server_close()
 
     def _close_socket(self):
         self._shutting_down = True
+        try:
+            # Wakes up `handle_request` waiting for a connection in another
+            # thread. Only closing the socket doesn't (unless a signal
+            # interrupts the wait).
+            self.server.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.server.socket.close()
 
     def _stop_server(self):
@@ -209,17 +326,41 @@ class BoltStubService:
         return self.server.timed_out
 
 
+def get_service_class(asyncio=False):
+    """Return the class of the threaded or of the asyncio stub service."""
+    if not asyncio:
+        return BoltStubService
+    # imported on demand, most stub servers don't use the asyncio engine
+    from .async_engine import AsyncBoltStubService
+    return AsyncBoltStubService
+
+
 class BoltActor:
 
-    def __init__(self, script: Script, wire, eval_context: EvalContext):
+    channel_class = Channel
+
+    def __init__(self, script: Script, wire, eval_context: EvalContext,
+                 precompiled=True, logger=None, events=None):
         self.script = script
-        self.channel = Channel(
+        self._logger = logger or log
+        self.channel = self.channel_class(
             wire, script.context.bolt_version, log_cb=self.log,
             handshake_data=self.script.context.handshake,
             handshake_delay=self.script.context.handshake_delay,
-            eval_context=eval_context,
+            eval_context=eval_context, precompiled=precompiled,
+            events=events, debug_log_cb=self.log_debug,
         )
         self._exit = False
+        self._skip_requested = False
+
+    def _check_requests(self):
+        # `exit` and `try_skip_to_end` are called from other threads, the
+        # actor acts on them itself after being woken up.
+        if self._exit:
+            raise ServerExit("Actor exit on request")
+        if self._skip_requested:
+            self._skip_requested = False
+            self.script.try_skip_to_end(self.channel)
 
     def play(self):
         for init_fn in (self.channel.preamble, self.channel.version_handshake):
@@ -234,44 +375,44 @@ class BoltActor:
         try:
             self.script.init(self.channel)
             while True:
-                if self._exit:
-                    raise ServerExit("Actor exit on request")
+                self._check_requests()
                 if self.script.done(self.channel):
                     break
                 try:
                     self.script.consume(self.channel)
                 except ReadWakeup:
-                    # The `Script` class does some locking to protect its state
-                    # which can be changed concurrently for example by
-                    # `try_skip_to_end` being called from the interrupt handler
-                    # in `__main__.py` which spawns a new thread. Without this
-                    # `sleep`, the main thread that keeps calling
-                    # `script.consume` only releases Script's internal lock so
-                    # briefly that `try_skip_to_end` can't reliably acquire it
-                    # thus hanging unnecessarily long.
-                    time.sleep(0.000001)
                     continue
         except OSError as e:
             self.log("S: <BROKEN> %r", e)
+            self.channel.event("S", "<BROKEN>", repr(e))
             self.script.try_skip_to_end(self.channel)
             if not self.script.done(self.channel):
                 raise
         self.log("Script finished")
+        self.channel.event("S", "<FINISHED>")
 
     def try_skip_to_end(self):
-        self.script.try_skip_to_end(self.channel)
+        self._skip_requested = True
+        self.channel.wire.wake_up()
 
     def exit(self):
         self._exit = True
+        self.channel.wire.wake_up()
 
     def log(self, text, *args):
-        log.info("[#%04X>#%04X]  " + text,
-                 self.channel.wire.remote_address.port_number,
-                 self.channel.wire.local_address.port_number,
-                 *args)
+        self._logger.info("[#%04X>#%04X]  " + text,
+                          self.channel.wire.remote_address.port_number,
+                          self.channel.wire.local_address.port_number,
+                          *args)
+
+    def log_debug(self, text, *args):
+        self._logger.debug("[#%04X>#%04X]  " + text,
+                           self.channel.wire.remote_address.port_number,
+                           self.channel.wire.local_address.port_number,
+                           *args)
 
     def log_error(self, text, *args):
-        log.error("[#%04X>#%04X]  " + text,
-                  self.channel.wire.remote_address.port_number,
-                  self.channel.wire.local_address.port_number,
-                  *args)
+        self._logger.error("[#%04X>#%04X]  " + text,
+                           self.channel.wire.remote_address.port_number,
+                           self.channel.wire.local_address.port_number,
+                           *args)
@@ -18,6 +18,7 @@
 # limitations under the License.
 
 
+import atexit
 import platform
 import signal
 import sys
@@ -25,15 +26,22 @@ import threading
 import time
 from argparse import ArgumentParser
 from logging import (
+    DEBUG,
     getLogger,
     INFO,
 )
 
-from . import BoltStubService
-from .parsing import (
-    parse_file,
-    ScriptFailure,
+from . import (
+    get_service_class,
+    listen,
+    service_exit_code,
 )
+from .caching import (
+    CACHE_DIR_ENV,
+    get_script_cache,
+)
+from .events import EventWriter
+from .parsing import parse_file
 from .watcher import watch
 
 log = getLogger(__name__)
@@ -92,18 +100,66 @@ def main():
             "server will wait for 30 seconds."
         )
         parser.add_argument(
-            "-v", "--verbose", action="store_true",
-            help="Show more detail about the client-server exchange."
+            "-v", "--verbose", action="count", default=0,
+            help="Show more detail about the client-server exchange. Repeat "
+                 "(-vv) to also show debug output, e.g., how many script "
+                 "lines each client message was matched against."
+        )
+        parser.add_argument(
+            "--no-precompile", action="store_true",
+            help="Translate and encode server messages every time they are "
+                 "sent instead of using the wire bytes compiled when loading "
+                 "the script. Useful for debugging the encoding."
+        )
+        parser.add_argument(
+            "--asyncio", action="store_true",
+            help="Serve all connections from a single asyncio event loop "
+                 "instead of using one thread per connection. Scales better "
+                 "for scripts accepting many concurrent connections."
+        )
+        parser.add_argument(
+            "--cache-dir",
+            help="Directory for caching parsed scripts across runs. "
+                 "Defaults to the {} environment variable. Without either, "
+                 "scripts are not cached.".format(CACHE_DIR_ENV)
+        )
+        parser.add_argument(
+            "--no-cache", action="store_true",
+            help="Always parse the scripts, even if a cache directory is "
+                 "configured."
+        )
+        parser.add_argument(
+            "--events", metavar="FILE",
+            help="Write every message received or sent as a JSON object to "
+                 "this file, one per line. Meant for tools inspecting the "
+                 "conversation, see `boltstub.events`."
         )
         parser.add_argument("script", nargs="+")
         parsed = parser.parse_args()
 
         if parsed.verbose:
-            watch("boltstub", INFO)
-
-        scripts = map(parse_file, parsed.script)
-        service = BoltStubService(*scripts, listen_addr=parsed.listen_addr,
-                                  timeout=parsed.timeout)
+            watch("boltstub", DEBUG if parsed.verbose > 1 else INFO)
+
+        # Loading the scripts takes a while, be listening in the meantime.
+        listen_socket = listen(parsed.listen_addr)
+
+        cache = None
+        if not parsed.no_cache:
+            cache = get_script_cache(parsed.cache_dir)
+        if cache is not None:
+            atexit.register(cache.print_stats)
+        scripts = [parse_file(script, cache=cache)
+                   for script in parsed.script]
+        events = None
+        if parsed.events:
+            events = EventWriter(open(parsed.events, "w", encoding="utf-8"))
+            atexit.register(events.close)
+        service_class = get_service_class(asyncio=parsed.asyncio)
+        service = service_class(*scripts, listen_addr=parsed.listen_addr,
+                                timeout=parsed.timeout,
+                                precompiled=not parsed.no_precompile,
+                                listen_socket=listen_socket,
+                                events=events)
 
         try:
             service.start()
@@ -112,27 +168,7 @@ def main():
             log.error("\r\n")
             return exit_(99)
 
-        if service.exceptions:
-            for error in service.exceptions:
-                extra = ""
-                if hasattr(error, "script") and error.script.filename:
-                    extra += " in {!r}".format(error.script.filename)
-                if isinstance(error, ScriptFailure):
-                    print("Script mismatch{}:\n{}\n".format(extra, error))
-                else:
-                    print("Error{}:\n{}\n".format(extra, error))
-
-            return exit_(1)
-
-        if service.timed_out:
-            print("Timed out")
-            return exit_(2)
-
-        if not service.ever_acted:
-            print("Script never started")
-            return exit_(3)
-
-        return exit_(0)
+        return exit_(service_exit_code(service))
 
     def signal_handler(sig, frame):
         nonlocal service
@@ -0,0 +1,382 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Engine serving all connections of a stub server from one asyncio event loop.
+
+Only imported when asked for (see :func:`boltstub.get_service_class`), most
+stub servers use the threaded engine.
+"""
+
+
+import asyncio
+import socket
+import traceback
+from collections import deque
+from copy import deepcopy
+from functools import partial
+
+from . import (
+    BaseBoltStubService,
+    BoltActor,
+    report_listening,
+)
+from .channel import Channel
+from .errors import ServerExit
+from .parsing import (
+    Script,
+    ScriptFailure,
+)
+from .wiring import (
+    BrokenWireError,
+    expects_more_http_header,
+    ReadWakeup,
+    RegularSocket,
+    WebSocket,
+    websocket_upgrade_response,
+    Wire,
+    WireError,
+)
+
+
+class AsyncWire(Wire):
+    """Wire for the asyncio engine.
+
+    Reading never blocks. If not enough data has been received,
+    :class:`.ReadWakeup` is raised and the caller is expected to await
+    :meth:`.wait_readable` before trying again. Sending is deferred until
+    :meth:`.flush` is awaited.
+    """
+
+    def __init__(self, s, raw_socket):
+        super().__init__(s)
+        s.settimeout(0)
+        self._raw_socket = raw_socket
+        self._pending = deque()
+        self._waiter = None
+
+    @property
+    def pending(self):
+        """Flag indicating whether there are deferred actions to flush."""
+        return bool(self._pending)
+
+    def send(self):
+        """Queue the contents of the output buffer for sending."""
+        if self._closed:
+            raise WireError("Closed")
+        sent = len(self._output)
+        if sent:
+            data = self._socket.frame(bytes(self._output))
+            self._output.clear()
+            self.defer(partial(self._sendall, data))
+        return sent
+
+    def defer(self, action):
+        """Queue a coroutine function to be awaited on the next flush."""
+        self._pending.append(action)
+
+    async def flush(self):
+        """Send queued data and run deferred actions in order."""
+        while self._pending:
+            action = self._pending.popleft()
+            await action()
+
+    async def _sendall(self, data):
+        try:
+            await asyncio.get_running_loop().sock_sendall(self._raw_socket,
+                                                          data)
+        except OSError:
+            self._broken = True
+            raise BrokenWireError("Broken")
+
+    async def wait_readable(self):
+        """Wait until there is data to read or :meth:`.wake_up` is called."""
+        if self.on_idle is not None:
+            self.on_idle()
+        loop = asyncio.get_running_loop()
+        fd = self._raw_socket.fileno()
+        self._waiter = loop.create_future()
+        loop.add_reader(fd, self.wake_up)
+        try:
+            await self._waiter
+        finally:
+            loop.remove_reader(fd)
+            self._waiter = None
+
+    def wake_up(self):
+        """Make a pending :meth:`.wait_readable` return."""
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+async def negotiate_socket(s):
+    """Like :func:`.wiring.negotiate_socket` for a non-blocking socket."""
+    loop = asyncio.get_running_loop()
+    buffer = await loop.sock_recv(s, 1024)
+    while expects_more_http_header(buffer):
+        data = await loop.sock_recv(s, 1024)
+        if not data:
+            break
+        buffer += data
+    response = websocket_upgrade_response(buffer)
+    if response is not None:
+        await loop.sock_sendall(s, response)
+        return WebSocket(s)
+
+    return RegularSocket(s, buffer)
+
+
+async def create_async_wire(s, wrap_socket=negotiate_socket):
+    s.setblocking(False)
+    actual_socket = await wrap_socket(s)
+    return AsyncWire(actual_socket, s)
+
+
+class AsyncChannel(Channel):
+    # Channel for the asyncio engine working on an `AsyncWire`.
+    # Sending, sleeping, and asserting that no input was received are
+    # deferred until the actor flushes the wire. Reading raises `ReadWakeup`
+    # while there are deferred actions left so that the actor flushes them
+    # before reading on.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._running_deferred = False
+
+    def _consume(self):
+        if self.wire.pending and not self._running_deferred:
+            raise ReadWakeup
+        return super()._consume()
+
+    def sleep(self, duration):
+        self.wire.defer(partial(asyncio.sleep, duration))
+
+    def assert_no_input(self):
+        async def assert_no_input():
+            # actions deferred after this one are still pending, but they
+            # must not keep this check from peeking at the input
+            self._running_deferred = True
+            try:
+                super(AsyncChannel, self).assert_no_input()
+            finally:
+                self._running_deferred = False
+
+        self.wire.defer(assert_no_input)
+
+
+class AsyncBoltActor(BoltActor):
+
+    channel_class = AsyncChannel
+
+    async def play(self):
+        for init_fn in (self.channel.preamble, self.channel.version_handshake):
+            while not await self._run(init_fn):
+                pass
+        try:
+            await self._run(self.script.init, self.channel)
+            while True:
+                self._check_requests()
+                if self.script.done(self.channel):
+                    break
+                await self._run(self.script.consume, self.channel)
+        except OSError as e:
+            self.log("S: <BROKEN> %r", e)
+            self.channel.event("S", "<BROKEN>", repr(e))
+            self.script.try_skip_to_end(self.channel)
+            if not self.script.done(self.channel):
+                raise
+        self.log("Script finished")
+        self.channel.event("S", "<FINISHED>")
+
+    async def _run(self, fn, *args):
+        # Call `fn` and send what it produced. If it has to wait for more data
+        # to arrive, return False to have it called again.
+        if self._exit:
+            raise ServerExit("Actor exit on request")
+        wire = self.channel.wire
+        try:
+            fn(*args)
+        except ReadWakeup:
+            if wire.pending:
+                await wire.flush()
+            else:
+                await wire.wait_readable()
+            return False
+        except Exception:
+            # the driver should still see what was sent before the failure
+            try:
+                await wire.flush()
+            except Exception:
+                pass
+            raise
+        await wire.flush()
+        return True
+
+
+class AsyncBoltStubService(BaseBoltStubService):
+    """Bolt stub service serving all connections from one asyncio event loop.
+
+    Alternative to :class:`.BoltStubService` with the same interface. Instead
+    of a thread per connection, which wakes up regularly to check whether it
+    should stop, every connection is a task that only runs when there is
+    something to receive, or when it's asked to stop.
+    """
+
+    def __init__(self, script: Script, listen_addr=None, timeout=None,
+                 precompiled=True, listen_socket=None, logger=None,
+                 events=None):
+        super().__init__(script, listen_addr=listen_addr, timeout=timeout,
+                         precompiled=precompiled, logger=logger,
+                         events=events)
+        self.timed_out = False
+        self._eval_context = script.context.create_eval_context()
+        self._loop = None
+        self._stopped = None
+        self._tasks = set()
+        if listen_socket is not None:
+            # already reported to be listening, see `listen`
+            self._socket = listen_socket
+            return
+        self._socket = socket.create_server(self.address)
+        # Must be here, testkit waits for this to know when the server is
+        # listening and on which port.
+        report_listening(self._socket)
+
+    def start(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        self._stopped = loop.create_future()
+        self._loop = loop
+        if self._shutting_down:
+            self._stopped.set_result(None)
+        self._socket.setblocking(False)
+        context = self.script.context
+        try:
+            if context.restarting or context.concurrent:
+                while True:
+                    connection = await self._accept()
+                    if connection is None:
+                        break
+                    task = self._loop.create_task(self._handle(connection))
+                    if context.concurrent:
+                        self._tasks.add(task)
+                        task.add_done_callback(self._tasks.discard)
+                    else:
+                        await task
+                if self._tasks:
+                    await asyncio.wait(self._tasks)
+            else:
+                connection = await self._accept(self.timeout)
+                if connection is not None:
+                    await self._handle(connection)
+                elif not self._stopped.done():
+                    self.timed_out = True
+        finally:
+            self._socket.close()
+
+    async def _accept(self, timeout=None):
+        accept = self._loop.create_task(self._loop.sock_accept(self._socket))
+        await asyncio.wait((accept, self._stopped), timeout=timeout,
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not accept.done():
+            accept.cancel()
+            return None
+        return accept.result()[0]
+
+    async def _handle(self, connection):
+        try:
+            wire = await create_async_wire(connection)
+        except OSError as e:
+            self.log.error("Failed to set up connection: %r", e)
+            connection.close()
+            return
+        client_port = wire.remote_address.port_number
+        server_port = wire.local_address.port_number
+        self.log.info("[#%04X>#%04X]  S: <ACCEPT> %s -> %s",
+                      client_port, server_port,
+                      wire.remote_address, wire.local_address)
+        self.event(wire, "<ACCEPT>", "%s -> %s" % (wire.remote_address,
+                                                   wire.local_address))
+        actor = AsyncBoltActor(deepcopy(self.script), wire,
+                               self._eval_context,
+                               precompiled=self.precompiled,
+                               logger=self.log, events=self.events)
+        self.actors.append(actor)
+        self.ever_acted = True
+        try:
+            await actor.play()
+        except ServerExit as e:
+            self.log.info("[#%04X>#%04X]  S: <EXIT> %s",
+                          client_port, server_port, e)
+            self.event(wire, "<EXIT>", str(e))
+        except ScriptFailure as e:
+            e.script = self.script
+            self.exceptions.append(e)
+        except Exception as e:
+            traceback.print_exc()
+            self.exceptions.append(e)
+        finally:
+            self.actors.remove(actor)
+            self.log.info("[#%04X>#%04X]  S: <HANGUP>",
+                          client_port, server_port)
+            self.event(wire, "<HANGUP>")
+            self.log.debug("[#%04X>#%04X]  wire stats: %r",
+                           client_port, server_port, wire.stats)
+            try:
+                wire.close()
+            except OSError:
+                pass
+
+    def _call_in_loop(self, fn):
+        # thread-safe (and signal handler safe) way of calling `fn` in the
+        # event loop
+        loop = self._loop
+        if loop is None:
+            fn()
+            return
+        try:
+            loop.call_soon_threadsafe(fn)
+        except RuntimeError:
+            # the event loop is closed: the service has already stopped
+            pass
+
+    def _stop_accepting(self):
+        self._shutting_down = True
+        if self._stopped is not None and not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def stop(self):
+        self._call_in_loop(self._stop_accepting)
+
+    def try_skip_to_end(self):
+        self._stop_accepting()
+        for actor in self.actors:
+            actor.try_skip_to_end()
+
+    def try_skip_to_end_async(self):
+        self._call_in_loop(self.try_skip_to_end)
+
+    def close_all_connections(self):
+        self._stop_accepting()
+        for actor in self.actors:
+            actor.exit()
+
+    def close_all_connections_async(self):
+        self._call_in_loop(self.close_all_connections)
@@ -16,6 +16,7 @@
 # limitations under the License.
 
 
+from importlib import import_module
 from threading import Lock
 
 from .errors import (
@@ -25,17 +26,29 @@ from .errors import (
     ServerExit,
 )
 from .packstream import Structure
-from .simple_jolt import v1 as jolt_v1
-from .simple_jolt import v2 as jolt_v2
 from .util import (
     hex_repr,
     recursive_subclasses,
 )
 
-jolt_package = {
-    1: jolt_v1,
-    2: jolt_v2,
+_jolt_package_modules = {
+    1: ".simple_jolt.v1",
+    2: ".simple_jolt.v2",
 }
+_jolt_packages = {}
+
+
+def get_jolt_package(packstream_version):
+    try:
+        return _jolt_packages[packstream_version]
+    except KeyError:
+        # imported on first use: a stub server only ever needs the JOLT
+        # version of its script's packstream version
+        package = import_module(_jolt_package_modules[packstream_version],
+                                __package__)
+        _jolt_packages[packstream_version] = package
+        return package
+
 
 auto_bolt_id = 0
 auto_bolt_id_lock = Lock()
@@ -86,7 +99,7 @@ class TranslatedStructure(Structure):
 
     def __str__(self):
         return self.name + " {}".format(" ".join(
-            map(jolt_package[self.packstream_version].dumps_simple,
+            map(get_jolt_package(self.packstream_version).dumps_simple,
                 self.fields_to_jolt_types())
         ))
 
@@ -180,7 +193,7 @@ class BoltProtocol:
 
     @classmethod
     def get_jolt_package(cls):
-        return jolt_package[cls.packstream_version]
+        return get_jolt_package(cls.packstream_version)
 
 
 class Bolt1Protocol(BoltProtocol):
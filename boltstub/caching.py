@@ -0,0 +1,210 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+from logging import getLogger
+from os import path
+
+log = getLogger(__name__)
+
+_VERSION_DIR_RE = re.compile(r"[0-9a-f]{16}")
+
+
+CACHE_DIR_ENV = "BOLTSTUB_CACHE_DIR"
+
+
+def get_script_cache(directory=None):
+    """Return the script cache in `directory`.
+
+    Caching is opt-in: without `directory`, the cache is in the directory
+    given by the environment variable named `CACHE_DIR_ENV`. If that isn't
+    set either, return None.
+    """
+    directory = directory or os.environ.get(CACHE_DIR_ENV)
+    if not directory:
+        return None
+    return ScriptCache(directory)
+
+
+_code_version = None
+
+
+def code_version():
+    """Hash of boltstub's own source code.
+
+    Cached scripts are only valid for the code that parsed them.
+    """
+    global _code_version
+    if _code_version is None:
+        hash_ = hashlib.sha256(sys.version.encode())
+        root = path.dirname(path.abspath(__file__))
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names[:] = sorted(d for d in dir_names
+                                  if d not in ("tests", "__pycache__"))
+            for file_name in sorted(file_names):
+                if not file_name.endswith((".py", ".lark")):
+                    continue
+                file_path = path.join(dir_path, file_name)
+                hash_.update(path.relpath(file_path, root).encode())
+                with open(file_path, "rb") as fd:
+                    hash_.update(fd.read())
+        _code_version = hash_.hexdigest()
+    return _code_version
+
+
+class ScriptCache:
+    """On-disk cache of parsed, verified, and precompiled scripts.
+
+    Entries are keyed by the script text, the substitutions applied to it,
+    and the version of boltstub's code. Failing to read or write an entry
+    is never an error, the script is just parsed as if it wasn't cached.
+
+    Entries of other code versions are removed when storing the first entry,
+    and only the `max_entries` most recently used entries are kept.
+    The cache holds pickles, so it's only used if the directory belongs to
+    the current user and nobody else can write to it.
+    """
+
+    max_entries = 1000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._version_directory = path.join(directory, code_version()[:16])
+        self._usable = None
+        self._pruned_versions = False
+
+    @staticmethod
+    def key(script: str, substitutions=None) -> str:
+        hash_ = hashlib.sha256(code_version().encode())
+        for match, replacement in (substitutions or {}).items():
+            hash_.update(b"\x00%i:%s\x00%i:%s" % (
+                len(match), match.encode(),
+                len(replacement), replacement.encode()
+            ))
+        hash_.update(b"\x01")
+        hash_.update(script.encode())
+        return hash_.hexdigest()
+
+    def _check_usable(self):
+        if self._usable is None:
+            self._usable = True
+            for directory in (self.directory, self._version_directory):
+                try:
+                    os.makedirs(directory, mode=0o700, exist_ok=True)
+                    stat = os.stat(directory)
+                except OSError as e:
+                    log.warning("Not using script cache %s: %r",
+                                self.directory, e)
+                    self._usable = False
+                    break
+                if hasattr(os, "getuid") and (stat.st_uid != os.getuid()
+                                              or stat.st_mode & 0o022):
+                    log.warning("Not using script cache %s: others can "
+                                "write to %s", self.directory, directory)
+                    self._usable = False
+                    break
+        return self._usable
+
+    def load(self, script: str, substitutions, parse_fn):
+        if not self._check_usable():
+            return parse_fn()
+        file_path = path.join(self._version_directory,
+                              self.key(script, substitutions) + ".pickle")
+        try:
+            with open(file_path, "rb") as fd:
+                parsed = pickle.load(fd)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.debug("Ignoring broken script cache entry %s: %r",
+                      file_path, e)
+        else:
+            self.hits += 1
+            try:
+                # most recently used entries survive pruning
+                os.utime(file_path)
+            except OSError:
+                pass
+            return parsed
+        self.misses += 1
+        parsed = parse_fn()
+        self._store(file_path, parsed)
+        self._prune()
+        return parsed
+
+    def _store(self, file_path, parsed):
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._version_directory,
+                                            suffix=".tmp")
+            with os.fdopen(fd, "wb") as fd:
+                pickle.dump(parsed, fd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, file_path)
+        except Exception as e:
+            log.debug("Failed to store script cache entry %s: %r",
+                      file_path, e)
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def _prune(self):
+        if not self._pruned_versions:
+            self._pruned_versions = True
+            current = path.basename(self._version_directory)
+            try:
+                for entry in os.scandir(self.directory):
+                    if (entry.name != current and entry.is_dir()
+                            and _VERSION_DIR_RE.fullmatch(entry.name)):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+        try:
+            entries = [entry for entry in os.scandir(self._version_directory)
+                       if entry.name.endswith(".pickle")]
+        except OSError:
+            return
+        if len(entries) <= self.max_entries:
+            return
+
+        def last_used(entry):
+            try:
+                return entry.stat().st_mtime
+            except OSError:
+                return 0
+
+        entries.sort(key=last_used)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def print_stats(self, out=None):
+        print("Script cache %s: %i hit(s), %i miss(es)"
+              % (self.directory, self.hits, self.misses),
+              file=out or sys.stderr)
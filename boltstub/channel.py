@@ -17,11 +17,13 @@
 
 
 import traceback
+from functools import partial
 from time import sleep
 from typing import Iterable
 
 from .bolt_protocol import get_bolt_protocol
 from .errors import ServerExit
+from .events import message_fields
 from .packstream import PackStream
 from .parsing import ScriptFailure
 from .util import (
@@ -35,23 +37,41 @@ class Channel:
     # protocol.
 
     def __init__(self, wire, bolt_version, log_cb=None, handshake_data=None,
-                 handshake_delay=None, eval_context=None):
+                 handshake_delay=None, eval_context=None, precompiled=True,
+                 events=None, debug_log_cb=None):
         self.wire = wire
         self.bolt_protocol = get_bolt_protocol(bolt_version)
         self.stream = PackStream(wire, self.bolt_protocol.packstream_version)
         self.log = log_cb
+        self.debug_log = debug_log_cb
+        self.events = events
+        if events is not None:
+            wire.on_idle = partial(self.event, "S", "<WAITING>")
         self.handshake_data = handshake_data
         self.handshake_delay = handshake_delay
         self._buffered_msg = None
         self.eval_context = eval_context or EvalContext()
+        self.precompiled = precompiled
+        # number of client lines tried against the next message
+        self.match_attempts = 0
 
     def _log(self, *args, **kwargs):
         if self.log:
             self.log(*args, **kwargs)
 
+    def event(self, direction, name, fields="", line=None):
+        if self.events is not None:
+            self.events.add(self.wire, direction, name, fields, line)
+
+    def _message_event(self, direction, message, line=None):
+        if self.events is not None:
+            self.events.add(self.wire, direction, message.name,
+                            message_fields(message), line)
+
     def preamble(self):
         request = self.wire.read(4)
         self._log("C: <MAGIC> %s", hex_repr(request))
+        self.event("C", "<MAGIC>", hex_repr(request))
         if request != b"\x60\x60\xb0\x17":
             raise ServerExit(
                 "Expected the magic header {}, received {}".format(
@@ -62,6 +82,7 @@ class Channel:
     def version_handshake(self):
         request = self.wire.read(16)
         self._log("C: <HANDSHAKE> %s", hex_repr(request))
+        self.event("C", "<HANDSHAKE>", hex_repr(request))
         if self.handshake_data is not None:
             response = self.handshake_data
         else:
@@ -85,6 +106,8 @@ class Channel:
                     try:
                         self._log("S: <HANDSHAKE> %s",
                                   hex_repr(b"\x00\x00\x00\x00"))
+                        self.event("S", "<HANDSHAKE>",
+                                   hex_repr(b"\x00\x00\x00\x00"))
                         self.wire.write(b"\x00\x00\x00\x00")
                         self.wire.send()
                     except OSError:
@@ -96,28 +119,51 @@ class Channel:
                     )
         if self.handshake_delay:
             self._log("S: <HANDSHAKE DELAY> %s", self.handshake_delay)
-            sleep(self.handshake_delay)
+            self.event("S", "<HANDSHAKE DELAY>", str(self.handshake_delay))
+            self.sleep(self.handshake_delay)
         self.wire.write(response)
         self.wire.send()
         self._log("S: <HANDSHAKE> %s", hex_repr(response))
+        self.event("S", "<HANDSHAKE>", hex_repr(response))
+
+    def sleep(self, duration):
+        sleep(duration)
 
     def match_client_line(self, client_line, msg):
+        self.match_attempts += 1
         return client_line.match_message(msg.name, msg.fields)
 
+    def _log_match_attempts(self):
+        if self.debug_log:
+            self.debug_log("<MATCH ATTEMPTS> %i", self.match_attempts)
+        self.match_attempts = 0
+
     def send_raw(self, b):
         self.log("%s", hex_repr(b))
+        self.event("S", "<RAW>", hex_repr(b))
         self.wire.write(b)
         self.wire.send()
 
     def send_struct(self, struct):
         self.log("S: %s", struct)
+        self._message_event("S", struct)
         self.stream.write_message(struct)
         self.stream.drain()
 
     def send_server_line(self, server_line):
         self.log("%s", server_line)
-        server_line = self.bolt_protocol.translate_server_line(server_line)
-        self.stream.write_message(server_line)
+        if self.events is not None:
+            name, _, fields = server_line.content.strip().partition(" ")
+            self.events.add(self.wire, "S", name, fields.strip(),
+                            server_line.line_number)
+        encoded = None
+        if self.precompiled:
+            encoded = server_line.encoded_messages.get(self.bolt_protocol)
+        if encoded is None:
+            server_line = self.bolt_protocol.translate_server_line(server_line)
+            self.stream.write_message(server_line)
+        else:
+            self.stream.write_encoded_message(encoded)
         self.stream.drain()
 
     def _consume(self):
@@ -131,6 +177,8 @@ class Channel:
                 self.log("(%3i) C: %s", line_no, self._buffered_msg)
             else:
                 self.log("(%3i) C: %s", self._buffered_msg)
+            self._message_event("C", self._buffered_msg, line_no)
+            self._log_match_attempts()
             msg = self._buffered_msg
             self._buffered_msg = None
             return msg
@@ -166,6 +214,8 @@ class Channel:
         if next_msg.name in whitelist:
             self._buffered_msg = None  # consume the message for real
             self.log("C: %s", next_msg)
+            self._message_event("C", next_msg)
+            self._log_match_attempts()
             self.auto_respond(next_msg)
             return True
         return False
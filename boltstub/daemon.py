@@ -0,0 +1,620 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Long-lived process running any number of stub servers.
+
+Instead of starting a `python -m boltstub` process per stub server, clients
+ask the daemon to start stub servers over a control socket. Each stub server
+behaves like a stub server process: it has an stdout and an stderr, can be
+interrupted (like with SIGINT) or killed, and ends with the exit code the
+process would have ended with.
+
+Run with
+    python -m boltstub.daemon [--socket PATH | -l CONTROL_ADDR]
+
+Scripts can run Python code (`PY:` lines), so only the user running the
+daemon may control it. By default, the control socket is a Unix domain
+socket only that user can access. Where there are none, e.g., on Windows,
+the daemon listens on a TCP address instead and every control connection
+must first authenticate with the token in the environment variable named
+`TOKEN_ENV` of the daemon.
+
+The control protocol is one JSON object per line in each direction. Requests
+look like `{"name": "StartServer", "data": {...}}`. Every request is answered
+by one response of the same shape. See :class:`.StubDaemon` for the
+requests.
+"""
+
+
+import atexit
+import hmac
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import traceback
+import warnings
+from argparse import ArgumentParser
+from collections import deque
+from itertools import (
+    count,
+    islice,
+)
+from logging import (
+    DEBUG,
+    getLogger,
+    Handler,
+    INFO,
+    LoggerAdapter,
+)
+from socketserver import (
+    StreamRequestHandler,
+    ThreadingTCPServer,
+)
+
+try:
+    from socketserver import ThreadingUnixStreamServer
+except ImportError:
+    # no Unix domain sockets, e.g., on Windows
+    ThreadingUnixStreamServer = None
+
+from . import (
+    get_service_class,
+    listen,
+    service_exit_code,
+)
+from .addressing import Address
+from .caching import (
+    CACHE_DIR_ENV,
+    get_script_cache,
+)
+from .events import EventLog
+from .parsing import parse
+from .watcher import (
+    ColourFormatter,
+    watch,
+)
+
+log = getLogger(__name__)
+
+# exit codes mirroring those of a `python -m boltstub` process
+LOAD_FAILURE_EXIT_CODE = 1
+START_FAILURE_EXIT_CODE = 99
+HARD_EXIT_CODE = 130
+KILLED_EXIT_CODE = -9
+
+# environment variable holding the token of a daemon listening on TCP
+TOKEN_ENV = "BOLTSTUB_DAEMON_TOKEN"
+
+
+class ServerOutput:
+    """Line buffer standing in for the stdout or stderr of a stub server.
+
+    Lines are indexed from the first line ever written. Once there are more
+    than `max_size` characters, the oldest lines are dropped.
+    """
+
+    max_size = 16 * 1024 * 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lines = deque()
+        self._size = 0
+        # number of lines dropped from the front
+        self._dropped = 0
+        self._partial_line = ""
+
+    def write(self, text):
+        with self._lock:
+            lines = (self._partial_line + text).splitlines(keepends=True)
+            if lines and not lines[-1].endswith("\n"):
+                self._partial_line = lines.pop()[-self.max_size:]
+            else:
+                self._partial_line = ""
+            self._lines.extend(lines)
+            self._size += sum(map(len, lines))
+            # the latest line is kept, however long
+            while self._size > self.max_size and len(self._lines) > 1:
+                self._size -= len(self._lines.popleft())
+                self._dropped += 1
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def lines(self, start=0):
+        """Return the lines from index `start` on and the next index.
+
+        If lines from `start` on have been dropped, a line saying how many
+        comes first.
+        """
+        with self._lock:
+            end = self._dropped + len(self._lines)
+            skip = start - self._dropped
+            if skip >= 0:
+                return list(islice(self._lines, skip, None)), end
+            return (["<%i line(s) dropped>\n" % -skip, *self._lines],
+                    end)
+
+
+class _ServerLogHandler(Handler):
+    # Writes log records of a stub server's service to its stdout.
+
+    def emit(self, record):
+        server = getattr(record, "stub_server", None)
+        if server is None or not server.verbose:
+            return
+        try:
+            server.stdout.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+_server_log = getLogger(__name__ + ".servers")
+_server_log.propagate = False
+_server_log.setLevel(INFO)
+_server_log_handler = _ServerLogHandler()
+_server_log_handler.setFormatter(ColourFormatter("%(asctime)s  %(message)s"))
+_server_log.addHandler(_server_log_handler)
+
+_parse_lock = threading.Lock()
+
+
+class StubServer:
+    """A stub server run by the daemon.
+
+    :param id_: id of the server in its daemon
+    :param verbose: whether to write the conversation to the server's stdout
+        (like `python -m boltstub -v`)
+    """
+
+    def __init__(self, id_, verbose=True):
+        self.id = id_
+        self.verbose = verbose
+        self.stdout = ServerOutput()
+        self.stderr = ServerOutput()
+        self.events = EventLog()
+        self.log = LoggerAdapter(_server_log, {"stub_server": self})
+        self.service = None
+        self.exit_code = None
+        self._interrupts = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._exited = threading.Event()
+
+    def start(self, script, listen_addr=None, filename=None, timeout=None,
+              precompiled=True, asyncio=False, cache=None):
+        """Parse the script and start serving it in a new thread.
+
+        Like a stub server process, failing to load the script doesn't raise
+        an error. It ends the server with the corresponding exit code
+        instead.
+        """
+        try:
+            listen_socket = listen(listen_addr, out=self.stdout)
+        except Exception:
+            self.stderr.write(traceback.format_exc())
+            self._exit(LOAD_FAILURE_EXIT_CODE)
+            return
+        try:
+            script = self._parse(script, cache)
+            script.filename = filename
+            service_class = get_service_class(asyncio=asyncio)
+            self.service = service_class(
+                script, listen_addr=listen_addr, timeout=timeout,
+                precompiled=precompiled, listen_socket=listen_socket,
+                logger=self.log, events=self.events
+            )
+        except Exception:
+            listen_socket.close()
+            if filename:
+                self.stderr.write("Error while parsing %s\n" % filename)
+            self.stderr.write(traceback.format_exc())
+            self._exit(LOAD_FAILURE_EXIT_CODE)
+            return
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _parse(self, script, cache):
+        # recording warnings isn't thread-safe
+        with _parse_lock, warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("default")
+            try:
+                return parse(script, cache=cache)
+            finally:
+                for w in caught:
+                    self.stderr.write(warnings.formatwarning(
+                        w.message, w.category, w.filename, w.lineno, w.line
+                    ))
+
+    def _serve(self):
+        try:
+            self.service.start()
+        except Exception as e:
+            self.log.error(" ".join(map(str, e.args)))
+            self.log.error("\r\n")
+            self._exit(START_FAILURE_EXIT_CODE)
+            return
+        self._exit(service_exit_code(self.service, out=self.stdout))
+
+    def _exit(self, exit_code):
+        with self._lock:
+            if self.exit_code is None:
+                self.exit_code = exit_code
+        self._exited.set()
+
+    def wait(self, timeout=None):
+        """Wait for the server to exit, return the exit code or None."""
+        self._exited.wait(timeout)
+        return self.exit_code
+
+    def interrupt(self):
+        """Do what a SIGINT does to a stub server process."""
+        if self._exited.is_set():
+            return
+        with self._lock:
+            self._interrupts += 1
+            interrupts = self._interrupts
+        if interrupts == 1:
+            self.stdout.write("1st interrupt received. "
+                              "Trying to finish all running scripts.\n")
+            self.service.try_skip_to_end_async()
+        elif interrupts == 2:
+            self.stdout.write("2nd interrupt received. "
+                              "Closing all connections.\n")
+            self.service.close_all_connections_async()
+        else:
+            self.stdout.write("3rd interrupt received. Hard exit.\n")
+            self.kill(HARD_EXIT_CODE)
+
+    def kill(self, exit_code=KILLED_EXIT_CODE):
+        """Stop the server right away.
+
+        Waits a moment for the service to close its socket so that the port
+        can be used again immediately.
+        """
+        if self._exited.is_set():
+            return
+        self._exit(exit_code)
+        self.service.close_all_connections_async()
+        self._thread.join(timeout=2)
+
+    def status(self, stdout_from=0, stderr_from=0, events_from=0):
+        stdout, stdout_next = self.stdout.lines(stdout_from)
+        stderr, stderr_next = self.stderr.lines(stderr_from)
+        return {
+            "serverId": self.id,
+            "exitCode": self.exit_code,
+            "stdout": stdout,
+            "stdoutNext": stdout_next,
+            "stderr": stderr,
+            "stderrNext": stderr_next,
+            "events": self.events.entries(events_from),
+        }
+
+
+class StubDaemon:
+    """Registry of the stub servers of a daemon and its control requests.
+
+    Requests about a server name it by the `serverId` it was started with.
+    Responses reporting a server's status (`ServerStatus`) contain its
+    `exitCode` (null while running), the lines written to its `stdout` and
+    `stderr`, and its conversation `events` (see :mod:`.events`), starting at
+    the indexes `stdoutFrom`, `stderrFrom`, and `eventsFrom` given in the
+    request. `stdoutNext` and `stderrNext` are the indexes to continue from,
+    as old output may have been dropped (see :class:`.ServerOutput`).
+
+    * `StartServer` {script, listenAddr, filename?, verbose?, timeout?}
+        Start serving the script (text). Answered once the server listens or
+        has exited on failing to load the script.
+    * `GetServerStatus` {serverId, timeout?, eventsTimeout?}
+        Optionally wait up to `timeout` seconds for the server to exit, or up
+        to `eventsTimeout` seconds for events past `eventsFrom`.
+    * `InterruptServer` {serverId}
+        Equivalent of sending SIGINT to a stub server process.
+    * `KillServer` {serverId}
+        Equivalent of killing a stub server process.
+    * `ReleaseServer` {serverId}
+        Kill the server if running and forget about it.
+    * `Reset` {}
+        Kill and forget all servers.
+
+    Failed requests are answered with `DaemonError` {msg}.
+    """
+
+    def __init__(self, precompiled=True, asyncio=False, cache=None):
+        self.precompiled = precompiled
+        self.asyncio = asyncio
+        self.cache = cache
+        self._servers = {}
+        self._ids = count(1)
+        self._lock = threading.Lock()
+
+    def handle(self, name, data):
+        """Handle a control request, return the response's name and data."""
+        handler = self._handlers.get(name)
+        if handler is None:
+            raise ValueError("Unknown request %r" % name)
+        return handler(self, data)
+
+    def _get_server(self, data):
+        with self._lock:
+            try:
+                return self._servers[data["serverId"]]
+            except KeyError:
+                raise ValueError(
+                    "Unknown stub server %r" % data.get("serverId")
+                ) from None
+
+    @staticmethod
+    def _status(server, data):
+        return "ServerStatus", server.status(data.get("stdoutFrom", 0),
+                                             data.get("stderrFrom", 0),
+                                             data.get("eventsFrom", 0))
+
+    def _start_server(self, data):
+        server = StubServer(next(self._ids),
+                            verbose=data.get("verbose", True))
+        with self._lock:
+            self._servers[server.id] = server
+        log.info("Starting stub server %i on %s",
+                 server.id, data.get("listenAddr"))
+        server.start(data["script"], listen_addr=data.get("listenAddr"),
+                     filename=data.get("filename"),
+                     timeout=data.get("timeout"),
+                     precompiled=self.precompiled, asyncio=self.asyncio,
+                     cache=self.cache)
+        return self._status(server, data)
+
+    def _get_server_status(self, data):
+        server = self._get_server(data)
+        if data.get("timeout"):
+            server.wait(data["timeout"])
+        if data.get("eventsTimeout"):
+            server.events.wait(data.get("eventsFrom", 0),
+                               data["eventsTimeout"])
+        return self._status(server, data)
+
+    def _interrupt_server(self, data):
+        server = self._get_server(data)
+        server.interrupt()
+        return self._status(server, data)
+
+    def _kill_server(self, data):
+        server = self._get_server(data)
+        server.kill()
+        return self._status(server, data)
+
+    def _release_server(self, data):
+        server = self._get_server(data)
+        server.kill()
+        with self._lock:
+            self._servers.pop(server.id, None)
+        log.info("Released stub server %i", server.id)
+        return self._status(server, data)
+
+    def reset(self, data=None):
+        """Kill and forget all servers."""
+        with self._lock:
+            servers = list(self._servers.values())
+            self._servers.clear()
+        for server in servers:
+            server.kill()
+        log.info("Reset, released %i stub server(s)", len(servers))
+        return "Reset", {}
+
+    _handlers = {
+        "StartServer": _start_server,
+        "GetServerStatus": _get_server_status,
+        "InterruptServer": _interrupt_server,
+        "KillServer": _kill_server,
+        "ReleaseServer": _release_server,
+        "Reset": reset,
+    }
+
+
+class _ControlRequestHandler(StreamRequestHandler):
+    def handle(self):
+        if self.server.token is not None and not self._authenticate():
+            return
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                name, data = self.server.stub_daemon.handle(
+                    request["name"], request.get("data", {})
+                )
+            except Exception as e:
+                log.debug("Failed control request %r", line, exc_info=True)
+                name, data = "DaemonError", {
+                    "msg": "%s: %s" % (type(e).__name__, e)
+                }
+            self._respond(name, data)
+
+    def _authenticate(self):
+        # The first request must be `Authenticate` {token}.
+        try:
+            request = json.loads(self.rfile.readline())
+            token = request["data"]["token"]
+            expected = self.server.token.encode("utf-8")
+            valid = (request["name"] == "Authenticate"
+                     and hmac.compare_digest(token.encode("utf-8"), expected))
+        except Exception:
+            valid = False
+        if not valid:
+            log.warning("Rejected unauthenticated control connection")
+            self._respond("DaemonError", {"msg": "Authentication failed"})
+            return False
+        self._respond("Authenticated", {})
+        return True
+
+    def _respond(self, name, data):
+        self.wfile.write(json.dumps({"name": name, "data": data})
+                         .encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class ControlServer(ThreadingTCPServer):
+    """TCP server for the control connections of a :class:`.StubDaemon`.
+
+    For where there are no Unix domain sockets. Clients must authenticate
+    with `token` (see :class:`.UnixControlServer`).
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, stub_daemon, token):
+        if not token:
+            raise ValueError("A control server on TCP needs a token")
+        self.stub_daemon = stub_daemon
+        self.token = token
+        super().__init__(address, _ControlRequestHandler)
+
+
+if ThreadingUnixStreamServer is not None:
+    class UnixControlServer(ThreadingUnixStreamServer):
+        """Unix domain socket server for the control connections.
+
+        The socket is only accessible by the user running the daemon.
+        """
+
+        daemon_threads = True
+        token = None
+
+        def __init__(self, path, stub_daemon):
+            self.stub_daemon = stub_daemon
+            super().__init__(path, _ControlRequestHandler)
+
+        def server_bind(self):
+            # no one else may connect in between binding and chmod
+            umask = os.umask(0o177)
+            try:
+                super().server_bind()
+            finally:
+                os.umask(umask)
+            os.chmod(self.server_address, 0o600)
+
+        def server_close(self):
+            super().server_close()
+            try:
+                os.remove(self.server_address)
+            except OSError:
+                pass
+
+
+def main():
+    parser = ArgumentParser(description="""\
+    Run a Bolt stub server daemon.
+
+    The daemon runs stub servers on request of clients connecting to its
+    control address. This saves starting a stub server process per script.
+    """)
+    parser.add_argument(
+        "--socket", metavar="PATH",
+        help="Path of the Unix domain socket on which to listen for control "
+             "connections. Defaults to a new socket in a private temporary "
+             "directory."
+    )
+    parser.add_argument(
+        "-l", "--listen-addr",
+        help="Listen for control connections on this TCP address in "
+             "INTERFACE:PORT format instead, e.g., where there are no Unix "
+             "domain sockets. Use port 0 to pick a free port. Clients must "
+             "authenticate with the token in the {} environment variable, "
+             "which must be set.".format(TOKEN_ENV)
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0,
+        help="Show the control requests. Repeat (-vv) to also write debug "
+             "output of the stub servers to their stdout, e.g., how many "
+             "script lines each client message was matched against."
+    )
+    parser.add_argument(
+        "--no-precompile", action="store_true",
+        help="See `python -m boltstub --help`."
+    )
+    parser.add_argument(
+        "--asyncio", action="store_true",
+        help="Serve the connections of each stub server from an asyncio "
+             "event loop. See `python -m boltstub --help`."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory for caching parsed scripts across runs. "
+             "Defaults to the {} environment variable. Without either, "
+             "scripts are not cached.".format(CACHE_DIR_ENV)
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Always parse the scripts, even if a cache directory is "
+             "configured."
+    )
+    parsed = parser.parse_args()
+
+    if parsed.verbose:
+        watch("boltstub.daemon", INFO)
+    if parsed.verbose > 1:
+        _server_log.setLevel(DEBUG)
+
+    cache = None
+    if not parsed.no_cache:
+        cache = get_script_cache(parsed.cache_dir)
+    if cache is not None:
+        atexit.register(cache.print_stats)
+    stub_daemon = StubDaemon(precompiled=not parsed.no_precompile,
+                             asyncio=parsed.asyncio, cache=cache)
+    tmp_dir = None
+    if parsed.listen_addr:
+        token = os.environ.get(TOKEN_ENV)
+        if not token:
+            parser.error("--listen-addr needs a token in the {} environment "
+                         "variable".format(TOKEN_ENV))
+        address = Address.parse(parsed.listen_addr)
+        server = ControlServer((address.host, address.port_number),
+                               stub_daemon, token)
+        listening_on = Address(server.server_address[:2])
+    elif ThreadingUnixStreamServer is None:
+        parser.error("No Unix domain sockets here, use --listen-addr")
+    else:
+        path = parsed.socket
+        if not path:
+            tmp_dir = tempfile.mkdtemp(prefix="boltstub-daemon-")
+            path = os.path.join(tmp_dir, "control.sock")
+        server = UnixControlServer(path, stub_daemon)
+        listening_on = path
+    # clean up when terminated, too
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    # clients starting the daemon wait for this line to know where it listens
+    print("Listening on {}".format(listening_on), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        stub_daemon.reset()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Machine-readable record of the conversations of a stub server.
+
+Next to logging the conversation as text, a stub server given an event sink
+reports every message it receives or sends as an event. Events are dicts
+with the keys
+
+* `connection`: id of the connection, e.g., `"#A316>#238D"` like in the log
+* `direction`: `"C"` for messages from the client, `"S"` for messages of
+  the server
+* `line`: number of the script line played for the message, or `None`
+* `name`: name of the message, e.g., `"RUN"`, or the pseudo message in angle
+  brackets, e.g., `"<ACCEPT>"`, `"<HANDSHAKE>"`, or `"<HANGUP>"`
+* `fields`: the message's fields as text (simple JOLT for Bolt messages),
+  an empty string if there are none
+
+Besides the messages, the server reports the life cycle of each connection:
+`<ACCEPT>` when accepting it, `<WAITING>` whenever it has handled all
+received messages and waits for the client to send more, `<FINISHED>` when
+the script has been played to the end, and `<HANGUP>` when closing it.
+Hence, once the last event of every connection is one of the latter three,
+the server has caught up with the client.
+"""
+
+
+import abc
+import json
+import threading
+
+
+class EventSink(abc.ABC):
+    """Base class of the receivers of conversation events."""
+
+    def add(self, wire, direction, name, fields="", line=None):
+        self.append({
+            "connection": "#%04X>#%04X" % (
+                wire.remote_address.port_number,
+                wire.local_address.port_number,
+            ),
+            "direction": direction,
+            "line": line,
+            "name": name,
+            "fields": fields,
+        })
+
+    @abc.abstractmethod
+    def append(self, event):
+        pass
+
+
+class EventLog(EventSink):
+    """Keeps the events in memory."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._events = []
+
+    def append(self, event):
+        with self._condition:
+            self._events.append(event)
+            self._condition.notify_all()
+
+    def entries(self, start=0):
+        with self._condition:
+            return self._events[start:]
+
+    def wait(self, start, timeout):
+        """Wait at most `timeout` seconds for more than `start` events."""
+        with self._condition:
+            self._condition.wait_for(lambda: len(self._events) > start,
+                                     timeout)
+
+
+class EventWriter(EventSink):
+    """Writes the events to a file, one JSON object per line."""
+
+    def __init__(self, file):
+        self._lock = threading.Lock()
+        self._file = file
+
+    def append(self, event):
+        line = json.dumps(event) + "\n"
+        with self._lock:
+            if self._file.closed:
+                # connections still being torn down at exit
+                return
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def message_fields(message):
+    """Fields of a message (:class:`.TranslatedStructure`) as text."""
+    return str(message)[len(message.name) + 1:]
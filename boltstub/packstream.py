@@ -18,19 +18,19 @@
 
 import inspect
 import re
-from codecs import decode
+from importlib import import_module
 from io import BytesIO
 from struct import pack as struct_pack
+from struct import Struct
 from struct import unpack as struct_unpack
 
 from .simple_jolt.common import types as jolt_common_types
-from .simple_jolt.v1 import types as jolt_v1_types
-from .simple_jolt.v2 import types as jolt_v2_types
 
-_jolt_types = {
-    1: jolt_v1_types,
-    2: jolt_v2_types,
+_jolt_types_modules = {
+    1: ".simple_jolt.v1.types",
+    2: ".simple_jolt.v2.types",
 }
+_jolt_types = {}
 
 
 def jolt_types(packstream_version):
@@ -38,24 +38,35 @@ def jolt_types(packstream_version):
         raise ValueError(
             "JOLT conversion requires packstream_version to be specified"
         )
-    return _jolt_types[packstream_version]
+    try:
+        return _jolt_types[packstream_version]
+    except KeyError:
+        # imported on first use: a stub server only ever needs the types of
+        # its script's packstream version
+        types = import_module(_jolt_types_modules[packstream_version],
+                              __package__)
+        _jolt_types[packstream_version] = types
+        return types
 
 
 PACKED_UINT_8 = [struct_pack(">B", value) for value in range(0x100)]
-PACKED_UINT_16 = [struct_pack(">H", value) for value in range(0x10000)]
-
-UNPACKED_UINT_8 = {bytes(bytearray([x])): x for x in range(0x100)}
-UNPACKED_UINT_16 = {struct_pack(">H", x): x for x in range(0x10000)}
-
-UNPACKED_MARKERS = {b"\xC0": None, b"\xC2": False, b"\xC3": True}
-UNPACKED_MARKERS.update({bytes(bytearray([z])): z for z in range(0x00, 0x80)})
-UNPACKED_MARKERS.update({bytes(bytearray([z + 256])): z
-                         for z in range(-0x10, 0x00)})
 
 
 INT64_MIN = -(2 ** 63)
 INT64_MAX = 2 ** 63
 
+INT_8 = Struct(">b")
+INT_16 = Struct(">h")
+UINT_16 = Struct(">H")
+INT_32 = Struct(">i")
+INT_64 = Struct(">q")
+FLOAT_64 = Struct(">d")
+# size headers of bytes, strings, lists, and maps indexed by `marker & 0x03`
+SIZE_STRUCTS = (Struct(">B"), Struct(">H"), Struct(">I"))
+
+MARKER_VALUES = {0xC0: None, 0xC2: False, 0xC3: True}
+MARKER_VALUES.update({z: z for z in range(0x00, 0x80)})
+
 
 EndOfStream = object()
 
@@ -198,7 +209,8 @@ class Structure:
                     return True
 
     @classmethod
-    def _from_jolt_v1_type(cls, jolt: jolt_v1_types.JoltType):
+    def _from_jolt_v1_type(cls, jolt: jolt_common_types.JoltType):
+        jolt_v1_types = jolt_types(1)
         if isinstance(jolt, jolt_v1_types.JoltDate):
             return cls(StructTagV1.date, jolt.days, packstream_version=1)
         if isinstance(jolt, jolt_v1_types.JoltTime):
@@ -286,7 +298,8 @@ class Structure:
         raise TypeError("Unsupported jolt type: {}".format(type(jolt)))
 
     @classmethod
-    def _from_jolt_v2_type(cls, jolt: jolt_v2_types.JoltType):
+    def _from_jolt_v2_type(cls, jolt: jolt_common_types.JoltType):
+        jolt_v2_types = jolt_types(2)
         if isinstance(jolt, jolt_v2_types.JoltDate):
             return cls(StructTagV2.date, jolt.days, packstream_version=2)
         if isinstance(jolt, jolt_v2_types.JoltTime):
@@ -376,13 +389,14 @@ class Structure:
 
     @classmethod
     def from_jolt_type(cls, jolt: jolt_common_types.JoltType):
-        if isinstance(jolt, jolt_v1_types.JoltType):
+        if isinstance(jolt, jolt_types(1).JoltType):
             return cls._from_jolt_v1_type(jolt)
-        elif isinstance(jolt, jolt_v2_types.JoltType):
+        elif isinstance(jolt, jolt_types(2).JoltType):
             return cls._from_jolt_v2_type(jolt)
         raise TypeError("Unsupported jolt type: {}".format(type(jolt)))
 
     def _to_jolt_v1_type(self):
+        jolt_v1_types = jolt_types(1)
         if self.tag == StructTagV1.date:
             return jolt_v1_types.JoltDate.new(*self.fields)
         if self.tag == StructTagV1.time:
@@ -432,6 +446,7 @@ class Structure:
         raise TypeError("Unsupported struct type: {}".format(self.tag))
 
     def _to_jolt_v2_type(self):
+        jolt_v2_types = jolt_types(2)
         if self.tag == StructTagV2.date:
             return jolt_v2_types.JoltDate.new(*self.fields)
         if self.tag == StructTagV2.time:
@@ -745,7 +760,7 @@ class Packer:
                 write(PACKED_UINT_8[value % 0x100])
             elif -0x8000 <= value < 0x8000:
                 write(b"\xC9")
-                write(PACKED_UINT_16[value % 0x10000])
+                write(INT_16.pack(value))
             elif -0x80000000 <= value < 0x80000000:
                 write(b"\xCA")
                 write(struct_pack(">i", value))
@@ -798,7 +813,7 @@ class Packer:
             write(PACKED_UINT_8[size])
         elif size < 0x10000:
             write(b"\xCD")
-            write(PACKED_UINT_16[size])
+            write(UINT_16.pack(size))
         elif size < 0x100000000:
             write(b"\xCE")
             write(struct_pack(">I", size))
@@ -844,7 +859,7 @@ class Packer:
             write(PACKED_UINT_8[size])
         elif size < 0x10000:
             write(b"\xD1")
-            write(PACKED_UINT_16[size])
+            write(UINT_16.pack(size))
         elif size < 0x100000000:
             write(b"\xD2")
             write(struct_pack(">I", size))
@@ -890,7 +905,7 @@ class Packer:
             write(PACKED_UINT_8[size])
         elif size < 0x10000:
             write(b"\xD5")
-            write(PACKED_UINT_16[size])
+            write(UINT_16.pack(size))
         elif size < 0x100000000:
             write(b"\xD6")
             write(struct_pack(">I", size))
@@ -939,7 +954,7 @@ class Packer:
             write(PACKED_UINT_8[size])
         elif size < 0x10000:
             write(b"\xD9")
-            write(PACKED_UINT_16[size])
+            write(UINT_16.pack(size))
         elif size < 0x100000000:
             write(b"\xDA")
             write(struct_pack(">I", size))
@@ -1012,177 +1027,137 @@ class Unpacker:
         return self.unpackable.read_u8()
 
     def unpack_message(self):
-        res = self._unpack(verify_struct=False)
-        if not isinstance(res, Structure):
-            raise ValueError("Expected a message struct")
-        return res
-
-    def unpack(self):
-        return self._unpack()
-
-    def _unpack(self, verify_struct=True):
         marker = self.read_u8()
-
         if marker == -1:
             raise ValueError("Nothing to unpack")
+        if 0xB0 <= marker <= 0xBF:
+            return self._unpack_structure(marker, verify_struct=False)
+        UNPACK_DISPATCH[marker](self, marker)
+        raise ValueError("Expected a message struct")
 
-        # Tiny Integer
-        if 0x00 <= marker <= 0x7F:
-            return marker
-        elif 0xF0 <= marker <= 0xFF:
-            return marker - 0x100
-
-        # Null
-        elif marker == 0xC0:
-            return None
-
-        # Float
-        elif marker == 0xC1:
-            value, = struct_unpack(">d", self.read(8))
-            return value
-
-        # Boolean
-        elif marker == 0xC2:
-            return False
-        elif marker == 0xC3:
-            return True
-
-        # Integer
-        elif marker == 0xC8:
-            return struct_unpack(">b", self.read(1))[0]
-        elif marker == 0xC9:
-            return struct_unpack(">h", self.read(2))[0]
-        elif marker == 0xCA:
-            return struct_unpack(">i", self.read(4))[0]
-        elif marker == 0xCB:
-            return struct_unpack(">q", self.read(8))[0]
-
-        # Bytes
-        elif marker == 0xCC:
-            size, = struct_unpack(">B", self.read(1))
-            return self.read(size).tobytes()
-        elif marker == 0xCD:
-            size, = struct_unpack(">H", self.read(2))
-            return self.read(size).tobytes()
-        elif marker == 0xCE:
-            size, = struct_unpack(">I", self.read(4))
-            return self.read(size).tobytes()
-
-        else:
-            marker_high = marker & 0xF0
-            # String
-            if marker_high == 0x80:  # TINY_STRING
-                return decode(self.read(marker & 0x0F), "utf-8")
-            elif marker == 0xD0:  # STRING_8:
-                size, = struct_unpack(">B", self.read(1))
-                return decode(self.read(size), "utf-8")
-            elif marker == 0xD1:  # STRING_16:
-                size, = struct_unpack(">H", self.read(2))
-                return decode(self.read(size), "utf-8")
-            elif marker == 0xD2:  # STRING_32:
-                size, = struct_unpack(">I", self.read(4))
-                return decode(self.read(size), "utf-8")
-
-            # List
-            elif 0x90 <= marker <= 0x9F or 0xD4 <= marker <= 0xD7:
-                return list(self._unpack_list_items(marker))
-
-            # Map
-            elif 0xA0 <= marker <= 0xAF or 0xD8 <= marker <= 0xDB:
-                return self._unpack_map(marker)
-
-            # Structure
-            elif 0xB0 <= marker <= 0xBF:
-                size, tag = self._unpack_structure_header(marker)
-                fields = [None] * size
-                for i in range(len(fields)):
-                    fields[i] = self._unpack(verify_struct=True)
-                return Structure(tag, *fields,
-                                 packstream_version=self.packstream_version,
-                                 verified=verify_struct)
-
-            elif marker == 0xDF:  # END_OF_STREAM:
-                return EndOfStream
-
-            else:
-                raise ValueError("Unknown PackStream marker %02X" % marker)
+    def unpack(self):
+        return self._unpack()
 
-    def _unpack_list_items(self, marker):
-        marker_high = marker & 0xF0
-        if marker_high == 0x90:
-            size = marker & 0x0F
-            if size == 0:
-                return
-            elif size == 1:
-                yield self._unpack()
-            else:
-                for _ in range(size):
-                    yield self._unpack()
-        elif marker == 0xD4:  # LIST_8:
-            size, = struct_unpack(">B", self.read(1))
-            for _ in range(size):
-                yield self._unpack()
-        elif marker == 0xD5:  # LIST_16:
-            size, = struct_unpack(">H", self.read(2))
-            for _ in range(size):
-                yield self._unpack()
-        elif marker == 0xD6:  # LIST_32:
-            size, = struct_unpack(">I", self.read(4))
-            for _ in range(size):
-                yield self._unpack()
-        elif marker == 0xD7:  # LIST_STREAM:
-            item = None
-            while item is not EndOfStream:
-                item = self._unpack()
-                if item is not EndOfStream:
-                    yield item
-        else:
-            return
+    def _unpack(self):
+        buffer = self.unpackable
+        p = buffer.p
+        if p >= buffer.used:
+            raise ValueError("Nothing to unpack")
+        buffer.p = p + 1
+        marker = buffer.data[p]
+        return UNPACK_DISPATCH[marker](self, marker)
+
+    def _unpack_marker_value(self, marker):
+        return MARKER_VALUES[marker]
+
+    def _unpack_tiny_int(self, marker):
+        return marker - 0x100
+
+    def _unpack_float(self, _):
+        buffer = self.unpackable
+        return FLOAT_64.unpack_from(buffer.data, buffer.advance(8))[0]
+
+    def _unpack_int_8(self, _):
+        buffer = self.unpackable
+        return INT_8.unpack_from(buffer.data, buffer.advance(1))[0]
+
+    def _unpack_int_16(self, _):
+        buffer = self.unpackable
+        return INT_16.unpack_from(buffer.data, buffer.advance(2))[0]
+
+    def _unpack_int_32(self, _):
+        buffer = self.unpackable
+        return INT_32.unpack_from(buffer.data, buffer.advance(4))[0]
+
+    def _unpack_int_64(self, _):
+        buffer = self.unpackable
+        return INT_64.unpack_from(buffer.data, buffer.advance(8))[0]
+
+    def _unpack_size(self, marker):
+        size_struct = SIZE_STRUCTS[marker & 0x03]
+        buffer = self.unpackable
+        return size_struct.unpack_from(
+            buffer.data, buffer.advance(size_struct.size)
+        )[0]
+
+    def _unpack_bytes(self, marker):
+        size = self._unpack_size(marker)
+        buffer = self.unpackable
+        p = buffer.advance(size)
+        return bytes(buffer.data[p:(p + size)])
+
+    def _unpack_tiny_string(self, marker):
+        size = marker & 0x0F
+        buffer = self.unpackable
+        p = buffer.advance(size)
+        return buffer.data[p:(p + size)].decode("utf-8")
+
+    def _unpack_string(self, marker):
+        size = self._unpack_size(marker)
+        buffer = self.unpackable
+        p = buffer.advance(size)
+        return buffer.data[p:(p + size)].decode("utf-8")
+
+    def _unpack_tiny_list(self, marker):
+        unpack = self._unpack
+        return [unpack() for _ in range(marker & 0x0F)]
+
+    def _unpack_list(self, marker):
+        unpack = self._unpack
+        return [unpack() for _ in range(self._unpack_size(marker))]
+
+    def _unpack_list_stream(self, _):
+        unpack = self._unpack
+        value = []
+        item = unpack()
+        while item is not EndOfStream:
+            value.append(item)
+            item = unpack()
+        return value
+
+    def _unpack_map_items(self, size):
+        unpack = self._unpack
+        value = {}
+        for _ in range(size):
+            key = unpack()
+            value[key] = unpack()
+        return value
+
+    def _unpack_tiny_map(self, marker):
+        return self._unpack_map_items(marker & 0x0F)
+
+    def _unpack_sized_map(self, marker):
+        return self._unpack_map_items(self._unpack_size(marker))
+
+    def _unpack_map_stream(self, _):
+        unpack = self._unpack
+        value = {}
+        key = unpack()
+        while key is not EndOfStream:
+            value[key] = unpack()
+            key = unpack()
+        return value
+
+    def _unpack_structure(self, marker, verify_struct=True):
+        buffer = self.unpackable
+        tag = PACKED_UINT_8[buffer.data[buffer.advance(1)]]
+        unpack = self._unpack
+        fields = [unpack() for _ in range(marker & 0x0F)]
+        return Structure(tag, *fields,
+                         packstream_version=self.packstream_version,
+                         verified=verify_struct)
+
+    def _unpack_end_of_stream(self, _):
+        return EndOfStream
+
+    def _unpack_unknown(self, marker):
+        raise ValueError("Unknown PackStream marker %02X" % marker)
 
     def unpack_map(self):
         marker = self.read_u8()
-        return self._unpack_map(marker)
-
-    def _unpack_map(self, marker):
-        marker_high = marker & 0xF0
-        if marker_high == 0xA0:
-            size = marker & 0x0F
-            value = {}
-            for _ in range(size):
-                key = self._unpack()
-                value[key] = self._unpack()
-            return value
-        elif marker == 0xD8:  # MAP_8:
-            size, = struct_unpack(">B", self.read(1))
-            value = {}
-            for _ in range(size):
-                key = self._unpack()
-                value[key] = self._unpack()
-            return value
-        elif marker == 0xD9:  # MAP_16:
-            size, = struct_unpack(">H", self.read(2))
-            value = {}
-            for _ in range(size):
-                key = self._unpack()
-                value[key] = self._unpack()
-            return value
-        elif marker == 0xDA:  # MAP_32:
-            size, = struct_unpack(">I", self.read(4))
-            value = {}
-            for _ in range(size):
-                key = self._unpack()
-                value[key] = self._unpack()
-            return value
-        elif marker == 0xDB:  # MAP_STREAM:
-            value = {}
-            key = None
-            while key is not EndOfStream:
-                key = self._unpack()
-                if key is not EndOfStream:
-                    value[key] = self._unpack()
-            return value
-        else:
-            return None
+        if 0xA0 <= marker <= 0xAF or 0xD8 <= marker <= 0xDB:
+            return UNPACK_DISPATCH[marker](self, marker)
+        return None
 
     def unpack_structure_header(self):
         marker = self.read_u8()
@@ -1200,6 +1175,44 @@ class Unpacker:
             raise ValueError("Expected structure, found marker %02X" % marker)
 
 
+def _build_unpack_dispatch():
+    # One entry per marker byte, so that `Unpacker._unpack` never has to walk
+    # an if/elif chain to find out how to decode the next value.
+    dispatch = [Unpacker._unpack_unknown] * 0x100
+    for marker in MARKER_VALUES:
+        dispatch[marker] = Unpacker._unpack_marker_value
+    for marker in range(0xF0, 0x100):
+        dispatch[marker] = Unpacker._unpack_tiny_int
+    dispatch[0xC1] = Unpacker._unpack_float
+    dispatch[0xC8] = Unpacker._unpack_int_8
+    dispatch[0xC9] = Unpacker._unpack_int_16
+    dispatch[0xCA] = Unpacker._unpack_int_32
+    dispatch[0xCB] = Unpacker._unpack_int_64
+    for marker in range(0xCC, 0xCF):
+        dispatch[marker] = Unpacker._unpack_bytes
+    for marker in range(0x80, 0x90):
+        dispatch[marker] = Unpacker._unpack_tiny_string
+    for marker in range(0xD0, 0xD3):
+        dispatch[marker] = Unpacker._unpack_string
+    for marker in range(0x90, 0xA0):
+        dispatch[marker] = Unpacker._unpack_tiny_list
+    for marker in range(0xD4, 0xD7):
+        dispatch[marker] = Unpacker._unpack_list
+    dispatch[0xD7] = Unpacker._unpack_list_stream
+    for marker in range(0xA0, 0xB0):
+        dispatch[marker] = Unpacker._unpack_tiny_map
+    for marker in range(0xD8, 0xDB):
+        dispatch[marker] = Unpacker._unpack_sized_map
+    dispatch[0xDB] = Unpacker._unpack_map_stream
+    for marker in range(0xB0, 0xC0):
+        dispatch[marker] = Unpacker._unpack_structure
+    dispatch[0xDF] = Unpacker._unpack_end_of_stream
+    return tuple(dispatch)
+
+
+UNPACK_DISPATCH = _build_unpack_dispatch()
+
+
 class UnpackableBuffer:
 
     initial_capacity = 8192
@@ -1232,6 +1245,15 @@ class UnpackableBuffer:
         else:
             return -1
 
+    def advance(self, n):
+        """Skip `n` bytes and return the position they started at."""
+        p = self.p
+        q = p + n
+        if q > self.used:
+            raise ValueError("Unexpected end of PackStream data")
+        self.p = q
+        return p
+
     def pop_u16(self):
         """Remove and return last 2 bytes as big-endian 16 bit unsigned int."""
         if self.used >= 2:
@@ -1241,16 +1263,36 @@ class UnpackableBuffer:
         else:
             return -1
 
+    def _reserve(self, end):
+        capacity = len(self.data)
+        if end > capacity:
+            self.data += bytearray(max(end, 2 * capacity) - capacity)
+
+    def write(self, b):
+        """Append `b` after the used part of the buffer."""
+        end = self.used + len(b)
+        self._reserve(end)
+        self.data[self.used:end] = b
+        self.used = end
+
     def receive(self, sock, n_bytes):
+        """Receive exactly `n_bytes` from `sock` into the buffer.
+
+        `used` is updated after every `recv_into` call, so if the socket
+        raises (e.g., because of a timeout), the bytes received so far are
+        kept and the next call only has to receive the remainder.
+        """
         end = self.used + n_bytes
-        if end > len(self.data):
-            self.data += bytearray(end - len(self.data))
-        view = memoryview(self.data)
-        while self.used < end:
-            n = sock.recv_into(view[self.used:end], end - self.used)
-            if n == 0:
-                raise OSError("No data")
-            self.used += n
+        self._reserve(end)
+        # release the views even when recv_into raises, a lingering export
+        # would prevent the buffer from growing later on
+        with memoryview(self.data) as view:
+            while self.used < end:
+                with view[self.used:end] as target:
+                    n = sock.recv_into(target)
+                if n == 0:
+                    raise OSError("No data")
+                self.used += n
 
 
 class PackStream:
@@ -1259,32 +1301,37 @@ class PackStream:
     def __init__(self, wire, packstream_version):
         self.wire = wire
         self.packstream_version = packstream_version
-        self.data_buffer = []
-        self.next_chunk_size = None
+        # chunks are reassembled in place, the buffer is reused (and only
+        # grows) across messages
+        self.buffer = UnpackableBuffer()
+        self.unpacker = Unpacker(self.buffer, packstream_version)
+        self.chunk_end = None
 
     def read_message(self):
         """Read a chunked message.
 
+        The reading can be interrupted (e.g., by `ReadWakeup`) at any point
+        and resumed by calling this method again.
+
         :return:
         """
+        buffer = self.buffer
         while True:
-            if self.next_chunk_size is None:
-                chunk_size = self.wire.read(2)
-                self.next_chunk_size, = struct_unpack(">H", chunk_size)
-            if self.next_chunk_size:
-                chunk_data = self.wire.read(self.next_chunk_size)
-                self.next_chunk_size = None
-                self.data_buffer.append(chunk_data)
-            else:
-                self.next_chunk_size = None
-                break
-        buffer = UnpackableBuffer(b"".join(self.data_buffer))
-        self.data_buffer = []
-        unpacker = Unpacker(buffer, self.packstream_version)
-        return unpacker.unpack_message()
+            if self.chunk_end is None:
+                chunk_size, = struct_unpack(">H", self.wire.read(2))
+                if not chunk_size:
+                    break
+                self.chunk_end = buffer.used + chunk_size
+            self.wire.read_into(buffer, self.chunk_end - buffer.used)
+            self.chunk_end = None
+        try:
+            return self.unpacker.unpack_message()
+        finally:
+            buffer.reset()
 
-    def write_message(self, message):
-        """Write a chunked message.
+    @staticmethod
+    def encode_message(message):
+        """Pack and chunk a message into the bytes that go over the wire.
 
         :param message:
         :return:
@@ -1295,13 +1342,32 @@ class PackStream:
         packer = Packer(b)
         packer.pack(message)
         data = b.getvalue()
+        encoded = bytearray()
         while len(data) > 65535:
             chunk = data[:65535]
-            header = bytearray(divmod(len(chunk), 0x100))
-            self.wire.write(header + chunk)
+            encoded += bytearray(divmod(len(chunk), 0x100))
+            encoded += chunk
             data = data[65535:]
-        header = bytearray(divmod(len(data), 0x100))
-        self.wire.write(header + data + b"\x00\x00")
+        encoded += bytearray(divmod(len(data), 0x100))
+        encoded += data
+        encoded += b"\x00\x00"
+        return bytes(encoded)
+
+    def write_message(self, message):
+        """Write a chunked message.
+
+        :param message:
+        :return:
+        """
+        self.wire.write(self.encode_message(message))
+
+    def write_encoded_message(self, data):
+        """Write a message previously encoded with `encode_message`.
+
+        :param data:
+        :return:
+        """
+        self.wire.write(data)
 
     def drain(self):
         """Flush the writer.
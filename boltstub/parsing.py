@@ -27,8 +27,9 @@ from collections import OrderedDict
 from copy import deepcopy
 from os import path
 from textwrap import wrap
-from time import sleep
 from typing import (
+    FrozenSet,
+    Iterable,
     List,
     Optional,
 )
@@ -39,13 +40,17 @@ from .bolt_protocol import (
     get_bolt_protocol,
     verify_script_messages,
 )
+from .caching import ScriptCache
 from .errors import (
     BoltMissingVersionError,
     BoltUnknownMessageError,
     BoltUnknownVersionError,
     ServerExit,
 )
-from .packstream import Structure
+from .packstream import (
+    PackStream,
+    Structure,
+)
 from .simple_jolt.common.types import (
     JoltType,
     JoltWildcard,
@@ -61,7 +66,16 @@ def load_parser():
         )
 
 
-parser = load_parser()
+_parser = None
+
+
+def get_parser():
+    # Building the parser is expensive. It's not needed at all when the
+    # script is loaded from the cache.
+    global _parser
+    if _parser is None:
+        _parser = load_parser()
+    return _parser
 
 
 class CopyableRLock:
@@ -71,6 +85,9 @@ class CopyableRLock:
     def __deepcopy__(self, memodict=None):
         return CopyableRLock()
 
+    def __reduce__(self):
+        return CopyableRLock, ()
+
     def acquire(self, blocking=True, timeout=-1):
         return self._l.acquire(blocking=blocking, timeout=timeout)
 
@@ -115,6 +132,18 @@ class Line(str, abc.ABC):
     def __getnewargs__(self):
         return self.line_number, super(Line, self).__str__(), self.content
 
+    def __reduce__(self):
+        # Restore the parsed line as it was pickled instead of parsing and
+        # verifying it again.
+        return _unpickle_line, (self.__class__, super(Line, self).__str__(),
+                                self.__dict__)
+
+    def __deepcopy__(self, memodict=None):
+        # Lines don't change once the script has been parsed. Copies of a
+        # script (one per connection) share them and only copy the blocks,
+        # which hold the state of playing the script.
+        return self
+
     @abc.abstractmethod
     def canonical(self):
         pass
@@ -123,6 +152,12 @@ class Line(str, abc.ABC):
         pass
 
 
+def _unpickle_line(cls, raw_line, state):
+    obj = str.__new__(cls, raw_line)
+    obj.__dict__.update(state)
+    return obj
+
+
 class BangLine(Line):
     TYPE_AUTO = "auto"
     TYPE_BOLT = "bolt"
@@ -321,63 +356,149 @@ class ClientLine(MessageLine):
         return " ".join(("C:", self.parsed[0],
                          *map(json.dumps, self.parsed[1])))
 
+    def parse_jolt(self, jolt_package):
+        jolt_parsed = super().parse_jolt(jolt_package)
+        self.fields_matcher = self._compile_matcher(jolt_parsed[1])
+        return jolt_parsed
+
     def match_message(self, name, fields):
         assert self.jolt_parsed
-        line_name, line_fields = self.jolt_parsed
-        if line_name != name:
+        if self.jolt_parsed[0] != name:
             return False
-        return self._field_match(line_fields, fields)
+        return self.fields_matcher.match(fields)
 
-    @classmethod
-    def _dict_match(cls, should, is_):
-        accepted_keys = set()
-        for should_key in should:
-            should_key_unescaped = re.sub(r"\\([\[\]\\\{\}])", r"\1",
-                                          should_key)
-            should_value = should[should_key]
-            optional = re.match(r"^\[.*\]$", should_key)
+    def _compile_matcher(self, should):
+        # Resolve everything that only depends on the line, so matching a
+        # message is a plain walk of the matcher tree.
+        if isinstance(should, str):
+            if should == "*":
+                return _AnyMatcher()
+            should = _UNESCAPE_STR_RE.sub(r"\1", should)
+        if isinstance(should, JoltWildcard):
+            return _WildcardMatcher(should)
+        if isinstance(should, (list, tuple)):
+            return _SequenceMatcher(should,
+                                    [self._compile_matcher(v) for v in should])
+        if isinstance(should, dict):
+            return self._compile_dict_matcher(should)
+        if isinstance(should, float) and math.isnan(should):
+            return _NanMatcher(should)
+        return _ValueMatcher(should)
+
+    def _compile_dict_matcher(self, should):
+        entries = []
+        for should_key, should_value in should.items():
+            key = _UNESCAPE_KEY_RE.sub(r"\1", should_key)
+            optional = bool(_OPTIONAL_KEY_RE.match(should_key))
             if optional:
-                should_key_unescaped = should_key_unescaped[1:-1]
-            ordered = re.match(r"^(?:\[.*\{\}\]|.*\{\})$", should_key)
+                key = key[1:-1]
+            ordered = bool(_ORDERED_KEY_RE.match(should_key))
             if ordered:
-                should_key_unescaped = should_key_unescaped[:-2]
+                key = key[:-2]
                 if isinstance(should_value, list):
-                    should_value = sorted(should_value)
-            accepted_keys.add(should_key_unescaped)
-            if should_key_unescaped in is_:
-                is_value = is_[should_key_unescaped]
+                    try:
+                        should_value = sorted(should_value)
+                    except TypeError as e:
+                        raise LineError(
+                            self, "values of ordered key %r cannot be sorted"
+                            % should_key
+                        ) from e
+            entries.append((key, optional, ordered,
+                            self._compile_matcher(should_value)))
+        return _DictMatcher(should, entries)
+
+
+# Matchers for the fields of client lines. Each matcher corresponds to a
+# (sub-)field of the line and checks a received value using `match`.
+# Anything but wildcards has to be of the same type as the expected value;
+# received structures have to be equal to the expected value.
+
+_UNESCAPE_STR_RE = re.compile(r"\\([\\*])")
+_UNESCAPE_KEY_RE = re.compile(r"\\([\[\]\\\{\}])")
+_OPTIONAL_KEY_RE = re.compile(r"^\[.*\]$")
+_ORDERED_KEY_RE = re.compile(r"^(?:\[.*\{\}\]|.*\{\})$")
+
+
+class _AnyMatcher:
+    __slots__ = ()
+
+    def match(self, is_):
+        return True
+
+
+class _WildcardMatcher:
+    __slots__ = ("should",)
+
+    def __init__(self, should):
+        self.should = should
+
+    def match(self, is_):
+        if isinstance(is_, Structure):
+            return is_.match_jolt_wildcard(self.should)
+        return type(is_) in self.should.types
+
+
+class _ValueMatcher:
+    __slots__ = ("should", "type")
+
+    def __init__(self, should):
+        self.should = should
+        self.type = type(should)
+
+    def match(self, is_):
+        if isinstance(is_, Structure):
+            return is_ == self.should
+        return type(is_) is self.type and is_ == self.should
+
+
+class _NanMatcher(_ValueMatcher):
+    __slots__ = ()
+
+    def match(self, is_):
+        if isinstance(is_, Structure):
+            return is_ == self.should
+        return type(is_) is float and math.isnan(is_)
+
+
+class _SequenceMatcher(_ValueMatcher):
+    __slots__ = ("items",)
+
+    def __init__(self, should, items):
+        super().__init__(should)
+        self.items = items
+
+    def match(self, is_):
+        if isinstance(is_, Structure):
+            return is_ == self.should
+        if type(is_) is not self.type or len(is_) != len(self.items):
+            return False
+        return all(m.match(v) for m, v in zip(self.items, is_))
+
+
+class _DictMatcher(_ValueMatcher):
+    __slots__ = ("entries", "accepted_keys")
+
+    def __init__(self, should, entries):
+        super().__init__(should)
+        # tuples of (unescaped key, optional, ordered, matcher)
+        self.entries = entries
+        self.accepted_keys = frozenset(entry[0] for entry in entries)
+
+    def match(self, is_):
+        if isinstance(is_, Structure):
+            return is_ == self.should
+        if type(is_) is not self.type:
+            return False
+        for key, optional, ordered, matcher in self.entries:
+            if key in is_:
+                is_value = is_[key]
                 if ordered and isinstance(is_value, list):
                     is_value = sorted(is_value)
-                if not cls._field_match(should_value, is_value):
+                if not matcher.match(is_value):
                     return False
             elif not optional:
                 return False
-        return not set(is_.keys()).difference(accepted_keys)
-
-    @classmethod
-    def _field_match(cls, should, is_):
-        if isinstance(should, str):
-            if should == "*":
-                return True
-            should = re.sub(r"\\([\\*])", r"\1", should)
-        if isinstance(should, JoltWildcard):
-            if isinstance(is_, Structure):
-                return is_.match_jolt_wildcard(should)
-            return type(is_) in should.types
-        if isinstance(is_, Structure):
-            return is_ == should
-        if type(should) is not type(is_):
-            return False
-        if isinstance(should, (list, tuple)):
-            if len(should) != len(is_):
-                return False
-            return all(cls._field_match(a, b)
-                       for a, b in zip(should, is_))
-        if isinstance(should, dict):
-            return cls._dict_match(should, is_)
-        if isinstance(should, float) and math.isnan(should):
-            return isinstance(is_, float) and math.isnan(is_)
-        return is_ == should
+        return self.accepted_keys.issuperset(is_)
 
 
 class AutoLine(ClientLine):
@@ -391,8 +512,10 @@ class ServerLine(MessageLine):
 
     def __new__(cls, *args, **kwargs):
         obj = super(ServerLine, cls).__new__(cls, *args, **kwargs)
-        obj.command_match = re.match(r"^<(.+?)>(.*)$", obj.content)
-        obj.is_command = bool(obj.command_match)
+        command_match = re.match(r"^<(.+?)>(.*)$", obj.content)
+        obj.command = command_match.groups() if command_match else None
+        obj.is_command = obj.command is not None
+        obj.encoded_messages = {}
         if not obj.is_command:
             obj.parsed = cls._parse_line(obj)
         else:
@@ -406,10 +529,25 @@ class ServerLine(MessageLine):
             self._verify_command(self)
         return self
 
+    def precompile(self, bolt_protocol):
+        """Encode the message into its wire representation ahead of time."""
+        if self.is_command:
+            return
+        try:
+            message = bolt_protocol.translate_server_line(self)
+        except BoltUnknownMessageError:
+            # reported by the script verification
+            return
+        try:
+            encoded = PackStream.encode_message(message)
+        except (OverflowError, ValueError) as e:
+            raise LineError(self, "message cannot be encoded") from e
+        self.encoded_messages[bolt_protocol] = encoded
+
     @staticmethod
     def _verify_command(obj):
-        if obj.command_match:
-            tag, args = obj.command_match.groups()
+        if obj.command:
+            tag, args = obj.command
             args = args.strip()
             if tag == "EXIT":
                 if args:
@@ -449,8 +587,8 @@ class ServerLine(MessageLine):
                              *map(json.dumps, self.parsed[1])))
 
     def try_run_command(self, channel):
-        if self.command_match:
-            tag, args = self.command_match.groups()
+        if self.command:
+            tag, args = self.command
             args = args.strip()
             if tag == "EXIT":
                 raise ServerExit(
@@ -461,9 +599,9 @@ class ServerLine(MessageLine):
             elif tag == "RAW":
                 channel.send_raw(bytearray(int(_, 16) for _ in wrap(args, 2)))
             elif tag == "SLEEP":
-                sleep(float(args))
+                channel.sleep(float(args))
             elif tag == "ASSERT ORDER":
-                sleep(float(args.strip() or 1))
+                channel.sleep(float(args.strip() or 1))
                 channel.assert_no_input()
             else:
                 raise ValueError("Unknown command %r" % (tag,))
@@ -479,10 +617,47 @@ class PythonLine(Line):
         eval_context.exec(self.content.strip())
 
 
+def _union_names(
+    name_sets: Iterable[Optional[FrozenSet[str]]]
+) -> Optional[FrozenSet[str]]:
+    res = set()
+    for names in name_sets:
+        if names is None:
+            return None
+        res.update(names)
+    return frozenset(res)
+
+
+def _may_accept(names: Optional[FrozenSet[str]], name: str) -> bool:
+    return names is None or name in names
+
+
 class Block(abc.ABC):
+    # Names of the client messages the block might consume (`message_names`)
+    # and might consume first after a reset (`first_message_names`).
+    # Both are supersets computed when building the script; `None` means
+    # any message. They allow parent blocks to skip children that cannot
+    # possibly consume the next message without trying to match it.
+    message_names: Optional[FrozenSet[str]] = frozenset()
+    first_message_names: Optional[FrozenSet[str]] = frozenset()
+
     def __init__(self, line_number: int):
         self.line_number = line_number
 
+    def __deepcopy__(self, memodict=None):
+        # Copy the state of playing the script (indices, selections, counters,
+        # ...) and all nested blocks. Lines and lists of lines are never
+        # modified, so they are shared.
+        clone = object.__new__(self.__class__)
+        for key, value in self.__dict__.items():
+            if isinstance(value, Block):
+                value = value.__deepcopy__(memodict)
+            elif (isinstance(value, list) and value
+                  and isinstance(value[0], Block)):
+                value = [block.__deepcopy__(memodict) for block in value]
+            clone.__dict__[key] = value
+        return clone
+
     @abc.abstractmethod
     def accepted_messages(self, channel) -> List[ClientLine]:
         pass
@@ -548,12 +723,20 @@ class Block(abc.ABC):
     def parse_jolt(self, simple_jolt):
         pass
 
+    @abc.abstractmethod
+    def precompile(self, bolt_protocol):
+        pass
+
 
 class ClientBlock(Block):
     def __init__(self, lines: List[ClientLine], line_number: int):
         super().__init__(line_number)
         self.lines = lines
         self.index = 0
+        self.message_names = frozenset(line.parsed[0] for line in lines)
+        self.first_message_names = frozenset(
+            line.parsed[0] for line in lines[:1]
+        )
 
     def accepted_messages(self, channel) -> List[ClientLine]:
         return self.lines[self.index:(self.index + 1)]
@@ -612,6 +795,9 @@ class ClientBlock(Block):
         for line in self.lines:
             line.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        pass
+
 
 class AutoBlock(ClientBlock):
     def __init__(self, line: AutoLine, line_number: int):
@@ -694,6 +880,10 @@ class ServerBlock(Block):
         for line in self.lines:
             line.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        for line in self.lines:
+            line.precompile(bolt_protocol)
+
 
 class PythonBlock(ServerBlock):
     def __init__(self, lines: List[PythonLine], line_number: int):
@@ -710,6 +900,9 @@ class PythonBlock(ServerBlock):
     def parse_jolt(self, simple_jolt):
         pass
 
+    def precompile(self, bolt_protocol):
+        pass
+
     def assert_no_init(self):
         if self.lines:
             raise LineError(
@@ -727,6 +920,10 @@ class AlternativeBlock(Block):
         super().__init__(line_number)
         self.block_lists = block_lists
         self.selection = None
+        self.message_names = _union_names(b.message_names
+                                          for b in block_lists)
+        self.first_message_names = _union_names(b.first_message_names
+                                                for b in block_lists)
         self.assert_no_init()
 
     def accepted_messages(self, channel) -> List[ClientLine]:
@@ -751,7 +948,10 @@ class AlternativeBlock(Block):
 
     def can_consume(self, channel) -> bool:
         if self.selection is None:
-            return any(b.can_consume(channel) for b in self.block_lists)
+            # no branch has been entered yet
+            name = channel.peek().name
+            return any(b.can_consume(channel) for b in self.block_lists
+                       if _may_accept(b.first_message_names, name))
         return self.block_lists[self.selection].can_consume(channel)
 
     def can_consume_after_reset(self, channel) -> bool:
@@ -777,8 +977,11 @@ class AlternativeBlock(Block):
     def try_consume(self, channel) -> bool:
         if self.selection is not None:
             return self.block_lists[self.selection].try_consume(channel)
-        for i in range(len(self.block_lists)):
-            if self.block_lists[i].try_consume(channel):
+        name = channel.peek().name
+        for i, block_list in enumerate(self.block_lists):
+            if not _may_accept(block_list.first_message_names, name):
+                continue
+            if block_list.try_consume(channel):
                 self.selection = i
                 return True
         return False
@@ -802,11 +1005,19 @@ class AlternativeBlock(Block):
         for block_list in self.block_lists:
             block_list.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        for block_list in self.block_lists:
+            block_list.precompile(bolt_protocol)
+
 
 class ParallelBlock(Block):
     def __init__(self, block_lists: List["BlockList"], line_number: int):
         super().__init__(line_number)
         self.block_lists = block_lists
+        self.message_names = _union_names(b.message_names
+                                          for b in block_lists)
+        self.first_message_names = _union_names(b.first_message_names
+                                                for b in block_lists)
         self.assert_no_init()
 
     def accepted_messages(self, channel) -> List[ClientLine]:
@@ -828,7 +1039,10 @@ class ParallelBlock(Block):
         return all(b.can_be_skipped(channel) for b in self.block_lists)
 
     def can_consume(self, channel) -> bool:
-        return any(b.can_consume(channel) for b in self.block_lists)
+        # branches might have been entered already
+        name = channel.peek().name
+        return any(b.can_consume(channel) for b in self.block_lists
+                   if _may_accept(b.message_names, name))
 
     def can_consume_after_reset(self, channel) -> bool:
         return any(b.can_consume_after_reset(channel)
@@ -846,7 +1060,10 @@ class ParallelBlock(Block):
             block.reset()
 
     def try_consume(self, channel) -> bool:
+        name = channel.peek().name
         for block in self.block_lists:
+            if not _may_accept(block.message_names, name):
+                continue
             if block.try_consume(channel):
                 return True
         return False
@@ -870,12 +1087,18 @@ class ParallelBlock(Block):
         for block_list in self.block_lists:
             block_list.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        for block_list in self.block_lists:
+            block_list.precompile(bolt_protocol)
+
 
 class OptionalBlock(Block):
     def __init__(self, block_list: "BlockList", line_number: int):
         super().__init__(line_number)
         self.started = False
         self.block_list = block_list
+        self.message_names = block_list.message_names
+        self.first_message_names = block_list.first_message_names
         self.assert_no_init()
 
     def accepted_messages(self, channel) -> List[ClientLine]:
@@ -939,6 +1162,9 @@ class OptionalBlock(Block):
     def parse_jolt(self, simple_jolt):
         self.block_list.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        self.block_list.precompile(bolt_protocol)
+
 
 class _RepeatBlock(Block, abc.ABC):
     def __init__(self, block_list, line_number: int):
@@ -946,6 +1172,8 @@ class _RepeatBlock(Block, abc.ABC):
         self.in_block = False
         self.iteration_count = 0
         self.block_list = block_list
+        self.message_names = block_list.message_names
+        self.first_message_names = block_list.first_message_names
         self.assert_no_init()
 
     def accepted_messages(self, channel) -> List[ClientLine]:
@@ -1049,6 +1277,9 @@ class _RepeatBlock(Block, abc.ABC):
     def parse_jolt(self, simple_jolt):
         self.block_list.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        self.block_list.precompile(bolt_protocol)
+
 
 class Repeat0Block(_RepeatBlock):
     def can_be_skipped(self, channel):
@@ -1072,6 +1303,10 @@ class ConditionalBlock(Block):
         self.conditions = conditions
         self.blocks = blocks
         self.selection = None
+        # Trying to consume selects a branch even if it does not consume the
+        # message, so parent blocks must never skip this block.
+        self.message_names = None
+        self.first_message_names = None
 
     def _get_selected_block(
         self, channel, selection, probing
@@ -1177,6 +1412,10 @@ class ConditionalBlock(Block):
         for block in self.blocks:
             block.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        for block in self.blocks:
+            block.precompile(bolt_protocol)
+
 
 class BlockList(Block):
     def __init__(self, blocks: List[Block], line_number: int):
@@ -1186,6 +1425,20 @@ class BlockList(Block):
         for prev_block, next_block in zip(self.blocks, self.blocks[1:]):
             if not prev_block.has_deterministic_end():
                 next_block.assert_no_init()
+        self.message_names = _union_names(b.message_names for b in blocks)
+        first_names = []
+        for block in blocks:
+            first_names.append(block.first_message_names)
+            if isinstance(block, ClientBlock) and block.lines:
+                break
+        self.first_message_names = _union_names(first_names)
+
+    def _may_accept(self, i, name):
+        # Blocks after the current one have not been entered since the last
+        # reset.
+        if i == self.index:
+            return _may_accept(self.blocks[i].message_names, name)
+        return _may_accept(self.blocks[i].first_message_names, name)
 
     def accepted_messages(self, channel) -> List[ClientLine]:
         res = []
@@ -1217,14 +1470,19 @@ class BlockList(Block):
                    for b in self.blocks[self.index:len(self.blocks)])
 
     def can_consume(self, channel) -> bool:
+        name = channel.peek().name
         for i in range(self.index, len(self.blocks)):
-            if self.blocks[i].can_consume(channel):
+            if (self._may_accept(i, name)
+                    and self.blocks[i].can_consume(channel)):
                 return True
             if not self.blocks[i].can_be_skipped(channel):
                 break
         return False
 
     def can_consume_after_reset(self, channel) -> bool:
+        name = channel.peek().name
+        if not _may_accept(self.first_message_names, name):
+            return False
         for i in range(len(self.blocks)):
             if self.blocks[i].can_consume_after_reset(channel):
                 return True
@@ -1254,9 +1512,10 @@ class BlockList(Block):
         self.index = 0
 
     def try_consume(self, channel) -> bool:
+        name = channel.peek().name
         for i in range(self.index, len(self.blocks)):
             block = self.blocks[i]
-            if block.try_consume(channel):
+            if self._may_accept(i, name) and block.try_consume(channel):
                 self.index = i
                 while block.has_deterministic_end() and block.done(channel):
                     self.index += 1
@@ -1289,6 +1548,10 @@ class BlockList(Block):
         for block in self.blocks:
             block.parse_jolt(simple_jolt)
 
+    def precompile(self, bolt_protocol):
+        for block in self.blocks:
+            block.precompile(bolt_protocol)
+
 
 class ScriptFailure(RuntimeError):
     pass
@@ -1330,6 +1593,10 @@ class ScriptContext:
             "python": [],
         }
 
+    def __deepcopy__(self, memodict=None):
+        # read-only once the script has been parsed
+        return self
+
     def create_eval_context(self) -> EvalContext:
         context = EvalContext()
         for cmd in self.python:
@@ -1348,6 +1615,7 @@ class Script:
         self._set_bolt_protocol()
         self._post_process()
         self._verify_script()
+        self._precompile()
         self._lock = CopyableRLock()
 
     def _set_bolt_protocol(self):
@@ -1371,6 +1639,9 @@ class Script:
         except BoltUnknownMessageError as e:
             raise LineError(e.line, e.msg) from e
 
+    def _precompile(self):
+        self.block_list.precompile(self._bolt_protocol)
+
     def _consume_bang_lines(self, bang_lines):
         for bl in bang_lines:
             bl.update_context(self.context)
@@ -1453,20 +1724,11 @@ class ScriptTransformer(lark.Transformer):
 
     @lark.v_args(meta=True)
     def block_list(self, meta, children):
-        blocks = []
-        for child in children:
-            if isinstance(child, lark.Token):
-                continue
-            if (blocks
-                    and ((child.__class__ == ClientBlock
-                          and blocks[-1].__class__ == ClientBlock)
-                         or (child.__class__ == ServerBlock
-                             and blocks[-1].__class__ == ServerBlock))):
-                blocks[-1].lines.extend(child.lines)
-            else:
-                blocks.append(child)
-
-        return BlockList(blocks, meta.line)
+        return _build_block_list(
+            [child for child in children
+             if not isinstance(child, lark.Token)],
+            meta.line
+        )
 
     @lark.v_args(meta=True)
     def client_block(self, meta, children):
@@ -1573,17 +1835,242 @@ class ScriptTransformer(lark.Transformer):
         return ConditionalBlock(conditions, blocks, meta.line)
 
 
-def parse(script: str, substitutions: Optional[dict] = None) -> Script:
+def _build_block_list(blocks: List[Block], line_number: int) -> "BlockList":
+    merged = []
+    for block in blocks:
+        if (merged
+                and ((block.__class__ == ClientBlock
+                      and merged[-1].__class__ == ClientBlock)
+                     or (block.__class__ == ServerBlock
+                         and merged[-1].__class__ == ServerBlock))):
+            # build a new block for the merged lines to have its message
+            # names computed for all of them
+            merged[-1] = block.__class__(merged[-1].lines + block.lines,
+                                         merged[-1].line_number)
+        else:
+            merged.append(block)
+    return BlockList(merged, line_number)
+
+
+class _NotParsed(Exception):
+    pass
+
+
+class ScriptParser:
+    """Line based parser for the script syntax defined in `grammar.lark`.
+
+    Apart from comments and empty lines, each line of a script is either a
+    block delimiter or a line of a block. This parser walks the lines with
+    a single line of look-ahead and builds the same `Script` as the
+    `ScriptTransformer` does from lark's parse tree, at a fraction of the
+    cost of lark's Earley parser.
+
+    Scripts with syntax errors or ambiguities (e.g., `ELSE:` following
+    nested conditionals without braces) are left to lark, which reports
+    the error or resolves the ambiguity.
+    """
+
+    _WS = " \t\f\r"
+    _LINE_MARKERS = ("!:", "C:", "A:", "?:", "*:", "+:", "S:", "PY:", "IF:",
+                     "ELIF:")
+    _DELIMITERS = frozenset((
+        "{{", "}}", "----", "++++", "{?", "?}", "{*", "*}", "{+", "+}",
+    ))
+    # what the grammar's LINE terminal must not start with
+    _NOT_LINE_RE = re.compile(
+        r"\s*(!:|S:|C:|A:|\?:|\*:|\+:|#|{{|----|\+\+\+\+|}}|{[?*+]|[?*+]\})"
+    )
+    _BLOCK_STARTS = frozenset((
+        "C:", "A:", "?:", "*:", "+:", "S:", "PY:", "IF:",
+        "{{", "{?", "{*", "{+",
+    ))
+    _BLOCK_ENDS = {"{?": "?}", "{*": "*}", "{+": "+}"}
+    _WRAPPERS = {
+        "?:": OptionalBlock, "*:": Repeat0Block, "+:": Repeat1Block,
+        "{?": OptionalBlock, "{*": Repeat0Block, "{+": Repeat1Block,
+        "----": AlternativeBlock, "++++": ParallelBlock,
+    }
+
+    def __init__(self, script: str):
+        self._script = script
+        self._tokens = []
+        self._pos = 0
+
+    def parse(self) -> Script:
+        try:
+            self._tokens = self._tokenize(self._script)
+            self._pos = 0
+            tree = self._parse_script()
+        except _NotParsed:
+            return ScriptTransformer().transform(
+                get_parser().parse(self._script)
+            )
+        return self._build(tree)
+
+    @classmethod
+    def _tokenize(cls, script):
+        # (kind, line number, raw line, content)
+        tokens = []
+        for line_number, text in enumerate(script.split("\n"), start=1):
+            stripped = text.lstrip(cls._WS)
+            if not stripped or stripped[0] == "#":
+                # empty line or comment
+                continue
+            for marker in cls._LINE_MARKERS:
+                if stripped.startswith(marker):
+                    rest = stripped[len(marker):]
+                    if not rest.strip() or cls._NOT_LINE_RE.match(rest):
+                        raise _NotParsed
+                    tokens.append((marker, line_number, marker + rest,
+                                   rest.strip()))
+                    break
+            else:
+                kind = stripped.rstrip(cls._WS)
+                if kind == "ELSE:" or kind in cls._DELIMITERS:
+                    tokens.append((kind, line_number, None, None))
+                elif (kind.startswith("ELSE:") or not text.strip()
+                      or cls._NOT_LINE_RE.match(text)):
+                    raise _NotParsed
+                else:
+                    tokens.append(("LINE", line_number, text, text.strip()))
+        return tokens
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos][0]
+        return None
+
+    def _next(self):
+        token = self._tokens[self._pos]
+        self._pos += 1
+        return token
+
+    # The parsing methods only build a tree of tuples
+    # `(kind, line number, *children)`. The lines and blocks are created
+    # afterwards in the same order as the `ScriptTransformer` creates them,
+    # so that they raise the same errors as they would after lark parsed the
+    # script.
+
+    def _parse_script(self):
+        bang_lines = []
+        while self._peek() == "!:":
+            bang_lines.append(self._next())
+        block_list = self._parse_block_list()
+        if self._peek() is not None:
+            raise _NotParsed
+        return "start", None, bang_lines, block_list
+
+    def _parse_block_list(self):
+        if self._peek() not in self._BLOCK_STARTS:
+            raise _NotParsed
+        line_number = self._tokens[self._pos][1]
+        blocks = [self._parse_block()]
+        while self._peek() in self._BLOCK_STARTS:
+            blocks.append(self._parse_block())
+        return "block_list", line_number, blocks
+
+    def _parse_block(self):
+        kind = self._peek()
+        if kind not in self._BLOCK_STARTS:
+            raise _NotParsed
+        token = self._next()
+        if kind in ("C:", "S:"):
+            lines = [token]
+            while self._peek() == "LINE":
+                lines.append(self._next())
+            return kind, token[1], lines
+        if kind in ("A:", "?:", "*:", "+:", "PY:"):
+            return kind, token[1], token
+        if kind in self._BLOCK_ENDS:
+            block_list = self._parse_block_list()
+            if self._peek() != self._BLOCK_ENDS[kind]:
+                raise _NotParsed
+            self._next()
+            return kind, token[1], block_list
+        if kind == "{{":
+            return self._parse_braces(token)
+        return self._parse_conditional(token)
+
+    def _parse_braces(self, start):
+        block_lists = [self._parse_block_list()]
+        separator = None
+        while self._peek() != "}}":
+            kind = self._peek()
+            if kind not in ("----", "++++") or separator not in (None, kind):
+                raise _NotParsed
+            separator = self._next()[0]
+            block_lists.append(self._parse_block_list())
+        self._next()
+        if separator is None:
+            return block_lists[0]
+        return separator, start[1], block_lists
+
+    def _parse_conditional(self, if_line):
+        conditions = [if_line]
+        blocks = [self._parse_block()]
+        while self._peek() == "ELIF:":
+            conditions.append(self._next())
+            blocks.append(self._parse_block())
+        if self._peek() == "ELSE:":
+            self._next()
+            blocks.append(self._parse_block())
+        if any(block[0] == "IF:" for block in blocks):
+            # nested conditionals without braces are ambiguous
+            raise _NotParsed
+        return "IF:", if_line[1], conditions, blocks
+
+    def _build(self, node):
+        kind, line_number, *children = node
+        if kind == "start":
+            bang_lines, block_list = children
+            bang_lines = [BangLine(*token[1:]) for token in bang_lines]
+            return Script(bang_lines, self._build(block_list))
+        if kind == "block_list":
+            return _build_block_list(list(map(self._build, children[0])),
+                                     line_number)
+        if kind == "C:":
+            return ClientBlock([ClientLine(*t[1:]) for t in children[0]],
+                               line_number)
+        if kind == "S:":
+            return ServerBlock([ServerLine(*t[1:]) for t in children[0]],
+                               line_number)
+        if kind == "PY:":
+            return PythonBlock([PythonLine(*children[0][1:])], line_number)
+        if kind == "A:":
+            return AutoBlock(AutoLine(*children[0][1:]), line_number)
+        if kind in ("?:", "*:", "+:"):
+            block = AutoBlock(AutoLine(*children[0][1:]), line_number)
+            return self._WRAPPERS[kind](BlockList([block], line_number),
+                                        line_number)
+        if kind in self._BLOCK_ENDS:
+            return self._WRAPPERS[kind](self._build(children[0]),
+                                        line_number)
+        if kind in ("----", "++++"):
+            return self._WRAPPERS[kind](list(map(self._build, children[0])),
+                                        line_number)
+        if kind == "IF:":
+            conditions, blocks = children
+            return ConditionalBlock([token[3] for token in conditions],
+                                    list(map(self._build, blocks)),
+                                    line_number)
+        raise ValueError("Unknown node %r" % (kind,))
+
+
+def parse(script: str, substitutions: Optional[dict] = None,
+          cache: Optional[ScriptCache] = None) -> Script:
+    if cache is not None:
+        return cache.load(script, substitutions,
+                          lambda: parse(script, substitutions))
     if substitutions:
         for match, replacement in substitutions.items():
             script = script.replace(match, replacement)
-    return ScriptTransformer().transform(parser.parse(script))
+    return ScriptParser(script).parse()
 
 
-def parse_file(filename):
+def parse_file(filename, cache: Optional[ScriptCache] = None):
     with open(filename, encoding="utf-8") as fd:
         try:
-            script = parse(fd.read())
+            script = parse(fd.read(), cache=cache)
         except Exception:
             print("Error while parsing %s" % filename, file=sys.stderr)
             raise
@@ -0,0 +1,129 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Micro-benchmark for unpacking PackStream messages.
+
+Not collected by pytest. Run with
+    python -m boltstub.tests.benchmark_packstream [--before REV] [ROUNDS]
+
+With `--before`, the unpacker of `boltstub/packstream.py` as of the git
+revision REV (e.g., the one before a change to the unpacker) is timed on
+the same messages, too.
+"""
+
+
+import argparse
+import os
+import subprocess
+import types
+from io import BytesIO
+from time import perf_counter
+
+from ..packstream import (
+    Packer,
+    Structure,
+    UnpackableBuffer,
+    Unpacker,
+)
+
+
+def _node(id_, element_id):
+    return Structure(b"\x4E", id_, ["Person", "Employee"],
+                     {"name": "Alice %i" % id_, "age": 42, "score": 1.5},
+                     element_id, packstream_version=2)
+
+
+MESSAGES = (
+    # RUN with a parameter map
+    Structure(b"\x10", "UNWIND $xs AS x RETURN x, $m",
+              {"xs": list(range(20)), "m": {"a": "b", "c": [1, 2, 3]}},
+              {"db": "neo4j", "bookmarks": ["bm:1", "bm:2"]},
+              packstream_version=2, verified=False),
+    # RECORDs with maps of strings, nested lists, and node structs
+    *(
+        Structure(b"\x71", [
+            {"key%i" % j: "value %i" % j for j in range(8)},
+            [[1, 2, [3, 4]], ["a", "b"], [None, True, False]],
+            _node(i, "4:db:%i" % i),
+            -(2 ** 40) + i,
+            "x" * 300,
+        ], packstream_version=2, verified=False)
+        for i in range(8)
+    ),
+    # summary
+    Structure(b"\x70", {"has_more": False, "type": "r", "t_last": 3,
+                        "db": "neo4j", "bookmark": "bm:3"},
+              packstream_version=2, verified=False),
+)
+
+
+def _pack(message):
+    stream = BytesIO()
+    Packer(stream).pack(message)
+    return stream.getvalue()
+
+
+def _load_packstream(revision):
+    """Load `boltstub/packstream.py` as of the git `revision`."""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)
+    )))
+    path = "%s:boltstub/packstream.py" % revision
+    source = subprocess.check_output(["git", "show", path], cwd=root)
+    module = types.ModuleType("boltstub._packstream_before")
+    # resolve the module's relative imports within boltstub
+    module.__package__ = "boltstub"
+    exec(compile(source, path, "exec"), module.__dict__)
+    return module
+
+
+def _time(unpacker_cls, buffer_cls, encoded, rounds):
+    # Warm up
+    for data in encoded:
+        unpacker_cls(buffer_cls(data), 2).unpack_message()
+    count = 0
+    start = perf_counter()
+    for _ in range(rounds):
+        for data in encoded:
+            unpacker_cls(buffer_cls(data), 2).unpack_message()
+            count += 1
+    return count, perf_counter() - start
+
+
+def run(rounds=2000, before=None):
+    encoded = [_pack(m) for m in MESSAGES]
+    candidates = []
+    if before is not None:
+        module = _load_packstream(before)
+        candidates.append(("before (%s)" % before, module.Unpacker,
+                           module.UnpackableBuffer))
+    candidates.append(("current", Unpacker, UnpackableBuffer))
+    for label, unpacker_cls, buffer_cls in candidates:
+        count, duration = _time(unpacker_cls, buffer_cls, encoded, rounds)
+        print("%s: unpacked %i messages in %.3f s: %.0f messages/s"
+              % (label, count, duration, count / duration))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rounds", nargs="?", type=int, default=2000)
+    parser.add_argument("--before", metavar="REV",
+                        help="git revision to compare the unpacker with")
+    args = parser.parse_args()
+    run(args.rounds, args.before)
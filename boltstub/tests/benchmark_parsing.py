@@ -0,0 +1,203 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Benchmark of the line based script parser against lark's Earley parser.
+
+Parses all stub scripts of the test suite with both parsers, asserts that
+they produce equal scripts, and compares the time spent. Template variables
+(e.g. `#VERSION#`) are replaced with values like the tests use first. The
+scripts are compared before they are checked against their Bolt version (see
+`UnverifiedScript`), and any script failing to parse fails the benchmark.
+
+Not collected by pytest. Run with
+    python -m boltstub.tests.benchmark_parsing [ROUNDS]
+"""
+
+
+import re
+import sys
+import warnings
+from glob import glob
+from os import path
+from time import perf_counter
+
+from .. import parsing
+
+SCRIPTS_ROOT = path.join(path.dirname(__file__), "..", "..", "tests", "stub")
+SCRIPTS_GLOB = path.join(SCRIPTS_ROOT, "**", "scripts", "**", "*.script")
+# values like the tests fill in for the template variables of the scripts
+SUBSTITUTIONS = {
+    "#VERSION#": "4.4",
+    "#BOLT_VERSION#": "4.4",
+    "#BOLT_PROTOCOL#": "4.4",
+    "#DELAY#": "0.5",
+    "#HOST#": "localhost",
+    "#ROUTINGCTX#": '{"address": "localhost:9000"}',
+    "#HELLO_ROUTINGCTX#": '{"address": "localhost:9000"}',
+    "#SERVER_AGENT#": "Neo4j/4.4.0",
+    "#USER_AGENT#": "007",
+    "#ROUTING#": ', "routing": null',
+    "#EXTR_HELLO_ROUTING_PROPS#": ', "routing": {"address": "localhost:9000"}',
+    "#EXTR_HELLO_ROUTING_PROPS_EMPTY_CTX#": ', "routing": {}',
+    "#EXTRA_HELLO_PARAMS#": ', "patch_bolt": ["utc"]',
+    "#VERIFY_AUTH#": '"principal": "neo4j", "credentials": "pass"',
+    "#DRIVER_AUTH#": '"principal": "neo4j", "credentials": "pass"',
+    "#NOTIS#": '"notifications_minimum_severity": "WARNING", ',
+    "#NOTIFICATIONS#": '[{"severity": "WARNING"}]',
+    "#EMIT#": '[{"severity": "WARNING"}]',
+    "#STATUSES#": '[{"gql_status": "00000"}]',
+    "#PLAN#": '{"operatorType": "Produce"}',
+    "#PROFILE#": '{"operatorType": "Produce", "rows": 1}',
+    "#RESULT#": '{"Z": "1"}',
+    "#BM_IN#": '"bookmarks": ["bm1"]',
+    "#BM_OUT#": "bm2",
+    "#BOOKMARKS#": '["bm1"]',
+    "#ROUTINGMODE#": '"mode": "r",',
+    "#MODE#": "r",
+    "#TYPE#": "r",
+    "#DB#": "adb",
+    # error code in some scripts, the whole FAILURE in others
+    '"#ERROR#"': '"Neo.ClientError.Test.Error"',
+    "#ERROR#": '{"code": "Neo.ClientError.Test.Error", "message": "error"}',
+    "#FAILURE#": '{"code": "Neo.ClientError.Test.Error", "message": "error"}',
+    "#SERVER_TELEMETRY_ENABLED#": "True",
+    "#RESET_ON_POOL_RETURN#": "True",
+    "#EXTRA_RESET#": "C: RESET\nS: SUCCESS {}",
+    "#EXTRA_RESET_1#": "C: RESET\nS: SUCCESS {}",
+    "#EXTRA_RESET_2#": "C: RESET\nS: SUCCESS {}",
+}
+# scripts using a variable differently, by path below tests/stub
+SCRIPT_SUBSTITUTIONS = {
+    "routing/scripts/v4x1/router_with_bookmarks.script": {
+        "#BOOKMARKS#": ', "bookmarks{}": ["bm1"]',
+    },
+}
+_VARIABLE_RE = re.compile(r"#[A-Z][A-Z0-9_]*#")
+
+
+def load_scripts():
+    scripts = []
+    for file_name in sorted(set(glob(SCRIPTS_GLOB, recursive=True))):
+        with open(file_name, encoding="utf-8") as fd:
+            script = fd.read()
+        if not any(line.strip() and not line.lstrip().startswith("#")
+                   for line in script.splitlines()):
+            # placeholder, e.g., for a Bolt version without the feature
+            continue
+        key = path.relpath(file_name, SCRIPTS_ROOT).replace(path.sep, "/")
+        substitutions = dict(SUBSTITUTIONS,
+                             **SCRIPT_SUBSTITUTIONS.get(key, {}))
+        for match, replacement in substitutions.items():
+            script = script.replace(match, replacement)
+        unknown = _VARIABLE_RE.findall(script)
+        if unknown:
+            raise ValueError("No value for %s in %s" % (unknown, file_name))
+        scripts.append((file_name, script))
+    return scripts
+
+
+class UnverifiedScript:
+    """Stand-in for `parsing.Script` keeping what the parsers built.
+
+    `parsing.Script` checks the messages against the script's Bolt version,
+    which the placeholder values don't match for all scripts.
+    """
+
+    def __init__(self, bang_lines, block_list, filename=None):
+        self.bang_lines = bang_lines
+        self.block_list = block_list
+
+
+def dump(obj):
+    """Turn a script into nested tuples for comparing scripts."""
+    if isinstance(obj, parsing.Line):
+        return (obj.__class__.__name__, obj.line_number,
+                str.__str__(obj), obj.content)
+    if isinstance(obj, (list, tuple)):
+        return tuple(map(dump, obj))
+    if isinstance(obj, dict):
+        return tuple((k, dump(v)) for k, v in sorted(obj.items()))
+    if isinstance(obj, (parsing.Block, parsing.ScriptContext)):
+        return (obj.__class__.__name__, dump(vars(obj)))
+    if isinstance(obj, UnverifiedScript):
+        return ("Script", dump(obj.bang_lines), dump(obj.block_list))
+    return obj
+
+
+def parse_all(parse, scripts):
+    results = []
+    start = perf_counter()
+    for _, script in scripts:
+        try:
+            results.append(parse(script))
+        except Exception as e:
+            results.append(e)
+    return results, perf_counter() - start
+
+
+def lark_parse(script):
+    return parsing.ScriptTransformer().transform(
+        parsing.get_parser().parse(script)
+    )
+
+
+def line_parse(script):
+    return parsing.ScriptParser(script).parse()
+
+
+def run(rounds=3):
+    scripts = load_scripts()
+    start = perf_counter()
+    parsing.get_parser()
+    print("built lark parser in %.3f s" % (perf_counter() - start))
+
+    warnings.simplefilter("ignore")
+    script_class, parsing.Script = parsing.Script, UnverifiedScript
+    try:
+        compare(scripts, rounds)
+    finally:
+        parsing.Script = script_class
+
+
+def compare(scripts, rounds):
+    lark_results, _ = parse_all(lark_parse, scripts)
+    line_results, _ = parse_all(line_parse, scripts)
+    failures = []
+    for (file_name, _), lark_result, line_result in zip(
+        scripts, lark_results, line_results
+    ):
+        for result in (lark_result, line_result):
+            if isinstance(result, Exception):
+                failures.append("%s: %s: %s" % (file_name,
+                                                type(result).__name__, result))
+                break
+        else:
+            assert dump(lark_result) == dump(line_result), file_name
+    if failures:
+        raise AssertionError("Scripts not compared:\n" + "\n".join(failures))
+    print("%i scripts parsed equally" % len(scripts))
+
+    for name, parse in (("lark", lark_parse), ("line parser", line_parse)):
+        duration = min(parse_all(parse, scripts)[1] for _ in range(rounds))
+        print("%s: %.3f s, %.3f ms per script"
+              % (name, duration, duration / len(scripts) * 1000))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
@@ -0,0 +1,125 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Benchmark for the per-connection cost of a large stub script.
+
+Measures copying the parsed script (done for every accepted connection) and
+the latency of accepting connections (connect until handshake response).
+
+Not collected by pytest. Run with
+    python -m boltstub.tests.benchmark_script_copy [ROUNDS]
+"""
+
+
+import socket
+import sys
+import threading
+from copy import deepcopy
+from io import BytesIO
+from time import perf_counter
+
+from .. import BoltStubService
+from ..packstream import (
+    PackStream,
+    Structure,
+)
+from ..parsing import parse
+
+
+def make_script(lines=500):
+    parts = ["!: BOLT 5.0", "!: ALLOW CONCURRENT", "",
+             'C: HELLO {"user_agent": "*", "[routing]": {"address": "*"}}',
+             'S: SUCCESS {"server": "Neo4j/5.0.0", "connection_id": "bolt-1"}']
+    i = 0
+    while len(parts) < lines:
+        parts += [
+            "{?",
+            "    {{",
+            '        C: ROUTE {"address": "*"} [] {"db": "db%i"}' % i,
+            '        S: SUCCESS {"rt": {"ttl": 1000, "db": "db%i", '
+            '"servers": [{"addresses": ["r:9000"], "role": "ROUTE"}, '
+            '{"addresses": ["w:9010"], "role": "WRITE"}]}}' % i,
+            "    ----",
+            '        C: RUN "RETURN %i AS n" {"x": {"Z": "*"}} {"db": "db%i"}'
+            % (i, i),
+            '        S: SUCCESS {"fields": ["n"]}',
+            '        C: PULL {"n": 1000}',
+            "        S: RECORD [%i]" % i,
+            '           SUCCESS {"type": "r"}',
+            "    }}",
+            "?}",
+        ]
+        i += 1
+    parts.append("C: GOODBYE")
+    return "\n".join(parts) + "\n"
+
+
+def _encode(*messages):
+    stream = BytesIO()
+    for message in messages:
+        stream.write(PackStream.encode_message(message))
+    return stream.getvalue()
+
+
+def _accept_latency(rounds):
+    service = BoltStubService(parse(make_script()), "localhost:17686")
+    thread = threading.Thread(target=service.start, daemon=True)
+    thread.start()
+    handshake = b"\x60\x60\xb0\x17\x00\x00\x00\x05" + b"\x00" * 12
+    # HELLO, then GOODBYE to finish the script right away
+    messages = _encode(
+        Structure(b"\x01", {"user_agent": "benchmark",
+                            "routing": {"address": "localhost:7687"}},
+                  packstream_version=2, verified=False),
+        Structure(b"\x02", packstream_version=2, verified=False),
+    )
+    start = perf_counter()
+    for _ in range(rounds):
+        with socket.create_connection(("localhost", 17686)) as con:
+            con.sendall(handshake)
+            assert con.recv(4) == b"\x00\x00\x00\x05"
+            con.sendall(messages)
+            # wait for the server to hang up
+            while con.recv(65536):
+                pass
+    duration = perf_counter() - start
+    service.close_all_connections()
+    thread.join()
+    assert not service.exceptions
+    return duration
+
+
+def run(rounds=200):
+    source = make_script()
+    script = parse(source)
+    print("script with %i lines" % len(source.splitlines()))
+    deepcopy(script)
+    start = perf_counter()
+    for _ in range(rounds):
+        deepcopy(script)
+    duration = perf_counter() - start
+    print("copied script %i times in %.3f s: %.3f ms per copy"
+          % (rounds, duration, duration / rounds * 1000))
+    duration = _accept_latency(rounds)
+    print("accepted %i connections in %.3f s: %.3f ms per connection"
+          % (rounds, duration, duration / rounds * 1000))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
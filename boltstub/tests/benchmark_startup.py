@@ -0,0 +1,136 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Benchmark for the startup time of the stub server process.
+
+Measures the import time of `boltstub.__main__` (with `-X importtime`),
+and, for fresh `python -m boltstub` processes, the time until `Listening`
+is printed and until the server answers the handshake.
+
+Not collected by pytest. Run with
+    python -m boltstub.tests.benchmark_startup [ROUNDS]
+"""
+
+
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from os import path
+from statistics import median
+from time import perf_counter
+
+ROOT = path.join(path.dirname(__file__), "..", "..")
+PORT = 17685
+SCRIPT = """\
+!: BOLT 4.4
+
+C: HELLO {"user_agent": "*", "[routing]": {"address": "*"}}
+S: SUCCESS {"server": "Neo4j/4.4.0", "connection_id": "bolt-1"}
+C: RUN "RETURN 1 AS n" {} {}
+S: SUCCESS {"fields": ["n"]}
+C: PULL {"n": 1000}
+S: RECORD [1]
+   SUCCESS {"type": "r"}
+C: GOODBYE
+"""
+_IMPORT_TIME_RE = re.compile(r"import time:\s*(\d+) \|\s*(\d+) \| (\s*)(\S+)")
+
+
+def _env():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def import_times(rounds):
+    """Median self and cumulative import time per module in ms."""
+    times = defaultdict(list)
+    for _ in range(rounds + 1):  # the first round (re)writes bytecode
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c",
+             "import boltstub.__main__"],
+            env=_env(), stderr=subprocess.PIPE, universal_newlines=True,
+            check=True
+        )
+        for line in process.stderr.splitlines():
+            match = _IMPORT_TIME_RE.match(line)
+            if match:
+                self_us, cumulative_us, _, module = match.groups()
+                times[module].append((int(self_us) / 1000,
+                                      int(cumulative_us) / 1000))
+    return {module: (median(t[0] for t in ts[1:]),
+                     median(t[1] for t in ts[1:]))
+            for module, ts in times.items() if len(ts) > 1}
+
+
+def time_to_listening(script_path, *args):
+    handshake = b"\x60\x60\xb0\x17\x00\x00\x04\x04" + b"\x00" * 12
+    start = perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "boltstub", "-l", ":%i" % PORT, *args,
+         script_path],
+        env=_env(), cwd=ROOT, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, universal_newlines=True
+    )
+    try:
+        for line in process.stdout:
+            if line.startswith("Listening on "):
+                break
+        listening = perf_counter() - start
+        with socket.create_connection(("localhost", PORT)) as con:
+            con.sendall(handshake)
+            assert con.recv(4) == b"\x00\x00\x04\x04"
+        serving = perf_counter() - start
+    finally:
+        process.kill()
+        process.communicate()
+    return listening, serving
+
+
+def run(rounds=10):
+    times = import_times(rounds)
+    print("import boltstub.__main__: %.1f ms"
+          % times["boltstub.__main__"][1])
+    print("slowest modules (self time):")
+    for module, (self_ms, _) in sorted(times.items(),
+                                       key=lambda item: -item[1][0])[:10]:
+        print("    %6.1f ms  %s" % (self_ms, module))
+
+    with tempfile.TemporaryDirectory() as directory:
+        script_path = path.join(directory, "startup.script")
+        with open(script_path, "w") as fd:
+            fd.write(SCRIPT)
+        for name, args in (("cached", ("--cache-dir", directory)),
+                           ("not cached", ("--no-cache",)),
+                           ("asyncio, cached",
+                            ("--asyncio", "--cache-dir", directory))):
+            time_to_listening(script_path, *args)
+            results = [time_to_listening(script_path, *args)
+                       for _ in range(rounds)]
+            print("%s: Listening after %.1f ms, handshake after %.1f ms"
+                  % (name, median(r[0] for r in results) * 1000,
+                     median(r[1] for r in results) * 1000))
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:2]))
@@ -0,0 +1,112 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Throughput benchmark for receiving masked websocket frames.
+
+Compares :class:`..wiring.WebSocket` to the previous implementation, which
+unmasked the payload byte by byte.
+
+Not collected by pytest. Run with
+    python -m boltstub.tests.benchmark_websocket [ROUNDS] [FRAME_SIZE]
+"""
+
+
+import os
+import struct
+import sys
+from time import perf_counter
+
+from ..wiring import WebSocket
+
+
+class _FakeSocket:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def recv(self, bufsize):
+        data = self.data[self.pos:(self.pos + bufsize)]
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, buffer, nbytes=0):
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _legacy_recv(socket_):
+    # the implementation this benchmark is measured against
+    frame = socket_.recv(2)
+    payload_len = frame[1] & 0b0111_1111
+    if payload_len == 126:
+        payload_len, = struct.unpack(">H", socket_.recv(2))
+    elif payload_len == 127:
+        payload_len, = struct.unpack(">Q", socket_.recv(8))
+    mask = socket_.recv(4)
+    masked_payload = socket_.recv(payload_len)
+    return bytearray([masked_payload[i] ^ mask[i % 4]
+                      for i in range(payload_len)])
+
+
+def _frame(payload):
+    mask = os.urandom(4)
+    size = len(payload)
+    if size < 126:
+        header = bytes((0x82, 0x80 | size))
+    elif size < 0x10000:
+        header = b"\x82\xFE" + struct.pack(">H", size)
+    else:
+        header = b"\x82\xFF" + struct.pack(">Q", size)
+    masked = bytes(payload[i] ^ mask[i % 4] for i in range(size))
+    return header + mask + masked
+
+
+def _measure(name, receive, data, rounds, size):
+    start = perf_counter()
+    for _ in range(rounds):
+        received = receive(_FakeSocket(data))
+        assert len(received) == size
+    duration = perf_counter() - start
+    print("%s: %i frames of %i bytes in %.3f s: %.1f MB/s"
+          % (name, rounds, size, duration, rounds * size / duration / 1e6))
+
+
+def _receive(socket_):
+    websocket = WebSocket(socket_)
+    buffer = bytearray(len(socket_.data))
+    view = memoryview(buffer)
+    used = 0
+    while True:
+        n = websocket.recv_into(view[used:])
+        if not n:
+            break
+        used += n
+    view.release()
+    return buffer[:used]
+
+
+def run(rounds=20, size=256 * 1024):
+    data = _frame(os.urandom(size))
+    _measure("legacy ", _legacy_recv, data, rounds, size)
+    _measure("current", _receive, data, rounds, size)
+
+
+if __name__ == "__main__":
+    run(*map(int, sys.argv[1:3]))
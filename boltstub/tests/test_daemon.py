@@ -0,0 +1,315 @@
+# Copyright (c) "Neo4j,"
+# Neo4j Sweden AB [https://neo4j.com]
+#
+# This file is part of Neo4j.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import socket
+import stat
+import tempfile
+import threading
+
+import pytest
+
+from ..daemon import (
+    ControlServer,
+    KILLED_EXIT_CODE,
+    ServerOutput,
+    StubDaemon,
+    UnixControlServer,
+)
+from .test_integration import (
+    BrokenSocket,
+    Connection,
+    server_version_to_version_request,
+    server_version_to_version_response,
+)
+
+LISTEN_ADDR = "localhost:7687"
+
+
+class ControlClient:
+    def __init__(self, address):
+        if isinstance(address, str):
+            self._socket = socket.socket(socket.AF_UNIX)
+            self._socket.settimeout(5)
+            self._socket.connect(address)
+        else:
+            self._socket = socket.create_connection(address, timeout=5)
+        self._file = self._socket.makefile("rwb")
+
+    def request(self, name, **data):
+        self._file.write(json.dumps({"name": name, "data": data}).encode()
+                         + b"\n")
+        self._file.flush()
+        response = json.loads(self._file.readline())
+        return response["name"], response["data"]
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+@pytest.fixture()
+def socket_path():
+    # not in `tmp_path`, socket paths must be short
+    tmp_dir = tempfile.mkdtemp()
+    yield os.path.join(tmp_dir, "control.sock")
+    os.rmdir(tmp_dir)
+
+
+@pytest.fixture()
+def control_server(socket_path):
+    servers = []
+
+    def start(tcp_token=None):
+        stub_daemon = StubDaemon()
+        if tcp_token is None:
+            server = UnixControlServer(socket_path, stub_daemon)
+        else:
+            server = ControlServer(("localhost", 0), stub_daemon, tcp_token)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+        server.stub_daemon.reset()
+
+
+@pytest.fixture()
+def control(control_server):
+    client = ControlClient(control_server().server_address)
+    try:
+        yield client
+    finally:
+        client.close()
+
+
+def _handshake(con, version=(4, 3)):
+    con.write(b"\x60\x60\xb0\x17")
+    con.write(server_version_to_version_request(version))
+    assert con.read(4) == server_version_to_version_response(version)
+
+
+def test_plays_scripts_one_after_another(control):
+    for _ in range(3):
+        name, status = control.request(
+            "StartServer", script="!: BOLT 4.3\n\nS: SUCCESS\n",
+            listenAddr=LISTEN_ADDR
+        )
+        assert name == "ServerStatus"
+        assert status["exitCode"] is None
+        assert status["stdout"] == ["Listening on 127.0.0.1:7687\n"]
+        con = Connection("localhost", 7687)
+        _handshake(con)
+        assert con.read_message() == b"\xb0\x70"
+        con.close()
+
+        name, status = control.request(
+            "GetServerStatus", serverId=status["serverId"], timeout=2,
+            stdoutFrom=1
+        )
+        assert status["exitCode"] == 0
+        conversation = "".join(status["stdout"])
+        assert "S: <HANDSHAKE> 00 00 03 04" in conversation
+        assert "S: SUCCESS" in conversation
+        assert status["stderr"] == []
+        control.request("ReleaseServer", serverId=status["serverId"])
+
+
+def test_reports_free_port(control):
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nS: SUCCESS\n",
+        listenAddr="localhost:0"
+    )
+    line, = status["stdout"]
+    assert line.startswith("Listening on 127.0.0.1:")
+    con = Connection("localhost", int(line.rpartition(":")[2]))
+    _handshake(con)
+    assert con.read_message() == b"\xb0\x70"
+    con.close()
+    _, status = control.request("GetServerStatus",
+                                serverId=status["serverId"], timeout=2)
+    assert status["exitCode"] == 0
+
+
+def test_reports_events(control):
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nS: SUCCESS\n",
+        listenAddr=LISTEN_ADDR, verbose=False
+    )
+    con = Connection("localhost", 7687)
+    _handshake(con)
+    con.read_message()
+    con.close()
+    server_id = status["serverId"]
+    _, status = control.request("GetServerStatus", serverId=server_id,
+                                timeout=2)
+    assert status["stdout"] == ["Listening on 127.0.0.1:7687\n"]
+    assert [(event["direction"], event["name"], event["line"])
+            for event in status["events"]
+            if event["name"] != "<WAITING>"][3:] == [
+        ("S", "<HANDSHAKE>", None),
+        ("S", "SUCCESS", 3),
+        ("S", "<FINISHED>", None),
+        ("S", "<HANGUP>", None),
+    ]
+    _, status = control.request("GetServerStatus", serverId=server_id,
+                                eventsFrom=len(status["events"]))
+    assert status["events"] == []
+
+
+def test_reports_script_mismatch(control):
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nC: RESET\n",
+        listenAddr=LISTEN_ADDR, filename="mismatch.script"
+    )
+    con = Connection("localhost", 7687)
+    _handshake(con)
+    con.write(b"\x00\x02\xb0\x2f\x00\x00")  # ROLLBACK
+    with pytest.raises(BrokenSocket):
+        con.read(1)
+    _, status = control.request("GetServerStatus",
+                                serverId=status["serverId"], timeout=2)
+    assert status["exitCode"] == 1
+    assert "Script mismatch in 'mismatch.script'" in "".join(status["stdout"])
+
+
+def test_reports_invalid_script(control):
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nX: nope\n",
+        listenAddr=LISTEN_ADDR, filename="invalid.script"
+    )
+    assert status["exitCode"] == 1
+    assert status["stderr"][0] == "Error while parsing invalid.script\n"
+    # the port is free again
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nS: SUCCESS\n",
+        listenAddr=LISTEN_ADDR
+    )
+    assert status["exitCode"] is None
+
+
+def test_interrupt_without_connection(control):
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nC: RUN\n",
+        listenAddr=LISTEN_ADDR
+    )
+    control.request("InterruptServer", serverId=status["serverId"])
+    _, status = control.request("GetServerStatus",
+                                serverId=status["serverId"], timeout=2)
+    # like a stub server process on SIGINT
+    assert status["exitCode"] == 3
+    assert status["stdout"][-1] == "Script never started\n"
+
+
+def test_kill_frees_port(control):
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nC: RUN\n",
+        listenAddr=LISTEN_ADDR
+    )
+    con = Connection("localhost", 7687)
+    _handshake(con)
+    _, status = control.request("KillServer", serverId=status["serverId"])
+    assert status["exitCode"] == KILLED_EXIT_CODE
+    with pytest.raises(BrokenSocket):
+        con.read(1)
+    _, status = control.request(
+        "StartServer", script="!: BOLT 4.3\n\nS: SUCCESS\n",
+        listenAddr=LISTEN_ADDR
+    )
+    assert status["exitCode"] is None
+
+
+def test_unknown_requests_and_servers(control):
+    name, data = control.request("Nope")
+    assert name == "DaemonError"
+    assert "Nope" in data["msg"]
+    name, data = control.request("GetServerStatus", serverId=42)
+    assert name == "DaemonError"
+    assert "42" in data["msg"]
+
+
+def test_control_socket_is_private(control_server, socket_path):
+    control_server()
+    assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+
+def test_control_socket_is_removed(control_server, socket_path):
+    server = control_server()
+    server.shutdown()
+    server.server_close()
+    assert not os.path.exists(socket_path)
+
+
+def test_tcp_needs_token():
+    with pytest.raises(ValueError):
+        ControlServer(("localhost", 0), StubDaemon(), None)
+
+
+@pytest.mark.parametrize("token", (None, "wrong"))
+def test_tcp_rejects_unauthenticated(control_server, token):
+    server = control_server(tcp_token="secret")
+    client = ControlClient(server.server_address[:2])
+    try:
+        if token is not None:
+            name, data = client.request("Authenticate", token=token)
+        else:
+            name, data = client.request("GetServerStatus", serverId=1)
+        assert name == "DaemonError"
+        assert data["msg"] == "Authentication failed"
+        # connection is closed
+        assert client._file.readline() == b""
+    finally:
+        client.close()
+
+
+def test_tcp_accepts_authenticated(control_server):
+    server = control_server(tcp_token="secret")
+    client = ControlClient(server.server_address[:2])
+    try:
+        assert client.request("Authenticate", token="secret") \
+            == ("Authenticated", {})
+        name, data = client.request("Nope")
+        assert name == "DaemonError"
+        assert "Nope" in data["msg"]
+    finally:
+        client.close()
+
+
+def test_server_output_drops_old_lines(monkeypatch):
+    monkeypatch.setattr(ServerOutput, "max_size", 10)
+    output = ServerOutput()
+    output.write("aaaa\nbbbb\n")
+    assert output.lines() == (["aaaa\n", "bbbb\n"], 2)
+    output.write("cccc\n")
+    assert output.lines() == (["<1 line(s) dropped>\n", "bbbb\n", "cccc\n"],
+                              3)
+    assert output.lines(1) == (["bbbb\n", "cccc\n"], 3)
+    assert output.lines(2) == (["cccc\n"], 3)
+    assert output.lines(3) == ([], 3)
+
+
+def test_server_output_caps_partial_line(monkeypatch):
+    monkeypatch.setattr(ServerOutput, "max_size", 30)
+    output = ServerOutput()
+    output.write("x" * 100)
+    output.write("\n")
+    assert output.lines() == (["x" * 30 + "\n"], 1)
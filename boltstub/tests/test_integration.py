@@ -16,6 +16,7 @@
 # limitations under the License.
 
 
+import re
 import socket
 import threading
 import time
@@ -25,7 +26,12 @@ from struct import unpack as struct_unpack
 
 import pytest
 
-from .. import BoltStubService
+from .. import (
+    BoltStubService,
+    listen,
+)
+from ..async_engine import AsyncBoltStubService
+from ..events import EventLog
 from ..parsing import (
     parse,
     ScriptFailure,
@@ -106,11 +112,12 @@ class Connection:
 
 
 class ThreadedServer(threading.Thread):
-    def __init__(self, script, address):
+    def __init__(self, script, address, service_class=BoltStubService,
+                 **kwargs):
         super().__init__(daemon=True)
         if isinstance(script, str):
             script = parse(script)
-        self.service = BoltStubService(script, address, timeout=1)
+        self.service = service_class(script, address, timeout=1, **kwargs)
         self.exc = None
         self._stopped = False
 
@@ -131,15 +138,17 @@ class ThreadedServer(threading.Thread):
         super().join(timeout=timeout)
 
 
-@pytest.fixture()
-def server_factory():
+@pytest.fixture(params=(BoltStubService, AsyncBoltStubService),
+                ids=("threads", "asyncio"))
+def server_factory(request):
     server = None
 
-    def factory(script, address="localhost:7687"):
+    def factory(script, address="localhost:7687", **kwargs):
         nonlocal server
         if server is not None:
             raise RuntimeError("server already running")
-        server = ThreadedServer(script, address)
+        server = ThreadedServer(script, address, service_class=request.param,
+                                **kwargs)
         server.start()
         return server
 
@@ -490,6 +499,163 @@ def test_initial_response(server_version, response_tag, response_name,
     assert not server.service.exceptions
 
 
+@pytest.mark.parametrize("precompiled", (True, False))
+def test_precompiled_responses(precompiled, server_factory,
+                               connection_factory):
+    script = parse("""
+    !: BOLT 5.0
+
+    C: PULL
+    S: RECORD [1, "a", {"b": [1.5, null]}, {"Z": "42"}]
+       RECORD [1, "a", {"b": [1.5, null]}, {"Z": "42"}]
+       SUCCESS {"has_more": false}
+    """)
+
+    server = server_factory(script, precompiled=precompiled)
+    con = connection_factory("localhost", 7687)
+    con.write(b"\x60\x60\xb0\x17")
+    con.write(server_version_to_version_request((5, 0)))
+    con.read(4)
+    con.write(b"\x00\x02\xb0\x3f\x00\x00")
+    for _ in range(2):
+        res = con.read_message()
+        assert res == (b"\xb1\x71\x94\x01\x81a\xa1\x81b\x92\xc1\x3f\xf8"
+                       + b"\x00" * 6 + b"\xc0\x2a")
+    res = con.read_message()
+    assert res == b"\xb1\x70\xa1\x88has_more\xc2"
+    with pytest.raises(BrokenSocket):
+        con.read(1)
+    assert not server.service.exceptions
+
+
+def test_reports_events(server_factory, connection_factory):
+    script = """
+    !: BOLT 4.3
+    !: AUTO RESET
+
+    C: RUN "RETURN 1 AS n" {} {}
+    S: SUCCESS {"fields": ["n"]}
+    C: PULL {"n": -1}
+    S: RECORD [1]
+       SUCCESS {}
+    """
+    events = EventLog()
+    server = server_factory(script, events=events)
+    con = connection_factory("localhost", 7687)
+    con.write(b"\x60\x60\xb0\x17")
+    con.write(server_version_to_version_request((4, 3)))
+    con.read(4)
+    con.write(b"\x00\x02\xb0\x0f\x00\x00")
+    con.read_message()
+    con.write(b"\x00\x12\xb3\x10\x8dRETURN 1 AS n\xa0\xa0\x00\x00")
+    con.write(b"\x00\x06\xb1\x3f\xa1\x81n\xff\x00\x00")
+    for _ in range(3):
+        con.read_message()
+    with pytest.raises(BrokenSocket):
+        con.read(1)
+    server.join(timeout=2)
+
+    # when the server waits for the client depends on timing
+    entries = [event for event in events.entries()
+               if event["name"] != "<WAITING>"]
+    connections = {event.pop("connection") for event in entries}
+    assert len(connections) == 1
+    assert re.match(r"^#[0-9A-F]{4}>#[0-9A-F]{4}$", connections.pop())
+    assert entries[0]["name"] == "<ACCEPT>"
+    assert entries[1:] == [
+        {"direction": "C", "line": None, "name": "<MAGIC>",
+         "fields": "60 60 B0 17"},
+        {"direction": "C", "line": None, "name": "<HANDSHAKE>",
+         "fields": "00 00 03 04" + " 00" * 12},
+        {"direction": "S", "line": None, "name": "<HANDSHAKE>",
+         "fields": "00 00 03 04"},
+        {"direction": "C", "line": None, "name": "RESET", "fields": ""},
+        {"direction": "S", "line": None, "name": "SUCCESS",
+         "fields": '{"{}": {}}'},
+        {"direction": "C", "line": 5, "name": "RUN",
+         "fields": '"RETURN 1 AS n" {"{}": {}} {"{}": {}}'},
+        {"direction": "S", "line": 6, "name": "SUCCESS",
+         "fields": '{"fields": ["n"]}'},
+        {"direction": "C", "line": 7, "name": "PULL",
+         "fields": '{"{}": {"n": -1}}'},
+        {"direction": "S", "line": 8, "name": "RECORD", "fields": "[1]"},
+        {"direction": "S", "line": 9, "name": "SUCCESS", "fields": "{}"},
+        {"direction": "S", "line": None, "name": "<FINISHED>", "fields": ""},
+        {"direction": "S", "line": None, "name": "<HANGUP>", "fields": ""},
+    ]
+
+
+def test_reports_waiting_for_client(server_factory, connection_factory):
+    script = """
+    !: BOLT 4.3
+
+    C: RESET
+    S: SUCCESS {}
+    C: RESET
+    S: SUCCESS {}
+    C: RESET
+    S: SUCCESS {}
+    """
+    events = EventLog()
+    server_factory(script, events=events)
+    con = connection_factory("localhost", 7687)
+    con.write(b"\x60\x60\xb0\x17")
+    con.write(server_version_to_version_request((4, 3)))
+    con.read(4)
+    con.write(b"\x00\x02\xb0\x0f\x00\x00" * 2)
+    con.read_message()
+    con.read_message()
+    deadline = time.monotonic() + 2
+    while (events.entries()[-1]["name"] != "<WAITING>"
+           and time.monotonic() < deadline):
+        events.wait(len(events.entries()), 0.1)
+    names = [event["name"] for event in events.entries()]
+    assert names[-1] == "<WAITING>"
+    assert names.count("RESET") == 2
+    # the second RESET had been received when handling the first one
+    assert names[names.index("RESET"):].count("<WAITING>") == 1
+
+    con.write(b"\x00\x02\xb0\x0f\x00\x00")
+    con.read_message()
+    with pytest.raises(BrokenSocket):
+        con.read(1)
+    names = [event["name"] for event in events.entries()]
+    assert names[-4:] == ["RESET", "SUCCESS", "<FINISHED>", "<HANGUP>"]
+
+
+def test_listening_before_loading_script(server_factory,
+                                         connection_factory, capsys):
+    listen_socket = listen("localhost:7687")
+    assert capsys.readouterr().out == "Listening on 127.0.0.1:7687\n"
+    # connections are queued until the service starts serving
+    con = connection_factory("localhost", 7687)
+    con.write(b"\x60\x60\xb0\x17")
+    con.write(server_version_to_version_request((4, 3)))
+
+    server = server_factory("""
+    !: BOLT 4.3
+
+    S: SUCCESS
+    """, listen_socket=listen_socket)
+    assert con.read(4) == server_version_to_version_response((4, 3))
+    assert con.read_message() == b"\xb0\x70"
+    assert capsys.readouterr().out == ""
+    server.join(timeout=2)
+    assert not server.is_alive()
+    assert not server.service.exceptions
+
+
+def test_listening_on_free_port(capsys):
+    listen_socket = listen("localhost:0")
+    try:
+        port = listen_socket.getsockname()[1]
+        assert port
+        assert (capsys.readouterr().out
+                == "Listening on 127.0.0.1:%i\n" % port)
+    finally:
+        listen_socket.close()
+
+
 @pytest.mark.parametrize("restarting", (False, True))
 @pytest.mark.parametrize("concurrent", (False, True))
 def test_restarting(server_factory, restarting, concurrent,
@@ -738,3 +904,71 @@ def test_assert_order_protocol_failure(server_factory, connection_factory):
     assert "Unknown response message type FF" in exc_str
     with pytest.raises(BrokenSocket):
         con.read(1)
+
+
+def test_asyncio_many_concurrent_connections(connection_factory):
+    script = """
+    !: BOLT 4.3
+    !: ALLOW CONCURRENT
+
+    C: HELLO
+    S: SUCCESS
+    C: GOODBYE
+    """
+    server = ThreadedServer(script, "localhost:7687",
+                            service_class=AsyncBoltStubService)
+    server.start()
+    try:
+        _play_many_concurrent_connections(connection_factory)
+    finally:
+        server.stop()
+        server.join()
+    assert not server.service.exceptions
+
+
+def _play_many_concurrent_connections(connection_factory):
+    connections = [connection_factory("localhost", 7687) for _ in range(50)]
+    for con in connections:
+        con.write(b"\x60\x60\xb0\x17")
+        con.write(server_version_to_version_request((4, 3)))
+    for con in connections:
+        assert con.read(4) == server_version_to_version_response((4, 3))
+        con.write(b"\x00\x02\xb0\x01\x00\x00")  # HELLO
+    for con in connections:
+        assert con.read_message() == b"\xb0\x70"  # SUCCESS
+        con.write(b"\x00\x02\xb0\x02\x00\x00")  # GOODBYE
+    for con in connections:
+        with pytest.raises(BrokenSocket):
+            con.read(1)
+
+
+@pytest.mark.parametrize("stop_method", ("close_all_connections_async",
+                                         "try_skip_to_end_async"))
+def test_stopping_wakes_up_idle_actors(stop_method, server_factory,
+                                       connection_factory):
+    script = """
+    !: BOLT 4.3
+    !: ALLOW CONCURRENT
+
+    C: HELLO
+    S: SUCCESS
+    {?
+        C: GOODBYE
+    ?}
+    """
+    server = server_factory(parse(script))
+    connections = [connection_factory("localhost", 7687) for _ in range(3)]
+    for con in connections:
+        con.write(b"\x60\x60\xb0\x17")
+        con.write(server_version_to_version_request((4, 3)))
+        con.read(4)
+        con.write(b"\x00\x02\xb0\x01\x00\x00")  # HELLO
+        assert con.read_message() == b"\xb0\x70"  # SUCCESS
+    start = time.monotonic()
+    getattr(server.service, stop_method)()
+    for con in connections:
+        with con.timeout(1):
+            with pytest.raises(BrokenSocket):
+                con.read(1)
+    assert time.monotonic() - start < .5
+    assert not server.service.exceptions
@@ -17,12 +17,22 @@
 
 
 import inspect
+import socket
+import threading
+from io import BytesIO
 
 import pytest
 
 from ..bolt_protocol import Structure
+from ..packstream import (
+    Packer,
+    PackStream,
+    UnpackableBuffer,
+    Unpacker,
+)
 from ..simple_jolt.v1 import types as jolt_v1_types
 from ..simple_jolt.v2 import types as jolt_v2_types
+from ..wiring import Wire
 
 
 @pytest.mark.parametrize(("packstream_version", "fields", "res"), (
@@ -249,3 +259,123 @@ def test_struct_to_jolt_type(packstream_version, fields, res):
             jolt_types[i].__class__ == res[i].__class__
             for i in range(len(res))
         )
+
+
+def _pack(value):
+    stream = BytesIO()
+    Packer(stream).pack(value)
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize("value", (
+    None, True, False,
+    0, 1, 127, -1, -16, -17, -128, -129, 32767, -32768, 32768, -32769,
+    2 ** 31 - 1, -(2 ** 31), 2 ** 31, -(2 ** 31) - 1, 2 ** 63 - 1, -(2 ** 63),
+    0.0, 1.5, -1e300, float("inf"),
+    b"", b"\x00\x01", b"x" * 255, b"x" * 256, b"x" * 65536,
+    "", "a", "ä", "x" * 15, "x" * 16, "x" * 255, "x" * 256, "x" * 65536,
+    [], [1, "a", None], list(range(15)), list(range(16)), list(range(256)),
+    list(range(65536)), [[1, [2, [3]]], {"a": [4]}],
+    {}, {"a": 1}, {str(i): i for i in range(16)},
+    {str(i): i for i in range(256)}, {"a": {"b": {"c": [1, 2]}}},
+    Structure(b"\x44", 2, packstream_version=1),
+    [Structure(b"\x4E", 1, ["l"], {"p": "v"}, packstream_version=1)],
+))
+def test_unpack_round_trip(value):
+    unpacker = Unpacker(UnpackableBuffer(_pack(value)), 1)
+    res = unpacker.unpack()
+    assert res == value
+    assert type(res) is type(value)
+
+
+@pytest.mark.parametrize(("data", "res"), (
+    (b"\xD7\x01\x02\xDF", [1, 2]),
+    (b"\xDB\x81a\x01\x81b\x02\xDF", {"a": 1, "b": 2}),
+    (b"\xD4\x02\x01\x02", [1, 2]),
+    (b"\xD8\x01\x81a\xC0", {"a": None}),
+))
+def test_unpack_variants(data, res):
+    assert Unpacker(UnpackableBuffer(data), 1).unpack() == res
+
+
+def test_unpack_message():
+    data = _pack(Structure(b"\x10", "RETURN 1", {}, {}, packstream_version=1,
+                           verified=False))
+    message = Unpacker(UnpackableBuffer(data), 1).unpack_message()
+    assert message.tag == b"\x10"
+    assert message.fields == ["RETURN 1", {}, {}]
+    assert not message.verified
+
+
+@pytest.mark.parametrize("data", (b"\x01", b"\x91\x01"))
+def test_unpack_message_requires_struct(data):
+    with pytest.raises(ValueError, match="Expected a message struct"):
+        Unpacker(UnpackableBuffer(data), 1).unpack_message()
+
+
+@pytest.mark.parametrize("data", (b"", b"\x92\x01"))
+def test_unpack_nothing(data):
+    with pytest.raises(ValueError, match="Nothing to unpack"):
+        Unpacker(UnpackableBuffer(data), 1).unpack()
+
+
+@pytest.mark.parametrize("data", (b"\xC1\x00", b"\x85abc", b"\xD0\x05ab"))
+def test_unpack_truncated(data):
+    with pytest.raises(ValueError, match="Unexpected end"):
+        Unpacker(UnpackableBuffer(data), 1).unpack()
+
+
+@pytest.mark.parametrize("marker", (0xC4, 0xCF, 0xD3, 0xDC, 0xE0, 0xEF))
+def test_unpack_unknown_marker(marker):
+    with pytest.raises(ValueError, match="Unknown PackStream marker"):
+        Unpacker(UnpackableBuffer(bytes((marker,))), 1).unpack()
+
+
+def _chunk(data, chunk_size):
+    res = bytearray()
+    for i in range(0, len(data), chunk_size):
+        chunk = data[i:(i + chunk_size)]
+        res += len(chunk).to_bytes(2, "big") + chunk
+    return res + b"\x00\x00"
+
+
+@pytest.fixture
+def wire_pair():
+    server, client = socket.socketpair()
+    try:
+        yield Wire(server), client
+    finally:
+        server.close()
+        client.close()
+
+
+@pytest.mark.parametrize("chunk_size", (1, 7, 0xFFFF))
+@pytest.mark.parametrize("payload_size", (0, 1000, 0x20000))
+def test_read_message(wire_pair, chunk_size, payload_size):
+    wire, client = wire_pair
+    message = Structure(b"\x10", "x" * payload_size, {"a": [1, 2]}, {},
+                        packstream_version=1, verified=False)
+    data = _chunk(_pack(message), chunk_size)
+    sender = threading.Thread(target=client.sendall, args=(data * 2,))
+    sender.start()
+    stream = PackStream(wire, 1)
+    for _ in range(2):
+        res = stream.read_message()
+        assert res.tag == b"\x10"
+        assert res.fields == message.fields
+        assert stream.buffer.used == 0
+    sender.join()
+
+
+def test_read_message_resumes_after_timeout(wire_pair):
+    wire, client = wire_pair
+    wire._socket.settimeout(.1)
+    data = _chunk(_pack(Structure(b"\x10", "abc", {}, {},
+                                  packstream_version=1, verified=False)), 2)
+    stream = PackStream(wire, 1)
+    for i in range(len(data) - 1):
+        client.sendall(data[i:(i + 1)])
+        with pytest.raises(socket.timeout):
+            stream.read_message()
+    client.sendall(data[-1:])
+    assert stream.read_message().fields == ["abc", {}, {}]
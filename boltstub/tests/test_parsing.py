@@ -17,8 +17,11 @@
 
 
 import itertools
+import os
 import re
+import time
 from collections import defaultdict
+from copy import deepcopy
 from typing import (
     Iterator,
     Optional,
@@ -33,7 +36,15 @@ from .. import (
     parsing,
     Script,
 )
-from ..bolt_protocol import Bolt1Protocol
+from ..bolt_protocol import (
+    Bolt1Protocol,
+    Bolt4x3Protocol,
+)
+from ..caching import (
+    CACHE_DIR_ENV,
+    get_script_cache,
+    ScriptCache,
+)
 from ..simple_jolt import v1 as jolt_v1
 from ..simple_jolt import v2 as jolt_v2
 from ._common import (
@@ -856,3 +867,190 @@ def test_comment_like_field(unverified_script):
     script = parsing.parse(script)
     assert_dialogue_blocks_block_list(script.block_list,
                                       ['C: MSG "# NOT a comment"'])
+
+
+def test_server_lines_are_precompiled():
+    script = parsing.parse('!: BOLT 4.3\n\nC: RUN\nS: SUCCESS {"a": 1}\n'
+                           "   <NOOP>")
+    server_block = script.block_list.blocks[1]
+    message_line, command_line = server_block.lines
+    assert message_line.encoded_messages == {
+        Bolt4x3Protocol: b"\x00\x06\xb1\x70\xa1\x81a\x01\x00\x00"
+    }
+    assert command_line.encoded_messages == {}
+
+
+def test_consecutive_client_lines_are_merged(unverified_script):
+    script = parsing.parse("C: MSG1\nC: MSG2\n   MSG3\nS: SMSG\n")
+    client_block, _ = script.block_list.blocks
+    assert_client_block(client_block, ["C: MSG1", "C: MSG2", "C: MSG3"])
+    assert client_block.message_names == {"MSG1", "MSG2", "MSG3"}
+    assert client_block.first_message_names == {"MSG1"}
+
+
+def test_script_copies_share_lines():
+    script = parsing.parse("!: BOLT 4.3\n\nC: RUN\n"
+                           "{?\n    C: PULL\n    S: SUCCESS\n?}\n")
+    script_copy = deepcopy(script)
+    client_block, optional_block = script.block_list.blocks
+    copy_client_block, copy_optional_block = script_copy.block_list.blocks
+    assert copy_client_block is not client_block
+    assert copy_optional_block.block_list is not optional_block.block_list
+    assert copy_client_block.lines[0] is client_block.lines[0]
+    assert (copy_optional_block.block_list.blocks[0].lines[0]
+            is optional_block.block_list.blocks[0].lines[0])
+    assert script_copy.context is script.context
+
+    copy_client_block.index = 1
+    copy_optional_block.started = True
+    assert client_block.index == 0
+    assert not optional_block.started
+
+
+def test_script_cache_round_trip(tmp_path):
+    script = (
+        "!: BOLT 4.3\n\n"
+        'C: RUN "RETURN $n" {"n": "#N#"} {}\n'
+        'S: SUCCESS {"fields": ["n"]}\n'
+        "   <SLEEP> 1\n"
+        "{?\n"
+        '    C: PULL {"n": {"Z": "*"}}\n'
+        "    S: RECORD [1]\n"
+        "?}\n"
+    )
+    substitutions = {"#N#": "1"}
+    cache = ScriptCache(str(tmp_path))
+    parsed = parsing.parse(script, substitutions, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+    cached = parsing.parse(script, substitutions, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    assert cached is not parsed
+    assert list(map(repr, cached.all_lines)) == list(map(repr,
+                                                         parsed.all_lines))
+    for line, cached_line in zip(parsed.all_lines, cached.all_lines):
+        assert type(cached_line) is type(line)
+        assert cached_line.__dict__.keys() == line.__dict__.keys()
+    run_line = cached.block_list.blocks[0].lines[0]
+    assert run_line.match_message("RUN", ["RETURN $n", {"n": "1"}, {}])
+    success_block = cached.block_list.blocks[1]
+    assert success_block.lines[0].encoded_messages
+    assert success_block.lines[1].command == ("SLEEP", " 1")
+
+
+def test_script_cache_key(tmp_path):
+    script = '!: BOLT 4.3\n\nC: RUN "#Q#"\nS: SUCCESS\n'
+    cache = ScriptCache(str(tmp_path))
+    parsing.parse(script, {"#Q#": "RETURN 1"}, cache=cache)
+    cached = parsing.parse(script, {"#Q#": "RETURN 2"}, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert cached.block_list.blocks[0].lines[0].match_message(
+        "RUN", ["RETURN 2"]
+    )
+    assert len(list(tmp_path.rglob("*.pickle"))) == 2
+
+
+def test_script_cache_is_opt_in(tmp_path, monkeypatch):
+    monkeypatch.delenv(CACHE_DIR_ENV, raising=False)
+    assert get_script_cache() is None
+    assert get_script_cache(str(tmp_path)).directory == str(tmp_path)
+    monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path))
+    assert get_script_cache().directory == str(tmp_path)
+
+
+def test_script_cache_keeps_recently_used_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(ScriptCache, "max_entries", 2)
+    stale_version = tmp_path / ("0" * 16)
+    stale_version.mkdir()
+    (stale_version / "stale.pickle").write_bytes(b"")
+    cache = ScriptCache(str(tmp_path))
+    scripts = ['!: BOLT 4.3\n\nC: RUN "%i"\nS: SUCCESS\n' % i
+               for i in range(3)]
+    parsing.parse(scripts[0], cache=cache)
+    assert not stale_version.exists()
+    parsing.parse(scripts[1], cache=cache)
+    time.sleep(0.01)
+    # using the first entry again makes the second the least recently used
+    parsing.parse(scripts[0], cache=cache)
+    time.sleep(0.01)
+    parsing.parse(scripts[2], cache=cache)
+    assert len(list(tmp_path.rglob("*.pickle"))) == 2
+    assert (cache.hits, cache.misses) == (1, 3)
+    parsing.parse(scripts[0], cache=cache)
+    parsing.parse(scripts[1], cache=cache)
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+@pytest.mark.skipif(not hasattr(os, "getuid"), reason="POSIX only")
+def test_script_cache_ignores_directory_others_can_write(tmp_path):
+    tmp_path.chmod(0o777)
+    cache = ScriptCache(str(tmp_path))
+    script = "!: BOLT 4.3\n\nC: RUN\nS: SUCCESS\n"
+    parsing.parse(script, cache=cache)
+    parsing.parse(script, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert not list(tmp_path.rglob("*.pickle"))
+
+
+def test_script_cache_prints_stats(tmp_path, capsys):
+    cache = ScriptCache(str(tmp_path))
+    parsing.parse("!: BOLT 4.3\n\nC: RUN\nS: SUCCESS\n", cache=cache)
+    cache.print_stats()
+    assert capsys.readouterr().err == (
+        "Script cache %s: 0 hit(s), 1 miss(es)\n" % tmp_path
+    )
+
+
+def test_script_cache_ignores_broken_entries(tmp_path):
+    script = "!: BOLT 4.3\n\nC: RUN\nS: SUCCESS\n"
+    cache = ScriptCache(str(tmp_path))
+    (tmp_path / (cache.key(script) + ".pickle")).write_bytes(b"garbage")
+    parsing.parse(script, cache=cache)
+    parsing.parse(script, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def _dump_parsed(obj):
+    if isinstance(obj, parsing.Line):
+        return (obj.__class__.__name__, obj.line_number,
+                str.__str__(obj), obj.content)
+    if isinstance(obj, (list, tuple)):
+        return tuple(map(_dump_parsed, obj))
+    if isinstance(obj, dict):
+        return tuple((k, _dump_parsed(v)) for k, v in sorted(obj.items()))
+    if isinstance(obj, (parsing.Block, parsing.ScriptContext)):
+        return obj.__class__.__name__, _dump_parsed(vars(obj))
+    if isinstance(obj, parsing.Script):
+        return (_dump_parsed(obj.context), _dump_parsed(obj.block_list))
+    return obj
+
+
+@pytest.mark.parametrize("script", (
+    '!: BOLT 4.3\n\nC: RUN\n   "RETURN 1" {}\nS: SUCCESS\n',
+    "!: BOLT 4.3\n# comment\nC: RUN\nC: PULL\nS: SUCCESS\n   RECORD [1]\n",
+    "!: BOLT 4.3\n!: AUTO HELLO\n\nA: HELLO {}\n?: GOODBYE\n*: RESET\n"
+    "+: NOOP\nC: RUN\nS: SUCCESS\n",
+    "!: BOLT 4.3\n\n{{\n    C: RUN\n----\n    C: PULL\n}}\nS: SUCCESS\n",
+    "!: BOLT 4.3\n\n{{\n    C: RUN\n++++\n    C: PULL\n}}\n"
+    "{? C: RESET ?}\n{* S: SUCCESS *}\n{+\n    C: NOOP\n+}\n",
+    "!: BOLT 4.3\n\nC: RUN\nIF: True\n    S: SUCCESS\nELIF: False\n"
+    "    S: FAILURE\nELSE:\n    S: IGNORED\nPY: x = 1\n",
+    # nested unbraced conditionals are ambiguous, left to lark
+    "!: BOLT 4.3\n\nC: RUN\nIF: True\n    IF: False\n        S: SUCCESS\n"
+    "    ELSE:\n        S: IGNORED\n",
+    "!: BOLT 4.3\n\nC: RUN\nS: SUCCESS\n}}\n",
+    "!: BOLT 4.3\n\nELSE:\nC: RUN\n",
+    "!: BOLT 4.3\n\nC:\nS: SUCCESS\n",
+))
+def test_script_parser_matches_grammar(script, unverified_script):
+    try:
+        expected = parsing.ScriptTransformer().transform(
+            parsing.get_parser().parse(script)
+        )
+    except Exception as e:
+        with pytest.raises(type(e)) as exc:
+            parsing.ScriptParser(script).parse()
+        assert str(exc.value) == str(e)
+    else:
+        parsed = parsing.ScriptParser(script).parse()
+        assert _dump_parsed(parsed) == _dump_parsed(expected)
@@ -53,6 +53,7 @@ class MockChannel:
         self.msg_buffer = []
         self.packstream_version = packstream_version
         self.eval_context = EvalContext()
+        self.match_attempts = 0
         if self.packstream_version == 1:
             self.jolt_package = jolt_v1
         elif self.packstream_version == 2:
@@ -71,6 +72,7 @@ class MockChannel:
 
     def match_client_line(self, client_line, msg):
         # we only test using message names (no fields)
+        self.match_attempts += 1
         client_line.parse_jolt(self.jolt_package)
         return client_line.match_message(msg.name, msg.fields)
 
@@ -334,6 +336,23 @@ class TestAlternativeBlock:
         else:
             assert block_with_non_det_block.can_be_skipped(channel)
 
+    @pytest.mark.parametrize("branch", range(10))
+    def test_only_tries_branches_accepting_message(self, branch):
+        block = AlternativeBlock([  # noqa: PAR103
+            BlockList([  # noqa: PAR103
+                OptionalBlock(BlockList([  # noqa: PAR103
+                    ClientBlock([ClientLine(i, "C: OPT", "OPT")], i),
+                ], i), i),
+                ClientBlock([ClientLine(i, "C: MSG%i" % i, "MSG%i" % i)], i),
+            ], i)
+            for i in range(10)
+        ], 1)
+        channel = channel_factory(["MSG%i" % branch, "NOMATCH"])
+        with channel.assert_consume():
+            assert block.try_consume(channel)
+        assert channel.match_attempts == 1
+        assert block.done(channel)
+
 
 class TestBlockList:
     @pytest.fixture
@@ -641,6 +660,20 @@ class TestOptionalBlock:
 
 
 class TestParallelBlock:
+    def test_only_tries_branches_accepting_message(self):
+        block = ParallelBlock([  # noqa: PAR103
+            BlockList([ClientBlock([  # noqa: PAR103
+                ClientLine(i, "C: MSG%i1" % i, "MSG%i1" % i),
+                ClientLine(i, "C: MSG%i2" % i, "MSG%i2" % i),
+            ], i)], i)
+            for i in range(10)
+        ], 1)
+        channel = channel_factory(["MSG31", "MSG71", "MSG32", "NOMATCH"])
+        for _ in range(3):
+            with channel.assert_consume():
+                assert block.try_consume(channel)
+        assert channel.match_attempts == 3
+
     @pytest.fixture
     def block_read(self):
         return ParallelBlock([  # noqa: PAR103
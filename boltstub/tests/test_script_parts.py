@@ -17,7 +17,7 @@
 
 
 import json
-from unittest.mock import patch
+import pickle
 
 import pytest
 
@@ -379,6 +379,26 @@ class TestClientLine:
                                   packstream_version=packstream_version)
         assert match == line.match_message(msg.name, msg.fields)
 
+    @pytest.mark.parametrize("packstream_version",
+                             _common.ALL_PACKSTREAM_VERSIONS)
+    def test_ordered_values_must_be_sortable(self, packstream_version):
+        content = 'MSG {"a{}": [{"b": 1}, {"c": 2}]}'
+        line = self.LINE_CLS(10, self.LINE_MARKER + ": " + content, content)
+        with pytest.raises(LineError, match="cannot be sorted"):
+            line.parse_jolt(_common.get_jolt_package(packstream_version))
+
+    @pytest.mark.parametrize("packstream_version",
+                             _common.ALL_PACKSTREAM_VERSIONS)
+    def test_matcher_survives_pickling(self, packstream_version):
+        content = r'MSG {"[a{}]": [2, 1], "b": "\\*", "c": {"Z": "*"}} "*"'
+        line = self.LINE_CLS(10, self.LINE_MARKER + ": " + content, content)
+        line.parse_jolt(_common.get_jolt_package(packstream_version))
+        line = pickle.loads(pickle.dumps(line))
+        msg = TranslatedStructure("MSG", b"\x00",
+                                  {"a": [1, 2], "b": "*", "c": 1}, None,
+                                  packstream_version=packstream_version)
+        assert line.match_message(msg.name, msg.fields)
+
 
 class TestAutoLine(TestClientLine):
     LINE_MARKER = "A"
@@ -390,10 +410,14 @@ def channel_mock():
     class ChannelMock:
         def __init__(self):
             self.buffer = bytearray()
+            self.sleeps = []
 
         def send_raw(self, b):
             self.buffer.extend(b)
 
+        def sleep(self, duration):
+            self.sleeps.append(duration)
+
     return ChannelMock()
 
 
@@ -445,13 +469,11 @@ class TestServerLine:
             ServerLine(10, "S: " + content, content)
 
     @pytest.mark.parametrize("duration", (0, 0.5, 1.5, 200))
-    def test_sleep_server_line(self, duration, channel_mock, mocker):
-        sleep_path = __name__.rsplit(".", 2)[0] + ".parsing.sleep"
-        with patch(sleep_path, return_value=None) as patched_sleep:
-            content = "<SLEEP> {}".format(duration)
-            line = ServerLine(10, "S: " + content, content)
-            assert line.try_run_command(channel_mock)
-            patched_sleep.assert_called_once_with(duration)
+    def test_sleep_server_line(self, duration, channel_mock):
+        content = "<SLEEP> {}".format(duration)
+        line = ServerLine(10, "S: " + content, content)
+        assert line.try_run_command(channel_mock)
+        assert channel_mock.sleeps == [duration]
 
     @pytest.mark.parametrize("string", ("", "-1", "a", "None"))
     def test_sleep_server_line_with_invalid_arg(self, string):
@@ -469,13 +491,11 @@ class TestServerLine:
             expected_sleep = duration
         assert_no_input_mock = mocker.Mock()
         channel_mock.assert_no_input = assert_no_input_mock
-        sleep_path = __name__.rsplit(".", 2)[0] + ".parsing.sleep"
-        with patch(sleep_path, return_value=None) as patched_sleep:
-            content = f"<ASSERT ORDER>{duration_str}"
-            line = ServerLine(10, "S: " + content, content)
-            assert line.try_run_command(channel_mock)
-            patched_sleep.assert_called_once_with(expected_sleep)
-            assert_no_input_mock.assert_called_once()
+        content = f"<ASSERT ORDER>{duration_str}"
+        line = ServerLine(10, "S: " + content, content)
+        assert line.try_run_command(channel_mock)
+        assert channel_mock.sleeps == [expected_sleep]
+        assert_no_input_mock.assert_called_once()
 
     @pytest.mark.parametrize("string", ("-1", "a", "None"))
     def test_assert_order_server_line_with_invalid_arg(self, string):
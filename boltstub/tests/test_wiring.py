@@ -16,16 +16,25 @@
 # limitations under the License.
 
 
+import asyncio
+import socket as socket_module
+import threading
+import time
 from functools import reduce
 from random import getrandbits
 
 import pytest
 
+from ..async_engine import negotiate_socket as async_negotiate_socket
 from ..wiring import (
     create_wire,
     negotiate_socket,
+    PONG,
+    ReadWakeup,
     RegularSocket,
+    unmask,
     WebSocket,
+    Wire,
 )
 
 
@@ -148,7 +157,8 @@ class TestWebSocket:
     def test_recv(self, payload, frame, mocker):
         socket_mock = mocker.Mock()
         framed_payload = frame + payload
-        socket_mock.recv.side_effect = TestWebSocket.mock_recv(framed_payload)
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(framed_payload)
 
         websocket = WebSocket(socket_mock)
 
@@ -169,7 +179,8 @@ class TestWebSocket:
         socket_mock = mocker.Mock()
         pong = b"\x0A\x00"
         framed_payload = pong + frame + payload
-        socket_mock.recv.side_effect = TestWebSocket.mock_recv(framed_payload)
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(framed_payload)
 
         websocket = WebSocket(socket_mock)
 
@@ -191,7 +202,8 @@ class TestWebSocket:
         ping = b"\x09\x00"
         pong = b"\x0A\x00"
         framed_payload = ping + frame + payload
-        socket_mock.recv.side_effect = TestWebSocket.mock_recv(framed_payload)
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(framed_payload)
 
         websocket = WebSocket(socket_mock)
 
@@ -213,7 +225,8 @@ class TestWebSocket:
         frame = b"\x82\x7E\x00\x7E"
         payload = randbytes(126)
         framed_payload = reserved_control_frame + frame + payload
-        socket_mock.recv.side_effect = TestWebSocket.mock_recv(framed_payload)
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(framed_payload)
 
         websocket = WebSocket(socket_mock)
 
@@ -231,7 +244,8 @@ class TestWebSocket:
         framed_payload = frame + masked_payload
 
         socket_mock = mocker.Mock()
-        socket_mock.recv.side_effect = TestWebSocket.mock_recv(framed_payload)
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(framed_payload)
 
         websocket = WebSocket(socket_mock)
 
@@ -255,7 +269,8 @@ class TestWebSocket:
                               map(lambda p: p[0], payload_list))
 
         socket_mock = mocker.Mock()
-        socket_mock.recv.side_effect = TestWebSocket.mock_recv(framed_payload)
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(framed_payload)
 
         websocket = WebSocket(socket_mock)
 
@@ -278,17 +293,187 @@ class TestWebSocket:
 
         assert wrapped_method == original_method
 
+    def test_recv_masked_large_frame(self, mocker):
+        payload = randbytes(70000)
+        mask = b"\x01\x80\xFF\x42"
+        frame = b"\x82\xFF\x00\x00\x00\x00\x00\x01\x11\x70" + mask
+        masked_payload = bytearray(payload[i] ^ mask[i % 4]
+                                   for i in range(len(payload)))
+
+        socket_mock = mocker.Mock()
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(frame + masked_payload)
+
+        websocket = WebSocket(socket_mock)
+
+        assert websocket.recv(1234) == payload
+
+    @pytest.mark.parametrize("chunk_size", [1, 3, 1000])
+    def test_recv_into_fragmented(self, chunk_size, mocker):
+        payloads = [randbytes(10), randbytes(300), randbytes(5)]
+        mask = b"\x0A\x0B\x0C\x0D"
+        framed_payload = bytearray(b"\x89\x00")  # PING
+        for i, payload in enumerate(payloads):
+            fin = 0x80 if i == len(payloads) - 1 else 0
+            opcode = 0x02 if i == 0 else 0x00
+            header = bytes((fin | opcode,))
+            if len(payload) < 126:
+                header += bytes((0x80 | len(payload),))
+            else:
+                header += b"\xFE" + len(payload).to_bytes(2, "big")
+            framed_payload += header + mask + bytearray(
+                payload[j] ^ mask[j % 4] for j in range(len(payload))
+            )
+
+        socket_mock = mocker.Mock()
+        socket_mock.recv_into.side_effect = \
+            TestWebSocket.mock_recv_into(framed_payload, chunk_size)
+
+        websocket = WebSocket(socket_mock)
+
+        received = bytearray()
+        buffer = bytearray(64)
+        while True:
+            n = websocket.recv_into(buffer)
+            if not n:
+                break
+            received += buffer[:n]
+        assert received == b"".join(payloads)
+        socket_mock.sendall.assert_called_once_with(PONG)
+
+    def test_recv_into_resumes_after_timeout(self, mocker):
+        payload = randbytes(200)
+        framed_payload = b"\x82\x7E\x00\xC8" + payload
+        recv_into = TestWebSocket.mock_recv_into(framed_payload, 50)
+        calls = {"count": 0}
+
+        def flaky_recv_into(buffer, *args):
+            calls["count"] += 1
+            if calls["count"] % 2 == 0:
+                raise socket_module.timeout
+            return recv_into(buffer, *args)
+
+        socket_mock = mocker.Mock()
+        socket_mock.recv_into.side_effect = flaky_recv_into
+
+        websocket = WebSocket(socket_mock)
+
+        buffer = bytearray(200)
+        while True:
+            try:
+                n = websocket.recv_into(buffer)
+                break
+            except socket_module.timeout:
+                pass
+        assert n == 200
+        assert buffer == payload
+
+    def test_unmask(self):
+        mask = b"\x12\x34\x56\x78"
+        for size in range(0, 20):
+            payload = randbytes(size)
+            expected = bytes(payload[i] ^ mask[i % 4] for i in range(size))
+            assert unmask(payload, mask) == expected
+
     @staticmethod
-    def mock_recv(payload_):
+    def mock_recv_into(payload_, chunk_size=None):
         state = {"pos": 0}
 
-        def recv(*args, **kwargs):
-            size = args[0]
+        def recv_into(buffer, nbytes=0):
+            size = nbytes or len(buffer)
+            if chunk_size is not None:
+                size = min(size, chunk_size)
             start = state.get("pos")
-            end = start + size
-            state["pos"] = end
-            return payload_[start:end]
-        return recv
+            data = payload_[start:(start + size)]
+            state["pos"] = start + len(data)
+            buffer[:len(data)] = data
+            return len(data)
+        return recv_into
+
+
+class TestWire:
+
+    @pytest.fixture
+    def wire_pair(self):
+        server_sock, client_sock = socket_module.socketpair()
+        wire = Wire(server_sock)
+        try:
+            yield wire, client_sock
+        finally:
+            wire.close()
+            client_sock.close()
+
+    def test_pipelined_reads_do_not_move_data(self, wire_pair):
+        wire, client = wire_pair
+        # many small messages arriving at once
+        data = bytes(range(256)) * 16
+        client.sendall(data)
+        received = bytearray()
+        while len(received) < len(data):
+            received += wire.read(2)
+        assert received == data
+        assert wire.bytes_received == len(data)
+        assert wire.recv_calls < len(data) // 2
+        assert wire.compactions == 0
+
+    def test_compacts_only_when_out_of_space(self, wire_pair):
+        wire, client = wire_pair
+        size = wire.input_buffer_size
+        client.sendall(b"a" * (size - 1))
+        assert wire.read(size - 2) == b"a" * (size - 2)
+        # the remaining byte sits at the very end of the buffer
+        client.sendall(b"b" * 10)
+        assert wire.read(11) == b"a" + b"b" * 10
+        assert wire.compactions == 1
+        assert wire.stats == {
+            "bytes_received": size + 9,
+            "recv_calls": wire.recv_calls,
+            "compactions": 1,
+        }
+
+    def test_grows_for_large_reads(self, wire_pair):
+        wire, client = wire_pair
+        data = randbytes(3 * wire.input_buffer_size)
+        client.sendall(data)
+        assert wire.read(len(data)) == data
+
+    def test_keeps_partial_data_on_wake_up(self, wire_pair):
+        wire, client = wire_pair
+        wire._socket.settimeout(.01)
+        client.sendall(b"abc")
+        with pytest.raises(ReadWakeup):
+            wire.read(5)
+        client.sendall(b"de")
+        assert wire.read(5) == b"abcde"
+
+    def test_wake_up_interrupts_blocking_read(self):
+        server_sock, client_sock = socket_module.socketpair()
+        wire = Wire(server_sock, read_wake_up=True)
+        try:
+            timer = threading.Timer(.05, wire.wake_up)
+            timer.start()
+            start = time.monotonic()
+            with pytest.raises(ReadWakeup):
+                wire.read(1)
+            assert time.monotonic() - start < 1
+            timer.join()
+            # the wire is still usable afterwards
+            client_sock.sendall(b"ab")
+            assert wire.read(2) == b"ab"
+            assert wire.recv_calls == 1
+        finally:
+            wire.close()
+            client_sock.close()
+
+    def test_check_no_input(self, wire_pair):
+        wire, client = wire_pair
+        assert wire.check_no_input()
+        client.sendall(b"xy")
+        # give the socket pair a moment to deliver the data
+        wire._socket.settimeout(1)
+        wire.read(1)
+        assert not wire.check_no_input()
+        assert wire.read(1) == b"y"
 
 
 def test_create_wire(mocker):
@@ -319,26 +504,28 @@ def test_negotiate_socket_negotiate_regular_socket(mocker):
     socket.recv.assert_called_once()
 
 
-def test_negotiate_socket_negotiate_web_socket(mocker):
-    payload_text = ("GET /chat HTTP/1.1\r\n"
-                    + "Host: server.example.com\r\n"
-                    + "Upgrade: websocket\r\n"
-                    + "Connection: Upgrade\r\n"
-                    + "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
-                    + "Origin: http://example.com\r\n"
-                    + "Sec-WebSocket-Protocol: chat, superchat\r\n"
-                    + "Sec-WebSocket-Version: 13\r\n\r\n")
-    payload = payload_text.encode("utf-8")
-
-    response_payload_text = (
-        "HTTP/1.1 101 Switching Protocols\r\n"
-        + "Upgrade: websocket\r\n"
-        + "Connection: Upgrade\r\n"
-        + "Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n\r\n"
-    )
+WEB_SOCKET_UPGRADE_REQUEST = (
+    "GET /chat HTTP/1.1\r\n"
+    + "Host: server.example.com\r\n"
+    + "Upgrade: websocket\r\n"
+    + "Connection: Upgrade\r\n"
+    + "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+    + "Origin: http://example.com\r\n"
+    + "Sec-WebSocket-Protocol: chat, superchat\r\n"
+    + "Sec-WebSocket-Version: 13\r\n\r\n"
+).encode("utf-8")
+
+WEB_SOCKET_UPGRADE_RESPONSE = (
+    "HTTP/1.1 101 Switching Protocols\r\n"
+    + "Upgrade: websocket\r\n"
+    + "Connection: Upgrade\r\n"
+    + "Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n\r\n"
+).encode("utf-8")
 
+
+def test_negotiate_socket_negotiate_web_socket(mocker):
     socket = mocker.Mock()
-    socket.recv.return_value = payload
+    socket.recv.return_value = WEB_SOCKET_UPGRADE_REQUEST
 
     negotiated_socket = negotiate_socket(socket)
 
@@ -348,5 +535,38 @@ def test_negotiate_socket_negotiate_web_socket(mocker):
     socket.sendall.assert_called_once()
 
     encoded_sent_response, = socket.sendall.call_args.args
-    decoded_sent_response = encoded_sent_response.decode("utf-8")
-    assert decoded_sent_response == response_payload_text
+    assert encoded_sent_response == WEB_SOCKET_UPGRADE_RESPONSE
+
+
+def test_negotiate_socket_web_socket_upgrade_in_several_packets(mocker):
+    socket = mocker.Mock()
+    socket.recv.side_effect = (WEB_SOCKET_UPGRADE_REQUEST[:40],
+                               WEB_SOCKET_UPGRADE_REQUEST[40:100],
+                               WEB_SOCKET_UPGRADE_REQUEST[100:])
+
+    negotiated_socket = negotiate_socket(socket)
+
+    assert isinstance(negotiated_socket,  WebSocket)
+    assert socket.recv.call_count == 3
+    socket.sendall.assert_called_once_with(WEB_SOCKET_UPGRADE_RESPONSE)
+
+
+def test_async_negotiate_socket_web_socket_upgrade_in_several_packets():
+    server, client = socket_module.socketpair()
+
+    async def negotiate():
+        server.setblocking(False)
+        negotiation = asyncio.ensure_future(async_negotiate_socket(server))
+        for start in range(0, len(WEB_SOCKET_UPGRADE_REQUEST), 40):
+            client.sendall(WEB_SOCKET_UPGRADE_REQUEST[start:(start + 40)])
+            await asyncio.sleep(0.01)
+        return await negotiation
+
+    try:
+        negotiated_socket = asyncio.run(negotiate())
+        assert isinstance(negotiated_socket, WebSocket)
+        client.settimeout(1)
+        assert client.recv(1024) == WEB_SOCKET_UPGRADE_RESPONSE
+    finally:
+        server.close()
+        client.close()
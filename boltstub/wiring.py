@@ -26,17 +26,20 @@ as well as classes for modelling IP addresses, based on tuples.
 
 import base64
 import hashlib
+import selectors
 import struct
 from functools import cached_property
 from socket import (
     AF_INET,
     AF_INET6,
     getservbyname,
+    socketpair,
     timeout,
 )
 
 BOLT_PORT_NUMBER = 7687
 HTTP_HEADER_MIN_SIZE = 26  # BYTES
+HTTP_HEADER_MAX_SIZE = 8192  # BYTES
 MAGIC_WS_STRING = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 PONG = b"\x0A\x00"
 
@@ -146,6 +149,11 @@ class RegularSocket:
     def __getattr__(self, item):
         return getattr(self._socket, item)
 
+    @property
+    def buffered(self) -> bool:
+        """Whether data can be received without reading from the network."""
+        return bool(self._cache)
+
     def recv(self, bufsize) -> bytes:
         if self._cache:
             buff = self._cache
@@ -153,6 +161,32 @@ class RegularSocket:
             return buff
         return self._socket.recv(bufsize)
 
+    def recv_into(self, buffer, nbytes=0) -> int:
+        if self._cache:
+            nbytes = min(nbytes or len(buffer), len(self._cache))
+            buffer[:nbytes] = self._cache[:nbytes]
+            self._cache = self._cache[nbytes:]
+            return nbytes
+        return self._socket.recv_into(buffer, nbytes)
+
+    def frame(self, payload) -> bytes:
+        """Get the bytes to put on the network for sending `payload`."""
+        return payload
+
+
+def unmask(payload, mask):
+    """Apply (or remove) the 4-byte websocket `mask` to `payload`.
+
+    The XOR is computed on the payload as a whole (interpreted as a big
+    integer) instead of byte by byte.
+    """
+    size = len(payload)
+    if not size:
+        return b""
+    key = (bytes(mask) * ((size + 3) // 4))[:size]
+    return (int.from_bytes(payload, "little")
+            ^ int.from_bytes(key, "little")).to_bytes(size, "little")
+
 
 class WebSocket:
     """Implementation of Websockets [rfc6455].
@@ -162,53 +196,138 @@ class WebSocket:
 
     def __init__(self, socket_) -> None:
         self._socket = socket_
+        # raw bytes of the frame currently being received, kept across
+        # socket timeouts
+        self._frame = bytearray()
+        self._frame_used = 0
+        # unmasked payload not yet returned by `recv_into`
+        self._payload = b""
+        self._payload_pos = 0
 
     def __getattr__(self, item):
         return getattr(self._socket, item)
 
-    def recv(self, bufsize) -> bytes:
-        """Receive data from the socket.
+    @property
+    def buffered(self) -> bool:
+        """Whether data can be received without reading from the network."""
+        return self._payload_pos < len(self._payload)
+
+    def _fill_frame(self, n):
+        # Receive until the first `n` bytes of the frame are available.
+        # Returns False if the connection was closed.
+        if len(self._frame) < n:
+            self._frame += bytes(n - len(self._frame))
+        with memoryview(self._frame) as view:
+            while self._frame_used < n:
+                with view[self._frame_used:n] as target:
+                    received = self._socket.recv_into(target)
+                if not received:
+                    return False
+                self._frame_used += received
+        return True
 
-        The `bufsize` parameter is ignored. This method returns the entire
-        frame payload and handles control frames doing the needed actions.
+    def _recv_frame(self):
+        """Receive one complete frame.
+
+        :return: tuple of fin, opcode, and the unmasked payload or None if the
+            connection was closed.
         """
-        frame = self._socket.recv(2)
-        if len(frame) == 0:
-            return frame
+        if not self._fill_frame(2):
+            return None
+        frame = self._frame
+        payload_len = frame[1] & 0b0111_1111
+        masked = frame[1] >> 7
+        header_len = 2
+        if payload_len == 126:
+            header_len += 2
+        elif payload_len == 127:
+            header_len += 8
+        if masked:
+            header_len += 4
+        if not self._fill_frame(header_len):
+            return None
+        if payload_len == 126:
+            payload_len, = struct.unpack_from(">H", frame, 2)
+        elif payload_len == 127:
+            payload_len, = struct.unpack_from(">Q", frame, 2)
+        if not self._fill_frame(header_len + payload_len):
+            return None
 
         fin = frame[0] >> 7
         # rsv1 = frame[0] & 0b0100_0000 == 0b0100_0000
         # rsv2 = frame[0] & 0b0010_0000 == 0b0010_0000
         # rsv3 = frame[0] & 0b0001_0000 == 0b0001_0000
         opcode = frame[0] & 0b0000_1111
+        with memoryview(frame) as view:
+            with view[header_len:(header_len + payload_len)] as payload:
+                if masked:
+                    payload = unmask(payload,
+                                     frame[(header_len - 4):header_len])
+                else:
+                    payload = bytes(payload)
+        self._frame_used = 0
+        return fin, opcode, payload
+
+    def _recv_data_frame(self):
+        # Receive the next data frame answering control frames on the way.
+        while True:
+            frame = self._recv_frame()
+            if frame is None:
+                return None
+            fin, opcode, payload = frame
+            if opcode & 0b0000_1000 == 0b0000_1000:
+                if opcode == 0x09:  # PING
+                    self._socket.sendall(PONG)
+                continue
+            return fin, payload
 
-        masked = frame[1] >> 7
-        payload_len = frame[1] & 0b0111_1111
+    def recv_into(self, buffer, nbytes=0) -> int:
+        """Receive data from the socket into a writable buffer.
 
-        if payload_len == 126:
-            payload_len, = struct.unpack(">H", self._socket.recv(2))
-        elif payload_len == 127:
-            payload_len, = struct.unpack(">Q", self._socket.recv(8))
-
-        if masked == 1:
-            mask = self._socket.recv(4)
-
-        masked_payload = self._socket.recv(payload_len)
-
-        payload = masked_payload \
-            if masked == 0 \
-            else bytearray([masked_payload[i] ^ mask[i % 4]
-                            for i in range(payload_len)])
-        if opcode & 0b0000_1000 == 0b0000_1000:
-            if opcode == 0x09:  # PING
-                self._socket.sendall(PONG)
-            return self.recv(bufsize)
-        elif fin == 0:
-            return payload + self.recv(bufsize)
-        return payload
+        Payload that doesn't fit into the buffer is kept for the next call.
+        Returns 0 if the connection was closed.
+        """
+        while self._payload_pos == len(self._payload):
+            frame = self._recv_data_frame()
+            if frame is None:
+                return 0
+            self._payload = frame[1]
+            self._payload_pos = 0
+        pos = self._payload_pos
+        nbytes = min(nbytes or len(buffer), len(self._payload) - pos)
+        with memoryview(self._payload) as view:
+            buffer[:nbytes] = view[pos:(pos + nbytes)]
+        self._payload_pos = pos + nbytes
+        return nbytes
+
+    def recv(self, bufsize) -> bytes:
+        """Receive data from the socket.
+
+        The `bufsize` parameter is ignored. This method returns the entire
+        message payload (all frames up to the final one) and handles control
+        frames doing the needed actions.
+        """
+        message = bytearray(self._payload[self._payload_pos:])
+        self._payload, self._payload_pos = b"", 0
+        while True:
+            frame = self._recv_data_frame()
+            if frame is None:
+                return bytes(message)
+            fin, payload = frame
+            message += payload
+            if fin:
+                return message
 
     def send(self, payload) -> int:
         """Send the payload over the socket inside a Websocket frame."""
+        self._socket.sendall(self.frame(payload))
+
+        return len(payload)
+
+    sendall = send
+
+    def frame(self, payload) -> bytes:
+        """Get the bytes to put on the network for sending `payload`."""
         frame = [0b1000_0010]
         payload_len = len(payload)
         if payload_len < 126:
@@ -220,13 +339,7 @@ class WebSocket:
             frame += [127]
             frame += bytearray(struct.pack(">Q", payload_len))
 
-        frame_to_send = bytearray(frame) + bytearray(payload)
-
-        self._socket.sendall(frame_to_send)
-
-        return len(payload)
-
-    sendall = send
+        return bytearray(frame) + bytearray(payload)
 
 
 class Wire(object):
@@ -236,13 +349,32 @@ class Wire(object):
 
     _broken = False
 
+    input_buffer_size = 8192
+
+    # called when about to wait for the peer with nothing left to read
+    on_idle = None
+
     def __init__(self, s, read_wake_up=False):
-        # ensure wrapped socket is in blocking mode but wakes up occasionally
-        # if wake_up == True
-        s.settimeout(.1 if read_wake_up else None)
+        # ensure wrapped socket is in blocking mode
+        # if read_wake_up == True, reads can be interrupted by `wake_up`
+        s.settimeout(None)
         self._socket = s
-        self._input = bytearray()
+        self._selector = None
+        if read_wake_up:
+            self._waker, self._wake_signal = socketpair()
+            self._waker.setblocking(False)
+            self._wake_signal.setblocking(False)
+            self._selector = selectors.DefaultSelector()
+            self._selector.register(s, selectors.EVENT_READ)
+            self._selector.register(self._waker, selectors.EVENT_READ)
+        # received but not yet read bytes are `_input[_input_start:_input_end]`
+        self._input = bytearray(self.input_buffer_size)
+        self._input_start = 0
+        self._input_end = 0
         self._output = bytearray()
+        self.bytes_received = 0
+        self.recv_calls = 0
+        self.compactions = 0
 
     def secure(self, verify=True, hostname=None):
         """Apply a layer of security onto this connection."""
@@ -271,18 +403,88 @@ class Wire(object):
     def read(self, n):
         """Read bytes from the network."""
         self._read_to_buffer(n)
-        data = self._input[:n]
-        self._input[:n] = []
+        start = self._input_start
+        data = self._input[start:(start + n)]
+        self._skip_input(n)
         return data
 
+    def read_into(self, buffer, n):
+        """Read `n` bytes from the network into an `UnpackableBuffer`.
+
+        Bytes already buffered by this wire are copied over, the remainder is
+        received directly into `buffer`.
+        """
+        start = self._input_start
+        buffered = min(n, self._input_end - start)
+        if buffered:
+            with memoryview(self._input) as view:
+                with view[start:(start + buffered)] as data:
+                    buffer.write(data)
+            self._skip_input(buffered)
+            n -= buffered
+        if n:
+            buffer.receive(self, n)
+
+    def recv_into(self, buffer):
+        """Receive at least one byte from the network into `buffer`.
+
+        :return: the number of bytes received
+        """
+        if (self._selector is not None
+                and not getattr(self._socket, "buffered", False)):
+            self._wait_readable()
+        self.recv_calls += 1
+        try:
+            n = self._socket.recv_into(buffer)
+        except (timeout, BlockingIOError):
+            raise ReadWakeup from None
+        except OSError as exc:
+            self._broken = True
+            raise BrokenWireError("Broken") from exc
+        if not n:
+            self._broken = True
+            raise BrokenWireError("Network read incomplete")
+        self.bytes_received += n
+        return n
+
+    def _wait_readable(self):
+        if self.on_idle is not None and not self._selector.select(0):
+            self.on_idle()
+        for key, _ in self._selector.select():
+            if key.fileobj is self._waker:
+                try:
+                    while self._waker.recv(1024):
+                        pass
+                except OSError:
+                    pass
+                raise ReadWakeup
+
+    def wake_up(self):
+        """Interrupt the current (or next) read with :class:`.ReadWakeup`.
+
+        Only has an effect if the wire was created with `read_wake_up=True`.
+        Can be called from any thread.
+        """
+        if self._selector is None:
+            return
+        try:
+            self._wake_signal.send(b"\x00")
+        except OSError:
+            # already closed or enough wake-up signals pending
+            pass
+
     def check_no_input(self):
-        if len(self._input) > 0:
+        if self._input_end > self._input_start:
             return False
         socket_timeout = self._socket.gettimeout()
         self._socket.settimeout(0)
         try:
-            received = self._socket.recv(1)
-            self._input.extend(received)
+            self.recv_calls += 1
+            with memoryview(self._input) as view:
+                with view[:1] as target:
+                    received = self._socket.recv_into(target)
+            self.bytes_received += received
+            self._input_start, self._input_end = 0, received
             return False
         except OSError:
             # probably no data, as expected
@@ -291,25 +493,45 @@ class Wire(object):
         finally:
             self._socket.settimeout(socket_timeout)
 
+    def _skip_input(self, n):
+        self._input_start += n
+        if self._input_start == self._input_end:
+            # everything has been read: start over at the front of the buffer
+            # for free instead of moving data around later
+            self._input_start = self._input_end = 0
+
+    def _make_room(self, n):
+        # Make sure `n` bytes can be buffered starting at `_input_start`.
+        # Buffered data is only moved to the front if there is not enough
+        # space left at the end of the buffer.
+        start, end = self._input_start, self._input_end
+        capacity = len(self._input)
+        if start + n <= capacity:
+            return
+        if start:
+            self._input[:(end - start)] = self._input[start:end]
+            self._input_start, self._input_end = 0, end - start
+            self.compactions += 1
+        if n > capacity:
+            self._input += bytearray(max(n, 2 * capacity) - capacity)
+
     def _read_to_buffer(self, n):
-        while len(self._input) < n:
-            required = n - len(self._input)
-            requested = max(required, 8192)
-            try:
-                received = self._socket.recv(requested)
-            except timeout:
-                raise ReadWakeup from None
-            except OSError as exc:
-                self._broken = True
-                raise BrokenWireError("Broken") from exc
-            else:
-                if received:
-                    self._input.extend(received)
-                else:
-                    self._broken = True
-                    raise BrokenWireError("Network read incomplete "
-                                          "(received %d of %d bytes)" %
-                                          (len(self._input), n))
+        if self._input_end - self._input_start >= n:
+            return
+        self._make_room(n)
+        with memoryview(self._input) as view:
+            while self._input_end - self._input_start < n:
+                with view[self._input_end:] as target:
+                    self._input_end += self.recv_into(target)
+
+    @property
+    def stats(self):
+        """Counters about the receiving side of this connection."""
+        return {
+            "bytes_received": self.bytes_received,
+            "recv_calls": self.recv_calls,
+            "compactions": self.compactions,
+        }
 
     def write(self, b):
         """Write bytes to the output buffer."""
@@ -335,6 +557,10 @@ class Wire(object):
 
     def close(self):
         """Close the connection."""
+        if self._selector is not None:
+            self._selector.close()
+            self._waker.close()
+            self._wake_signal.close()
         try:
             # TODO: shutdown
             self._socket.close()
@@ -379,33 +605,54 @@ class BrokenWireError(WireError):
     """Raised when a connection is broken by the network or remote peer."""
 
 
-def negotiate_socket(socket_):
-    def try_to_negotiate_websocket(socket__, buffer_):
-        encoding = "utf-8"
-        encoded = buffer_.strip().decode(encoding)
-        headers = encoded.strip().split("\r\n")
-        if "Upgrade: websocket" not in headers:
-            return False
-        for h in headers:
-            if "Sec-WebSocket-Key" in h:
-                key = h.split(" ")[1]
-        key = key + MAGIC_WS_STRING
-        encoded_key = key.encode(encoding)
-        encrypted_key = hashlib.sha1(encoded_key).digest()
-        base64_key = base64.standard_b64encode(encrypted_key).decode(encoding)
-        response = ("HTTP/1.1 101 Switching Protocols\r\n"
-                    + "Upgrade: websocket\r\n"
-                    + "Connection: Upgrade\r\n"
-                    + "Sec-WebSocket-Accept: %s\r\n\r\n") % base64_key
-        encoded_response = response.encode(encoding)
-        socket__.sendall(encoded_response)
-        return True
+def expects_more_http_header(buffer):
+    """Whether `buffer` is the start of an HTTP request's header.
+
+    Websocket upgrade requests can arrive in several packets, while Bolt
+    connections start with the magic preamble instead.
+    """
+    return (buffer.startswith(b"GET ")
+            and b"\r\n\r\n" not in buffer
+            and len(buffer) < HTTP_HEADER_MAX_SIZE)
+
+
+def websocket_upgrade_response(buffer):
+    """Return the response to a websocket upgrade request.
 
+    :return: the response or None if `buffer` is no such request
+    """
+    if len(buffer) < HTTP_HEADER_MIN_SIZE:
+        return None
+    encoding = "utf-8"
+    encoded = buffer.strip().decode(encoding)
+    headers = encoded.strip().split("\r\n")
+    if "Upgrade: websocket" not in headers:
+        return None
+    for h in headers:
+        if "Sec-WebSocket-Key" in h:
+            key = h.split(" ")[1]
+    key = key + MAGIC_WS_STRING
+    encoded_key = key.encode(encoding)
+    encrypted_key = hashlib.sha1(encoded_key).digest()
+    base64_key = base64.standard_b64encode(encrypted_key).decode(encoding)
+    response = ("HTTP/1.1 101 Switching Protocols\r\n"
+                + "Upgrade: websocket\r\n"
+                + "Connection: Upgrade\r\n"
+                + "Sec-WebSocket-Accept: %s\r\n\r\n") % base64_key
+    return response.encode(encoding)
+
+
+def negotiate_socket(socket_):
     buffer = socket_.recv(1024)
-    if len(buffer) >= HTTP_HEADER_MIN_SIZE:
-        negotiated = try_to_negotiate_websocket(socket_, buffer)
-        if negotiated:
-            return WebSocket(socket_)
+    while expects_more_http_header(buffer):
+        data = socket_.recv(1024)
+        if not data:
+            break
+        buffer += data
+    response = websocket_upgrade_response(buffer)
+    if response is not None:
+        socket_.sendall(response)
+        return WebSocket(socket_)
 
     return RegularSocket(socket_, buffer)
 
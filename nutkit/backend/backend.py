@@ -1,4 +1,5 @@
 import inspect
+import itertools
 import json
 import os
 import socket
@@ -7,6 +8,12 @@ from datetime import datetime
 
 import nutkit.protocol as protocol
 
+try:
+    import orjson
+except ImportError:
+    # faster, but optional
+    orjson = None
+
 PROTOCOL_CLASSES = dict(
     m for m in inspect.getmembers(protocol, inspect.isclass)
 )
@@ -18,35 +25,126 @@ DEBUG_TIMEOUT = os.environ.get("TEST_DEBUG_NO_BACKEND_TIMEOUT", "0") in (
 )
 
 
+def _field_names(cls):
+    """Names of the instance variables sent for an object of `cls`.
+
+    Classes without `__slots__` are sent with all their instance variables.
+    """
+    slots = cls.__dict__.get("__slots__")
+    if slots is None:
+        return None
+    return (slots,) if isinstance(slots, str) else tuple(slots)
+
+
+def _make_encoder(cls):
+    name = cls.__name__
+    fields = _field_names(cls)
+    if fields is None:
+        def encode(o):
+            return {"name": name, "data": o.__dict__}
+    elif fields == ("value",):
+        def encode(o):
+            return {"name": name, "data": {"value": o.value}}
+    else:
+        def encode(o):
+            return {"name": name,
+                    "data": {field: getattr(o, field) for field in fields}}
+    return encode
+
+
+def _make_decoder(cls):
+    try:
+        parameters = list(inspect.signature(cls).parameters)
+    except ValueError:
+        # e.g., exception classes without their own `__init__`
+        parameters = None
+    if parameters == ["value"]:
+        # most values in records, skip the keyword argument handling
+        def decode(data):
+            if not data:
+                return cls()
+            return cls(data["value"])
+    else:
+        def decode(data):
+            if not data:
+                return cls()
+            return cls(**data)
+    return decode
+
+
+# Protocol classes are looked up by type when encoding and by name when
+# decoding. Aliases (e.g., `CypherNode` for `Node`) are only decoded.
+_ENCODERS = {cls: _make_encoder(cls) for cls in PROTOCOL_CLASSES.values()}
+_DECODERS = {name: _make_decoder(cls)
+             for name, cls in PROTOCOL_CLASSES.items()}
+
+
+def to_json_object(o):
+    """Return the JSON object of a protocol object.
+
+    Raises `TypeError` for objects of any other type.
+    """
+    encode = _ENCODERS.get(type(o))
+    if encode is None:
+        raise TypeError("Object of type %s is not JSON serializable"
+                        % type(o).__name__)
+    return encode(o)
+
+
 class Encoder(json.JSONEncoder):
     def default(self, o):
-        name = type(o).__name__
-        if name in PROTOCOL_CLASSES:
-            return {"name": name, "data": o.__dict__}
-        return json.JSONEncoder.default(self, o)
+        encode = _ENCODERS.get(type(o))
+        if encode is None:
+            return json.JSONEncoder.default(self, o)
+        return encode(o)
 
 
 def decode_hook(x):
-    if "name" not in x:
+    name = x.get("name")
+    if name.__class__ is not str:
         return x
-
-    name = x["name"]
-    if not isinstance(name, str) or name not in PROTOCOL_CLASSES:
+    decode = _DECODERS.get(name)
+    if decode is None:
         return x
+    return decode(x.get("data"))
+
+
+def loads(s, object_hook=decode_hook):
+    """Decode a response."""
+    # orjson has no object hook, and calling `decode_hook` for the objects it
+    # returns is slower than letting `json` call it
+    return json.loads(s, object_hook=object_hook)
 
-    data = x.get("data", {})
-    if not data:
-        data = {}
 
-    return PROTOCOL_CLASSES[name](**data)
+if orjson is not None:
+    def dumps(o):
+        """Encode a request."""
+        try:
+            return orjson.dumps(o, default=to_json_object).decode("utf-8")
+        except orjson.JSONEncodeError:
+            # e.g., integers beyond 64 bit, which some tests send on purpose
+            return _encoder.encode(o)
+else:
+    def dumps(o):
+        """Encode a request."""
+        return _encoder.encode(o)
+
+
+_encoder = Encoder()
 
 
 # How long to wait before backend responds
 DEFAULT_TIMEOUT = None if DEBUG_TIMEOUT else 10
 
+# Header of a length-prefixed message, followed by the length of the JSON in
+# bytes, a line break, and the JSON.
+# See `protocol.Feature.BACKEND_LENGTH_PREFIXED_FRAMING`.
+FRAME_PREFIX = "#json "
+
 
 class Backend:
-    def __init__(self, address, port):
+    def __init__(self, address, port, request_filter=None,
+                 response_filter=None):
         self._socket = socket.socket(socket.AF_INET)
         try:
             self._socket.connect((address, port))
@@ -59,10 +157,52 @@ class Backend:
                 "Driver backend is not running or is not listening on "
                 "port %d or is just refusing connections" % port
             )
-        self._encoder = Encoder()
-        self._reader = self._socket.makefile(mode="r", encoding="utf-8")
-        self._writer = self._socket.makefile(mode="w", encoding="utf-8")
+        # functions applied to requests before they are encoded and to
+        # responses after they have been decoded
+        self._request_filter = request_filter
+        self._response_filter = response_filter
+        self._reader = self._socket.makefile(mode="rb")
+        self._writer = self._socket.makefile(mode="wb")
         self.default_timeout = DEFAULT_TIMEOUT
+        # Features the driver supports, set by the tests once known (see
+        # `tests.shared.get_driver_features`).
+        self.features = None
+        # Frame messages by their length instead of `#request begin` and
+        # `#request end` lines. Only for backends that support it.
+        self.length_prefixed_framing = False
+        # Allow sending requests before the responses to earlier ones have
+        # been received. Only for backends that support it.
+        self.pipelining = False
+        # Fetch records in batches with ResultNextBatch. Only for backends
+        # that support it.
+        self.result_batches = False
+        self._pending_responses = 0
+        self._request_ids = itertools.count(1)
+        # responses to pipelined requests received while waiting for another
+        self._pipelined_responses = {}
+
+    def is_idle(self):
+        """Whether all requests have been answered and the backend is there.
+
+        A connection in this state can be used by another test.
+        """
+        if self._pending_responses:
+            return False
+        timeout = self._socket.gettimeout()
+        try:
+            self._socket.settimeout(0)
+            # anything but the connection having been closed is fine, the
+            # backend may send logs at any time
+            return self._socket.recv(1, socket.MSG_PEEK) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            try:
+                self._socket.settimeout(timeout)
+            except OSError:
+                pass
 
     def close(self):
         self._reader.close()
@@ -70,69 +210,133 @@ class Backend:
         self._socket.shutdown(socket.SHUT_RDWR)
         self._socket.close()
 
-    def send(self, req, hooks=None):
+    def send(self, req, hooks=None, pipelined=False):
+        """Send a request to the backend.
+
+        :param pipelined: tag the request with an id the backend tags the
+            response with, so that more requests can be sent before
+            receiving it. Requires `pipelining`.
+        :return: the id to pass to `receive` for pipelined requests
+        """
         if hooks:
             hook = hooks.get("on_send_" + req.__class__.__name__, None)
             if callable(hook):
                 hook(req)
-        req_json = self._encoder.encode(req)
+        if self._request_filter:
+            req = self._request_filter(req)
+        request_id = None
+        if pipelined:
+            if not self.pipelining:
+                raise Exception("Backend doesn't support pipelining")
+            request_id = next(self._request_ids)
+            req_json = dumps(dict(to_json_object(req),
+                                  requestId=request_id))
+        else:
+            req_json = dumps(req)
         if DEBUG_MESSAGES:
             print("%s Request: %s" % (datetime.now(), req_json))
-        self._writer.write("#request begin\n")
-        self._writer.write(req_json + "\n")
-        self._writer.write("#request end\n")
+        data = req_json.encode("utf-8")
+        if self.length_prefixed_framing:
+            self._writer.write(b"%s%i\n" % (FRAME_PREFIX.encode(), len(data)))
+            self._writer.write(data)
+        else:
+            self._writer.write(b"#request begin\n" + data
+                               + b"\n#request end\n")
         self._writer.flush()
+        self._pending_responses += 1
+        return request_id
 
-    def receive(self, timeout=None, hooks=None):
-        if timeout is None:
-            timeout = self.default_timeout
-        self._socket.settimeout(timeout)
-        response = ""
-        in_response = False
+    def _read_response(self):
+        lines = None
         num_blanks = 0
         while True:
-            line = self._reader.readline().strip()
+            line = self._reader.readline().decode("utf-8").strip()
+            if (self.length_prefixed_framing
+                    and line.startswith(FRAME_PREFIX)):
+                size = int(line[len(FRAME_PREFIX):])
+                data = self._reader.read(size)
+                if len(data) < size:
+                    raise Exception("Backend closed the connection "
+                                    "in the middle of a response")
+                return data.decode("utf-8")
             if line == "#response begin":
-                if in_response:
+                if lines is not None:
                     raise Exception("already in response")
-                in_response = True
+                lines = []
             elif line == "#response end":
-                if DEBUG_MESSAGES:
-                    try:
-                        print("%s Response: %s" % (datetime.now(), response))
-                    except UnicodeEncodeError:
-                        print("Response: <invalid unicode>")
-                try:
-                    res = json.loads(response, object_hook=decode_hook)
-                except json.decoder.JSONDecodeError:
-                    raise Exception("Failed to decode: %s" % response)
-
-                if hooks:
-                    hook = hooks.get("on_receive_" + res.__class__.__name__,
-                                     None)
-                    if callable(hook):
-                        hook(res)
-                # All received errors are raised as exceptions
-                if isinstance(res, protocol.BaseError):
-                    raise res
-                return res
-            else:
-                if in_response:
-                    response = response + line
-                else:
-                    # When backend crashes we will end up reading empty lines
-                    # until end of universe.  Use this simple check to detect
-                    # this condition and abort
-                    if not line:
-                        num_blanks += 1
-                        if num_blanks > 50:
-                            raise Exception(
-                                "Detected possible crash in backend"
-                            )
-                    # The backend can send it's own logs outside of response
-                    # blocks
-                    elif DEBUG_MESSAGES:
-                        print("[BACKEND]: %s" % line)
+                return "".join(lines)
+            elif lines is not None:
+                lines.append(line)
+            # When backend crashes we will end up reading empty lines
+            # until end of universe.  Use this simple check to detect
+            # this condition and abort
+            elif not line:
+                num_blanks += 1
+                if num_blanks > 50:
+                    raise Exception("Detected possible crash in backend")
+            # The backend can send it's own logs outside of response
+            # blocks
+            elif DEBUG_MESSAGES:
+                print("[BACKEND]: %s" % line)
+
+    def _decode(self, response):
+        if not self.pipelining:
+            return loads(response), None
+        envelope = None
+
+        def hook(x):
+            nonlocal envelope
+            # the envelope is the last (outermost) object decoded
+            envelope = x
+            return decode_hook(x)
+
+        res = loads(response, object_hook=hook)
+        return res, envelope.get("requestId")
+
+    def _receive_next(self):
+        response = self._read_response()
+        self._pending_responses -= 1
+        if DEBUG_MESSAGES:
+            try:
+                print("%s Response: %s" % (datetime.now(), response))
+            except UnicodeEncodeError:
+                print("Response: <invalid unicode>")
+        try:
+            res, request_id = self._decode(response)
+        except json.decoder.JSONDecodeError:
+            raise Exception("Failed to decode: %s" % response)
+        if self._response_filter:
+            res = self._response_filter(res)
+        return res, request_id
+
+    def receive(self, timeout=None, hooks=None, request_id=None):
+        """Receive the next response from the backend.
+
+        :param request_id: id of the pipelined request to receive the
+            response to. Responses to other pipelined requests received in
+            the meantime are kept until asked for. Responses without id,
+            e.g., callbacks of the driver, are returned right away.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        self._socket.settimeout(timeout)
+        if request_id in self._pipelined_responses:
+            res = self._pipelined_responses.pop(request_id)
+        else:
+            while True:
+                res, res_id = self._receive_next()
+                if res_id is None or res_id == request_id:
+                    break
+                self._pipelined_responses[res_id] = res
+
+        if hooks:
+            hook = hooks.get("on_receive_" + res.__class__.__name__, None)
+            if callable(hook):
+                hook(res)
+        # All received errors are raised as exceptions
+        if isinstance(res, protocol.BaseError):
+            raise res
+        return res
 
     def send_and_receive(self, req, timeout=None, hooks=None):
         self.send(req, hooks=hooks)
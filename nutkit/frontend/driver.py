@@ -71,9 +71,19 @@ class Driver:
             raise Exception("Should be Driver but was %s" % res)
         self._driver = res
 
-    def receive(self, timeout=None, hooks=None, *, allow_resolution):
+    @property
+    def pipelining(self):
+        return self._backend.pipelining
+
+    @property
+    def result_batches(self):
+        return self._backend.result_batches
+
+    def receive(self, timeout=None, hooks=None, *, allow_resolution,
+                request_id=None):
         while True:
-            res = self._backend.receive(timeout=timeout, hooks=hooks)
+            res = self._backend.receive(timeout=timeout, hooks=hooks,
+                                        request_id=request_id)
             if allow_resolution:
                 if isinstance(res, protocol.ResolverResolutionRequired):
                     addresses = self.resolve(res.address)
@@ -107,8 +117,8 @@ class Driver:
 
             return res
 
-    def send(self, req, hooks=None):
-        self._backend.send(req, hooks=hooks)
+    def send(self, req, hooks=None, pipelined=False):
+        return self._backend.send(req, hooks=hooks, pipelined=pipelined)
 
     def send_and_receive(self, req, timeout=None, hooks=None, *,
                          allow_resolution):
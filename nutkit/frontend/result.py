@@ -1,13 +1,35 @@
+from collections import deque
+
 from .. import protocol
 
+# Most ResultNext requests sent ahead when iterating over a result with a
+# backend that supports pipelining
+PIPELINED_RESULT_NEXT_REQUESTS = 32
+# Records requested at a time when iterating over a result with a backend
+# that supports ResultNextBatch
+RESULT_BATCH_SIZE = 100
+
 
 class Result:
     def __init__(self, driver, result):
         self._driver = driver
         self._result = result
+        # Records received ahead while iterating (pipelined ResultNext
+        # requests or the rest of a batch), which the caller didn't get to
+        # as it stopped early. Possibly followed by the NullRecord or error
+        # ending them.
+        self._buffered = deque()
+
+    def _next_buffered(self):
+        response = self._buffered.popleft()
+        if isinstance(response, protocol.BaseError):
+            raise response
+        return response
 
     def next(self):
         """Move to next record in result."""
+        if self._buffered:
+            return self._next_buffered()
         req = protocol.ResultNext(self._result.id)
         return self._driver.send_and_receive(req, allow_resolution=True)
 
@@ -31,20 +53,30 @@ class Result:
 
     def peek(self):
         """Return the next Record or NullRecord without consuming it."""
+        if self._buffered:
+            if isinstance(self._buffered[0], protocol.BaseError):
+                raise self._buffered[0]
+            return self._buffered[0]
         req = protocol.ResultPeek(self._result.id)
         return self._driver.send_and_receive(req, allow_resolution=True)
 
     def consume(self):
         """Discard all records in result and returns summary."""
+        self._buffered.clear()
         req = protocol.ResultConsume(self._result.id)
         return self._driver.send_and_receive(req, allow_resolution=True)
 
     def list(self):
         """Retrieve the entire result stream."""
+        records = []
+        while self._buffered:
+            record = self._next_buffered()
+            if not isinstance(record, protocol.NullRecord):
+                records.append(record)
         req = protocol.ResultList(self._result.id)
         res = self._driver.send_and_receive(req, allow_resolution=True)
         assert isinstance(res, protocol.RecordList)
-        return res.records
+        return records + res.records
 
     def read_cypher_type_field(self, record_key, type_name, field_id):
         req = protocol.CypherTypeField(self._result.id, record_key, type_name,
@@ -55,8 +87,117 @@ class Result:
         return self._result.keys
 
     def __iter__(self):
+        while self._buffered:
+            record = self._next_buffered()
+            if isinstance(record, protocol.NullRecord):
+                return
+            yield record
+        if self._driver.result_batches:
+            yield from self._iter_batches()
+            return
+        if self._driver.pipelining:
+            yield from self._iter_pipelined()
+            return
         while True:
             record = self.next()
             if isinstance(record, protocol.NullRecord):
                 break
             yield record
+
+    def _iter_batches(self):
+        """Iterate fetching RESULT_BATCH_SIZE records per request."""
+        while True:
+            req = protocol.ResultNextBatch(self._result.id, RESULT_BATCH_SIZE)
+            batch = self._driver.send_and_receive(req, allow_resolution=True)
+            assert isinstance(batch, protocol.RecordBatch)
+            records = deque(batch.records)
+            try:
+                while records:
+                    yield records.popleft()
+            except GeneratorExit:
+                # the caller stopped iterating, keep the rest for later
+                self._buffered.extend(records)
+                if batch.endOfStream:
+                    self._buffered.append(protocol.NullRecord())
+                raise
+            if batch.endOfStream:
+                break
+
+    def _iter_pipelined(self):
+        """Iterate with several ResultNext requests in flight at a time.
+
+        Starts with one request in flight and allows one more for every
+        record received, up to PIPELINED_RESULT_NEXT_REQUESTS. So the number
+        of requests in flight doubles with every round trip, and short
+        results get few requests past their end.
+        """
+        request_ids = deque()
+        window = 1
+
+        def request_next():
+            while len(request_ids) < window:
+                req = protocol.ResultNext(self._result.id)
+                request_ids.append(self._driver.send(req, pipelined=True))
+
+        try:
+            request_next()
+            while True:
+                record = self._driver.receive(
+                    allow_resolution=True, request_id=request_ids.popleft()
+                )
+                if isinstance(record, protocol.NullRecord):
+                    break
+                window = min(window + 1, PIPELINED_RESULT_NEXT_REQUESTS)
+                request_next()
+                yield record
+        except GeneratorExit:
+            # the caller stopped iterating, keep the records for later
+            self._buffer_pipelined(request_ids)
+            raise
+        except BaseException:
+            self._discard_pipelined(request_ids)
+            raise
+        # The requests past the end of the result. Drivers may answer them
+        # with NullRecord or reject them, both is fine. Anything else, like
+        # the backend timing out, is not.
+        while request_ids:
+            try:
+                self._driver.receive(allow_resolution=True,
+                                     request_id=request_ids.popleft())
+            except protocol.BaseError:
+                pass
+
+    def _buffer_pipelined(self, request_ids):
+        # Receive the responses to the requests still in flight into the
+        # buffer, up to the end of the result or an error.
+        keep = True
+        while request_ids:
+            try:
+                response = self._driver.receive(
+                    allow_resolution=True, request_id=request_ids.popleft()
+                )
+            except protocol.BaseError as e:
+                response = e
+            except Exception:
+                # Give up, the backend connection is left with unanswered
+                # requests, so it won't be reused.
+                return
+            if keep:
+                self._buffered.append(response)
+                keep = not isinstance(response, (protocol.NullRecord,
+                                                 protocol.BaseError))
+
+    def _discard_pipelined(self, request_ids):
+        # Receive the responses to the requests still in flight without
+        # masking the exception being handled.
+        while request_ids:
+            try:
+                self._driver.receive(allow_resolution=True,
+                                     request_id=request_ids.popleft())
+            except protocol.BaseError:
+                # e.g., the error that ended the result again
+                continue
+            except Exception:
+                # Give up, the backend connection is left with unanswered
+                # requests, so it won't be reused.
+                return
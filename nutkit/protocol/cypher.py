@@ -22,6 +22,8 @@ import math
 class CypherNull:
     """Represents null/nil as sent/received to/from the database."""
 
+    __slots__ = ("value",)
+
     def __init__(self, value=None):
         self.value = None
 
@@ -36,6 +38,8 @@ class CypherNull:
 
 
 class CypherList:
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -50,6 +54,8 @@ class CypherList:
 
 
 class CypherMap:
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -64,6 +70,8 @@ class CypherMap:
 
 
 class CypherInt:
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -78,6 +86,8 @@ class CypherInt:
 
 
 class CypherBool:
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -98,6 +108,8 @@ class CypherFloat:
     than true float arithmetics.
     """
 
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
         if isinstance(value, float):
@@ -117,6 +129,8 @@ class CypherFloat:
 
 
 class CypherString:
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
@@ -131,6 +145,8 @@ class CypherString:
 
 
 class CypherBytes:
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
         if isinstance(value, (bytes, bytearray)):
@@ -214,10 +214,35 @@ class Feature(Enum):
     CONF_HINT_CON_RECV_TIMEOUT = "ConfHint:connection.recv_timeout_seconds"
 
     # === BACKEND FEATURES FOR TESTING ===
+    # The backend accepts requests framed as `#json <n>` on a line of its own,
+    # followed by n bytes of UTF-8 encoded JSON, and frames its responses to
+    # such requests the same way. Saves scanning for the `#request end` and
+    # `#response end` lines, which is slow for large requests and responses.
+    # TestKit keeps using the `#request begin`/`#request end` framing for
+    # backends that don't announce this feature.
+    BACKEND_LENGTH_PREFIXED_FRAMING = "Backend:LengthPrefixedFraming"
     # The backend understands the FakeTimeInstall, FakeTimeUninstall and
     # FakeTimeTick protocol messages and provides a way to mock the system
     # time. This is mainly used for testing various timeouts.
     BACKEND_MOCK_TIME = "Backend:MockTime"
+    # The backend understands the StartTests protocol message and decides
+    # whether to run the tests of a whole suite at once.
+    BACKEND_START_TESTS = "Backend:StartTests"
+    # The backend accepts requests carrying a `requestId` next to `name` and
+    # `data` in their envelope before it has responded to earlier ones. It
+    # tags its response to such a request with the same `requestId`.
+    # Responses without id (e.g., callbacks like ResolverResolutionRequired)
+    # are still allowed in between. TestKit uses this to send several
+    # ResultNext requests ahead when iterating over results.
+    BACKEND_PIPELINING = "Backend:Pipelining"
+    # The backend understands the ResultNextBatch protocol message. TestKit
+    # then iterates over results in batches of records instead of record by
+    # record.
+    BACKEND_RESULT_NEXT_BATCH = "Backend:ResultNextBatch"
+    # The backend understands the ResetBackend protocol message and can drop
+    # all state created through a connection. TestKit then reuses the
+    # connection for all tests instead of opening a new one for each test.
+    BACKEND_RESET = "Backend:Reset"
     # The backend understands the GetRoutingTable protocol message and provides
     # a way for TestKit to request the routing table (for testing only, should
     # not be exposed to the user).
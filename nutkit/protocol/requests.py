@@ -35,6 +35,21 @@ class StartTest:
         self.testName = test_name
 
 
+class StartTests:
+    """
+    Request the backend to decide for many tests at once whether to run them.
+
+    Only sent if the backend supports the Backend:StartTests feature. TestKit
+    sends it with the names of all tests of a suite before running them. It
+    then doesn't send StartTest for the tests the backend decided on.
+
+    The backend should respond with StartTestDecisions.
+    """
+
+    def __init__(self, test_names):
+        self.testNames = test_names
+
+
 class StartSubTest:
     """
     Request the backend to confirm to run a specific subtest.
@@ -58,6 +73,23 @@ class GetFeatures:
     """
 
 
+class ResetBackend:
+    """
+    Request the backend to drop everything created through this connection.
+
+    Only sent if the backend supports the Backend:Reset feature. TestKit
+    sends it after each test to keep using the connection for the next one.
+
+    The backend should close all drivers, sessions, transactions, etc. that
+    are still open and forget about all objects (including auth token
+    managers, bookmark managers, resolvers, and fake time) like it would
+    when the connection was closed. Then, it should respond with
+    BackendReset. If the backend can't restore a clean state, it should
+    respond with BackendError. TestKit then closes the connection and opens
+    a new one for the next test.
+    """
+
+
 class NewDriver:
     """
     Request to create a new driver instance on the backend.
@@ -660,6 +692,24 @@ class ResultNext:
         self.resultId = resultId
 
 
+class ResultNextBatch:
+    """
+    Request to retrieve up to batchSize next records of a result.
+
+    Only sent if the backend supports the Backend:ResultNextBatch feature.
+
+    Backend should respond with a RecordBatch holding the records it
+    retrieved, as if ResultNext had been sent batchSize times. If an error
+    occurs before retrieving any record, it should respond with the Error.
+    If the error occurs after some records, it should respond with those
+    records and the Error on the next request.
+    """
+
+    def __init__(self, resultId, batchSize):
+        self.resultId = resultId
+        self.batchSize = batchSize
+
+
 class ResultSingle:
     """
     Request to expect and return exactly one record in the result stream.
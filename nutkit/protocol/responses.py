@@ -48,6 +48,23 @@ class SkipTest:
         self.reason = reason
 
 
+class StartTestDecisions:
+    """
+    Response to StartTests.
+
+    Maps test names to the response StartTest would get for the test: a
+    RunTest, SkipTest, or RunSubTests. Tests missing in the mapping are
+    started with StartTest as usual.
+    """
+
+    def __init__(self, decisions):
+        self.decisions = decisions
+
+
+class BackendReset:
+    """Response to ResetBackend: the connection is as good as new."""
+
+
 class Driver:
     """Represents a driver instance on the backend."""
 
@@ -459,6 +476,23 @@ class RecordList:
         self.records = record_list
 
 
+class RecordBatch:
+    """Represents records returned from a ResultNextBatch request.
+
+    Fields:
+        records:
+            list of records like the `records` field of RecordList
+        endOfStream:
+            True if there are no more records after these, i.e., ResultNext
+            would respond with NullRecord.
+    """
+
+    def __init__(self, records, endOfStream):
+        self.records = [Record(values=record["values"])
+                        for record in records]
+        self.endOfStream = endOfStream
+
+
 class RecordOptional:
     """
     Represents an optional record.
@@ -6,6 +6,7 @@ import sys
 import unittest
 
 from tests.neo4j.shared import env_neo4j_version
+from tests.shared import fetch_test_decisions
 from tests.testenv import get_test_result_class
 
 # [bolt-version-bump] search tag when updating IT matrix
@@ -113,6 +114,7 @@ if __name__ == "__main__":
         resultclass=get_test_result_class(suite_name),
         verbosity=100, stream=sys.stdout,
     )
+    fetch_test_decisions(suite)
     result = runner.run(suite)
     if result.errors or result.failures:
         sys.exit(-1)
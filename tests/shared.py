@@ -7,9 +7,15 @@ Uses environment variables for configuration:
 
 TEST_BACKEND_HOST  Hostname of backend, default is localhost
 TEST_BACKEND_PORT  Port on backend host, default is 9876
+TEST_STUB_PORT_OFFSET
+                   Offset added to the stub server ports (9000-9999), default
+                   is 0. Set by the parallel stub test runner for each worker
+                   (see `tests.stub.parallel`).
 """
 
 
+import atexit
+import copy
 import enum
 import functools
 import inspect
@@ -19,6 +25,10 @@ import socket
 import unittest
 import warnings
 from contextlib import contextmanager
+from urllib.parse import (
+    urlsplit,
+    urlunsplit,
+)
 
 import ifaddr
 
@@ -32,12 +42,240 @@ def get_backend_host_and_port():
     return host, port
 
 
+# ports the stub tests use for their stub servers
+STUB_PORTS = range(9000, 10000)
+# host:port in a string, the host being a name, an IP, an IPv6 address in
+# brackets, or a stub script variable like #HOST#
+_PORT_RE = re.compile(r"(?<=[\w\].#-]):(\d{4,5})\b")
+
+
+def get_stub_port_offset():
+    return int(os.environ.get("TEST_STUB_PORT_OFFSET", 0))
+
+
+def _move_ports(text, ports, offset):
+    def move(match):
+        port = int(match.group(1))
+        if port not in ports:
+            return match.group(0)
+        return ":%i" % (port + offset)
+
+    return _PORT_RE.sub(move, text)
+
+
+def shift_stub_ports(text, offset=None):
+    """Move the stub server ports in addresses in `text` by the port offset.
+
+    Turns the addresses the tests are written with into the ones the stub
+    servers actually listen on.
+    """
+    if offset is None:
+        offset = get_stub_port_offset()
+    if not offset:
+        return text
+    return _move_ports(text, STUB_PORTS, offset)
+
+
+def unshift_stub_ports(text, offset=None):
+    """Undo :func:`shift_stub_ports`."""
+    if offset is None:
+        offset = get_stub_port_offset()
+    if not offset:
+        return text
+    shifted = range(STUB_PORTS.start + offset, STUB_PORTS.stop + offset)
+    return _move_ports(text, shifted, -offset)
+
+
+def _move_address(address, ports, offset):
+    # `address` is host:port
+    if not isinstance(address, str):
+        return address
+    host, _, port = address.rpartition(":")
+    if not host or not port.isdigit() or int(port) not in ports:
+        return address
+    return "%s:%i" % (host, int(port) + offset)
+
+
+def _move_uri_port(uri, ports, offset):
+    try:
+        parts = urlsplit(uri)
+        port = parts.port
+    except ValueError:
+        return uri
+    if port not in ports:
+        return uri
+    netloc = "%s:%i" % (parts.netloc.rpartition(":")[0], port + offset)
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+def _shift_request_addresses(request, offset):
+    # Only fields holding addresses are touched, not queries, parameters,
+    # bookmarks, and the like.
+    moved = None
+    if isinstance(request, protocol.NewDriver):
+        moved = {"uri": _move_uri_port(request.uri, STUB_PORTS, offset)}
+    elif isinstance(request, (protocol.ResolverResolutionCompleted,
+                              protocol.DomainNameResolutionCompleted)):
+        moved = {"addresses": [_move_address(a, STUB_PORTS, offset)
+                               for a in request.addresses]}
+    elif isinstance(request, protocol.GetConnectionPoolMetrics):
+        moved = {"address": _move_address(request.address, STUB_PORTS,
+                                          offset)}
+    if moved is None:
+        return request
+    # the test may still hold on to the request
+    request = copy.copy(request)
+    vars(request).update(moved)
+    return request
+
+
+def _unshift_response_addresses(response, offset):
+    shifted = range(STUB_PORTS.start + offset, STUB_PORTS.stop + offset)
+
+    def move(address):
+        return _move_address(address, shifted, -offset)
+
+    if isinstance(response, protocol.RoutingTable):
+        response.routers = list(map(move, response.routers))
+        response.readers = list(map(move, response.readers))
+        response.writers = list(map(move, response.writers))
+    elif isinstance(response, protocol.ResolverResolutionRequired):
+        response.address = move(response.address)
+    elif isinstance(response, protocol.ServerInfo):
+        response.address = move(response.address)
+    elif isinstance(response, protocol.Summary):
+        response.server_info.address = move(response.server_info.address)
+    elif isinstance(response, protocol.EagerResult):
+        response.summary.server_info.address = move(
+            response.summary.server_info.address
+        )
+    return response
+
+
 def new_backend():
     """Return connection to backend, caller is responsible for closing."""
     host, port = get_backend_host_and_port()
+    offset = get_stub_port_offset()
+    if offset:
+        # The tests keep using the ports they're written with. Only the
+        # addresses the driver gets to see are moved to the ports the stub
+        # servers listen on.
+        return Backend(
+            host, port,
+            request_filter=functools.partial(_shift_request_addresses,
+                                             offset=offset),
+            response_filter=functools.partial(_unshift_response_addresses,
+                                              offset=offset)
+        )
     return Backend(host, port)
 
 
+class _BackendPool:
+    """Backend connections shared by the tests of the test run.
+
+    Backends supporting `Backend:Reset` are reset after each test and their
+    connection is reused by the next test. Other backends get a new
+    connection for each test.
+    """
+
+    def __init__(self):
+        self._idle = []
+        # all connections are to the same backend, so they share its features
+        self._features = None
+        atexit.register(self.close)
+
+    def acquire(self):
+        while self._idle:
+            backend = self._idle.pop()
+            if backend.is_idle():
+                return backend
+            self._discard(backend)
+        backend = new_backend()
+        backend.features = self._features
+        return backend
+
+    def release(self, backend):
+        if backend.features is not None:
+            self._features = backend.features
+        if self._reset(backend):
+            self._idle.append(backend)
+        else:
+            backend.close()
+
+    @staticmethod
+    def _reset(backend):
+        features = backend.features
+        if not features or protocol.Feature.BACKEND_RESET not in features:
+            return False
+        if not backend.is_idle():
+            # e.g., a test failed waiting for a response
+            return False
+        try:
+            response = backend.send_and_receive(protocol.ResetBackend())
+        except Exception as e:
+            warnings.warn(f"Could not reset backend: {e}")  # noqa: B028
+            return False
+        return isinstance(response, protocol.BackendReset)
+
+    @staticmethod
+    def _discard(backend):
+        try:
+            backend.close()
+        except OSError:
+            pass  # already gone
+
+    def close(self):
+        while self._idle:
+            self._discard(self._idle.pop())
+
+
+_backend_pool = _BackendPool()
+
+
+def iter_tests(suite):
+    """Yield the test cases of a (nested) test suite."""
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from iter_tests(test)
+        else:
+            yield test
+
+
+def get_testkit_test_name(test):
+    return re.sub(r"^([^\.]+\.)*?tests\.", "", test.id())
+
+
+# test name -> RunTest, SkipTest, or RunSubTests, see `fetch_test_decisions`
+_test_decisions = {}
+
+
+def fetch_test_decisions(suite):
+    """Ask the backend up front whether to run the tests of `suite`.
+
+    Tests the backend decided on don't ask it again when started. Tests it
+    skips are skipped before connecting to the backend or setting up
+    anything else. Only for backends supporting `Backend:StartTests`.
+    """
+    try:
+        backend = _backend_pool.acquire()
+    except Exception as e:
+        # leave it to the tests to report
+        warnings.warn(f"Could not fetch test decisions: {e}")  # noqa: B028
+        return
+    try:
+        features = get_driver_features(backend)
+        if protocol.Feature.BACKEND_START_TESTS not in features:
+            return
+        names = [get_testkit_test_name(test) for test in iter_tests(suite)]
+        response = backend.send_and_receive(protocol.StartTests(names))
+        if not isinstance(response, protocol.StartTestDecisions):
+            raise Exception("Should be StartTestDecisions, received {}: {}"
+                            .format(type(response), response))
+        _test_decisions.update(response.decisions)
+    finally:
+        _backend_pool.release(backend)
+
+
 def get_ip_addresses(exclude_loopback=True):
     def pick_address(adapter_):
         ip6 = None
@@ -100,26 +338,17 @@ def driver_feature(*features):
     return driver_feature_decorator
 
 
-class MemoizedSupplier:
-    """Memoize the function it annotates.
+def get_driver_features(backend):
+    """Return the features of the driver behind `backend`.
 
-    This way the decorated function will always return the
-    same value of the first interaction independent of the
-    supplied params.
+    Fetched only once, the backend connection keeps them.
     """
+    if backend.features is None:
+        backend.features = _fetch_driver_features(backend)
+    return backend.features
 
-    def __init__(self, func):
-        self._func = func
-        self._memo = None
-
-    def __call__(self, *args, **kwargs):
-        if self._memo is None:
-            self._memo = self._func(*args, **kwargs)
-        return self._memo
 
-
-@MemoizedSupplier
-def get_driver_features(backend):
+def _fetch_driver_features(backend):
     try:
         response = backend.send_and_receive(protocol.GetFeatures())
         if not isinstance(response, protocol.FeatureList):
@@ -150,18 +379,30 @@ class TestkitTestCase(unittest.TestCase):
 
     def setUp(self):
         super().setUp()
-        self._testkit_test_name = id_ = re.sub(
-            r"^([^\.]+\.)*?tests\.", "", self.id()
-        )
+        self._testkit_test_name = id_ = get_testkit_test_name(self)
         self._check_subtests = False
-        self._backend = new_backend()
-        self.addCleanup(self._backend.close)
+        response = _test_decisions.get(id_)
+        if isinstance(response, protocol.SkipTest):
+            self.skipTest(response.reason)
+        self._backend = _backend_pool.acquire()
+        self.addCleanup(_backend_pool.release, self._backend)
         self._driver_features = get_driver_features(self._backend)
+        if (protocol.Feature.BACKEND_LENGTH_PREFIXED_FRAMING
+                in self._driver_features):
+            self._backend.length_prefixed_framing = True
+        if protocol.Feature.BACKEND_PIPELINING in self._driver_features:
+            self._backend.pipelining = True
+        if (protocol.Feature.BACKEND_RESULT_NEXT_BATCH
+                in self._driver_features):
+            self._backend.result_batches = True
 
         if self.required_features:
             self.skip_if_missing_driver_features(*self.required_features)
 
-        response = self._backend.send_and_receive(protocol.StartTest(id_))
+        if response is None:
+            response = self._backend.send_and_receive(
+                protocol.StartTest(id_)
+            )
         if isinstance(response, protocol.SkipTest):
             self.skipTest(response.reason)
         elif isinstance(response, protocol.RunSubTests):
@@ -0,0 +1,277 @@
+"""Runs the stub tests in several worker processes.
+
+The test classes are sharded across the workers. Each worker runs its tests
+with its own backend connections and its own range of stub server ports by
+setting TEST_STUB_PORT_OFFSET (see `tests.shared`), so the workers' stub
+servers don't get into each other's way. Hence, the backend must accept
+several connections at the same time.
+
+Workers report each test as a line of JSON on stdout. These are replayed
+into the result of the main process, so the output looks the same as when
+running the tests in one process, except that the output a test prints is
+only shown as part of its failure details.
+
+Usage (through `tests.stub.suites`):
+  TEST_STUB_WORKERS=4 python -m tests.stub.suites
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from queue import Queue
+from threading import Thread
+
+from tests.shared import (
+    fetch_test_decisions,
+    iter_tests,
+)
+
+PORT_OFFSET_STEP = 1000
+_RESULT_PREFIX = "#result "
+
+
+def get_worker_count():
+    return int(os.environ.get("TEST_STUB_WORKERS", 1))
+
+
+def _describe(test):
+    return {"id": test.id(), "str": str(test),
+            "doc": test.shortDescription()}
+
+
+class _RecordingResult(unittest.TestResult):
+    """Writes the outcome of each test to `stream` as a line of JSON."""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.buffer = True
+        self._stream = stream
+        self._record = None
+
+    def _current(self, test):
+        if self._record is None:
+            # class or module fixture errors happen outside of any test
+            return {"test": _describe(test), "started": False,
+                    "outcomes": []}
+        return self._record
+
+    def _add(self, test, outcome):
+        record = self._current(test)
+        record["outcomes"].append(outcome)
+        if record is not self._record:
+            self._write(record)
+
+    def _write(self, record):
+        self._stream.write(_RESULT_PREFIX + json.dumps(record) + "\n")
+        self._stream.flush()
+
+    def startTest(self, test):  # noqa: N802
+        super().startTest(test)
+        self._record = {"test": _describe(test), "started": True,
+                        "outcomes": []}
+
+    def _restoreStdout(self):  # noqa: N802
+        # The captured output is part of the reported errors already, don't
+        # print it a second time.
+        self._mirrorOutput = False
+        super()._restoreStdout()
+
+    def stopTest(self, test):  # noqa: N802
+        super().stopTest(test)
+        self._write(self._record)
+        self._record = None
+
+    def addSuccess(self, test):  # noqa: N802
+        super().addSuccess(test)
+        self._add(test, ["success"])
+
+    def addError(self, test, err):  # noqa: N802
+        super().addError(test, err)
+        self._add(test, ["error", self.errors[-1][1]])
+
+    def addFailure(self, test, err):  # noqa: N802
+        super().addFailure(test, err)
+        self._add(test, ["failure", self.failures[-1][1]])
+
+    def addSkip(self, test, reason):  # noqa: N802
+        super().addSkip(test, reason)
+        self._add(test, ["skip", reason])
+
+    def addExpectedFailure(self, test, err):  # noqa: N802
+        super().addExpectedFailure(test, err)
+        self._add(test, ["expectedFailure", self.expectedFailures[-1][1]])
+
+    def addUnexpectedSuccess(self, test):  # noqa: N802
+        super().addUnexpectedSuccess(test)
+        self._add(test, ["unexpectedSuccess"])
+
+    def addSubTest(self, test, subtest, err):  # noqa: N802
+        super().addSubTest(test, subtest, err)
+        if err is None:
+            self._add(test, ["subTest", _describe(subtest), None])
+        elif issubclass(err[0], test.failureException):
+            self._add(test, ["subTest", _describe(subtest),
+                             ["failure", self.failures[-1][1]]])
+        else:
+            self._add(test, ["subTest", _describe(subtest),
+                             ["error", self.errors[-1][1]]])
+
+
+class _RemoteTest:
+    """Stands in for a test that ran in a worker."""
+
+    failureException = AssertionError  # noqa: N815
+
+    def __init__(self, description):
+        self._description = description
+
+    def id(self):
+        return self._description["id"]
+
+    def shortDescription(self):  # noqa: N802
+        return self._description["doc"]
+
+    def __str__(self):
+        return self._description["str"]
+
+
+def _remote_err(kind, text):
+    # exc_info like tuple whose formatting is already done by the worker
+    if kind == "failure":
+        return AssertionError, text, None
+    return Exception, text, None
+
+
+def replaying(result_class):
+    """Extend `result_class` to accept the errors reported by workers."""
+    class ReplayingResult(result_class):
+        def _exc_info_to_string(self, err, test):
+            if err[2] is None and isinstance(err[1], str):
+                return err[1]
+            return super()._exc_info_to_string(err, test)
+
+    return ReplayingResult
+
+
+def _replay(result, record):
+    test = _RemoteTest(record["test"])
+    if record["started"]:
+        result.startTest(test)
+    for outcome in record["outcomes"]:
+        kind = outcome[0]
+        if kind == "success":
+            result.addSuccess(test)
+        elif kind == "error":
+            result.addError(test, _remote_err(kind, outcome[1]))
+        elif kind == "failure":
+            result.addFailure(test, _remote_err(kind, outcome[1]))
+        elif kind == "skip":
+            result.addSkip(test, outcome[1])
+        elif kind == "expectedFailure":
+            result.addExpectedFailure(test, _remote_err(kind, outcome[1]))
+        elif kind == "unexpectedSuccess":
+            result.addUnexpectedSuccess(test)
+        elif kind == "subTest":
+            err = outcome[2] and _remote_err(*outcome[2])
+            result.addSubTest(test, _RemoteTest(outcome[1]), err)
+    if record["started"]:
+        result.stopTest(test)
+
+
+def _shard(suite, index, count):
+    """Return the tests of every `count`-th test class, from `index` on."""
+    classes = {}
+    tests = list(iter_tests(suite))
+    for test in tests:
+        classes.setdefault(type(test), len(classes))
+    return unittest.TestSuite(
+        test for test in tests if classes[type(test)] % count == index
+    )
+
+
+class ParallelSuite:
+    """Runs the stub tests in `workers` worker processes.
+
+    Can be passed to `unittest.TextTestRunner.run` in place of a test suite.
+    """
+
+    def __init__(self, workers):
+        self._workers = workers
+
+    def _start_worker(self, index, tmp_dir):
+        env = dict(os.environ)
+        env["TEST_STUB_PORT_OFFSET"] = str(index * PORT_OFFSET_STEP)
+        env["PYTHONIOENCODING"] = "utf-8"
+        # stub scripts are rewritten into the temp dir under fixed names
+        env["TMPDIR"] = env["TEMP"] = env["TMP"] = tmp_dir
+        return subprocess.Popen(
+            [sys.executable, "-m", "tests.stub.parallel",
+             str(index), str(self._workers)],
+            env=env, stdout=subprocess.PIPE, encoding="utf-8"
+        )
+
+    def __call__(self, result):
+        queue = Queue()
+        tmp_dirs = [tempfile.mkdtemp(prefix="testkit-stub-%i-" % i)
+                    for i in range(self._workers)]
+        workers = [self._start_worker(i, tmp_dir)
+                   for i, tmp_dir in enumerate(tmp_dirs)]
+
+        def read(index, pipe):
+            for line in iter(pipe.readline, ""):
+                queue.put((index, line))
+            queue.put((index, None))
+
+        for index, worker in enumerate(workers):
+            Thread(target=read, daemon=True,
+                   args=(index, worker.stdout)).start()
+        try:
+            running = len(workers)
+            while running:
+                index, line = queue.get()
+                if line is None:
+                    running -= 1
+                    self._check_exit(result, index, workers[index].wait())
+                elif line.startswith(_RESULT_PREFIX):
+                    _replay(result,
+                            json.loads(line[len(_RESULT_PREFIX):]))
+                else:
+                    result.stream.write(line)
+                    result.stream.flush()
+        finally:
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.kill()
+                    worker.wait()
+            for tmp_dir in tmp_dirs:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        return result
+
+    @staticmethod
+    def _check_exit(result, index, exit_code):
+        if exit_code == 0:
+            return
+        _replay(result, {
+            "test": {"id": "tests.stub.parallel.worker%i" % index,
+                     "str": "stub test worker %i" % index, "doc": None},
+            "started": True,
+            "outcomes": [["error", "Worker exited with %i before finishing "
+                                   "its tests\n" % exit_code]],
+        })
+
+
+def _run_worker(index, count):
+    from tests.stub.suites import stub_suite
+
+    stream = sys.stdout
+    suite = _shard(stub_suite, index, count)
+    fetch_test_decisions(suite)
+    suite.run(_RecordingResult(stream))
+
+
+if __name__ == "__main__":
+    _run_worker(int(sys.argv[1]), int(sys.argv[2]))
@@ -1,23 +1,60 @@
 """Shared utilities for writing stub tests.
 
 Uses environment variables for configuration:
+  TEST_STUB_HOST     host the stub servers are reachable at from the driver
+  TEST_STUB_DAEMON   run the stub servers in a stub server daemon
+                     (`python -m boltstub.daemon`) instead of starting a
+                     process per stub server. Set to `1` to start one or to
+                     the control socket path of a running daemon. For a
+                     daemon listening on a `HOST:PORT` TCP address, set
+                     BOLTSTUB_DAEMON_TOKEN to the daemon's token as well.
+  TEST_STUB_IN_PROCESS
+                     set to `1` to run the stub servers in threads of the
+                     test process itself. Takes precedence over
+                     TEST_STUB_DAEMON.
+  TEST_STUB_TIMING   set to `1` to report the time spent waiting for the
+                     stub servers to catch up with the driver at exit.
+  TEST_STUB_PORT_OFFSET
+                     see `tests.shared`. The stub servers listen on their
+                     port plus the offset while tests keep using the port
+                     they're written with.
+
+Instead of a fixed port, stub servers can be given port 0 to listen on a free
+port, and a name for the scripts of other stub servers to refer to them by,
+see `StubServer`.
 """
 
+import atexit
 import errno
+import itertools
+import json
 import os
 import platform
 import re
+import secrets
 import signal
+import socket
 import subprocess
 import sys
 import tempfile
 import time
+import weakref
 from queue import (
     Empty,
     Queue,
 )
 from textwrap import wrap
-from threading import Thread
+from threading import (
+    Lock,
+    Thread,
+)
+
+from tests.shared import (
+    get_stub_port_offset,
+    shift_stub_ports,
+    STUB_PORTS,
+    unshift_stub_ports,
+)
 
 if platform.system() == "Windows":
     INTERRUPT = signal.CTRL_BREAK_EVENT
@@ -47,11 +84,370 @@ def _poll_pipe(pipe, queue):
     pipe.close()
 
 
+# last events of a connection on which the server has caught up with the
+# driver
+_REST_EVENTS = frozenset(("<WAITING>", "<FINISHED>", "<HANGUP>"))
+# Time the conversation has to stay settled before waiting for it ends.
+# Covers the driver sending more right after the server caught up.
+_REST_CONFIRMATION_PERIOD = 0.01
+
+
+class _Conversation:
+    """Messages exchanged by a stub server, indexed by direction and name.
+
+    Built incrementally from the server's conversation events (see
+    `boltstub.events`). A message is represented by its name followed by its
+    fields, e.g., `'RUN "RETURN 1 AS n" {} {}'`.
+
+    The conversation has settled since a position when the server has caught
+    up with the client on all connections after that position.
+
+    Addresses in the messages are moved back by `port_offset` (see
+    `tests.shared.shift_stub_ports`).
+    """
+
+    def __init__(self, port_offset=0):
+        self._port_offset = port_offset
+        self._count = 0
+        self._messages = []
+        # direction -> name -> [(position, message)]
+        self._index = {"C": {}, "S": {}}
+        self._busy_connections = set()
+        # connection -> (position, name) of its last event
+        self._last_events = {}
+
+    def __len__(self):
+        return self._count
+
+    def settled_since(self, position):
+        """Whether the server has caught up since the event at `position`.
+
+        A connection whose last event is older might have data from the
+        driver the server hasn't woken up to yet, unless it's hung up.
+        """
+        if self._count <= position or self._busy_connections:
+            return False
+        return all(name == "<HANGUP>" or event_position > position
+                   for event_position, name in self._last_events.values())
+
+    def extend(self, events):
+        for event in events:
+            self._count += 1
+            self._last_events[event["connection"]] = (self._count,
+                                                      event["name"])
+            if event["name"] in _REST_EVENTS:
+                self._busy_connections.discard(event["connection"])
+                if event["name"] == "<WAITING>":
+                    continue
+            else:
+                self._busy_connections.add(event["connection"])
+            message = event["name"]
+            if event["fields"]:
+                message += " " + unshift_stub_ports(event["fields"],
+                                                    self._port_offset)
+            self._index[event["direction"]].setdefault(
+                event["name"], []
+            ).append((self._count, message))
+            self._messages.append((event["direction"], message))
+
+    def _candidates(self, direction, pattern):
+        by_name = self._index[direction]
+        if isinstance(pattern, re.Pattern):
+            return list(by_name.values())
+        # only messages of these names can start with the pattern
+        return [messages for name, messages in by_name.items()
+                if name.startswith(pattern) or pattern.startswith(name)]
+
+    def find(self, direction, pattern):
+        """Messages in the direction matching or starting with the pattern."""
+        candidates = self._candidates(direction, pattern)
+        if len(candidates) == 1:
+            found = candidates[0]
+        else:
+            found = sorted(itertools.chain.from_iterable(candidates))
+        if isinstance(pattern, re.Pattern):
+            return [message for _, message in found if pattern.match(message)]
+        return [message for _, message in found
+                if message.startswith(pattern)]
+
+    def count(self, direction, pattern):
+        if not isinstance(pattern, re.Pattern):
+            messages = self._index[direction].get(pattern)
+            if messages is not None and len(self._candidates(
+                direction, pattern
+            )) == 1:
+                # all messages of the name match and no others
+                return len(messages)
+        return len(self.find(direction, pattern))
+
+    def messages(self):
+        """All messages in order as (direction, message) tuples."""
+        return list(self._messages)
+
+
+class _EventsReader:
+    """Reads the events a stub server process writes to its events file."""
+
+    def __init__(self, path, conversation):
+        self._file = open(path, "rb")
+        self._conversation = conversation
+        self._partial_line = b""
+
+    def read(self):
+        data = self._partial_line + self._file.read()
+        lines = data.split(b"\n")
+        self._partial_line = lines.pop()
+        self._conversation.extend(json.loads(line) for line in lines)
+
+    def close(self):
+        self._file.close()
+
+
+# environment variable holding the token of a daemon listening on TCP
+_DAEMON_TOKEN_ENV = "BOLTSTUB_DAEMON_TOKEN"
+
+
+class _StubDaemon:
+    """Control connection to a stub server daemon.
+
+    :param address: path of the daemon's control socket, or its `HOST:PORT`
+        address if it listens on TCP. Then `token` (by default the one in
+        the environment) is needed to authenticate.
+    """
+
+    def __init__(self, address, token=None):
+        host, _, port = address.rpartition(":")
+        tcp = bool(host) and port.isdigit()
+        if tcp:
+            token = token or os.environ.get(_DAEMON_TOKEN_ENV)
+            if not token:
+                raise StubServerError(
+                    "Set %s to connect to the stub server daemon at %s"
+                    % (_DAEMON_TOKEN_ENV, address)
+                )
+            self._socket = socket.create_connection((host, int(port)))
+        else:
+            self._socket = socket.socket(socket.AF_UNIX)
+            self._socket.connect(address)
+        self._file = self._socket.makefile("rwb")
+        self._lock = Lock()
+        if tcp:
+            self.request("Authenticate", token=token)
+
+    @classmethod
+    def spawn(cls):
+        args = [sys.executable, "-m", "boltstub.daemon"]
+        env = None
+        token = None
+        if not hasattr(socket, "AF_UNIX"):
+            token = secrets.token_hex(32)
+            args += ["-l", "127.0.0.1:0"]
+            env = dict(os.environ, **{_DAEMON_TOKEN_ENV: token})
+        process = subprocess.Popen(
+            args, **POPEN_EXTRA_KWARGS, env=env,
+            stdout=subprocess.PIPE, close_fds=True, encoding="utf-8"
+        )
+        atexit.register(process.terminate)
+        line = process.stdout.readline()
+        if not line.startswith("Listening on "):
+            process.kill()
+            raise StubServerError("Stub server daemon failed to start")
+        Thread(target=_poll_pipe, daemon=True,
+               args=(process.stdout, Queue())).start()
+        return cls(line[len("Listening on "):].strip(), token=token)
+
+    def request(self, name, **data):
+        with self._lock:
+            self._file.write(json.dumps({"name": name, "data": data})
+                             .encode("utf-8") + b"\n")
+            self._file.flush()
+            response = json.loads(self._file.readline())
+        if response["name"] == "DaemonError":
+            raise StubServerError(
+                "Stub server daemon error: %s" % response["data"]["msg"]
+            )
+        return response["data"]
+
+
+class _InProcessDaemon:
+    """Stub server daemon running in the test process.
+
+    Offers the interface of `_StubDaemon` without a control connection.
+    """
+
+    def __init__(self):
+        # only needed (and importable) when running in-process
+        from boltstub.caching import get_script_cache
+        from boltstub.daemon import StubDaemon
+
+        cache = get_script_cache()
+        self._stub_daemon = StubDaemon(cache=cache)
+        atexit.register(self._stub_daemon.reset)
+        if cache is not None:
+            atexit.register(cache.print_stats)
+
+    def request(self, name, **data):
+        try:
+            return self._stub_daemon.handle(name, data)[1]
+        except ValueError as e:
+            raise StubServerError("Stub server daemon error: %s" % e) from e
+
+
+_daemon = None
+_daemon_lock = Lock()
+
+
+def _env_flag(name):
+    return os.environ.get(name, "").strip().lower() in ("1", "true")
+
+
+def _get_daemon():
+    global _daemon
+    setting = os.environ.get("TEST_STUB_DAEMON", "").strip()
+    in_process = _env_flag("TEST_STUB_IN_PROCESS")
+    if not in_process and setting.lower() in ("", "0", "false"):
+        return None
+    with _daemon_lock:
+        if _daemon is None:
+            if in_process:
+                _daemon = _InProcessDaemon()
+            elif setting.lower() in ("1", "true"):
+                _daemon = _StubDaemon.spawn()
+            else:
+                _daemon = _StubDaemon(setting)
+        return _daemon
+
+
+class _RestWaitStats:
+    """Time spent waiting for conversations to come to rest.
+
+    Reported at exit when TEST_STUB_TIMING is set, together with the least
+    time waiting for `silence_period` seconds of silence would have taken.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.waits = 0
+        self.waited = 0.
+        self.silence = 0.
+
+    def add(self, waited, silence_period):
+        with self._lock:
+            self.waits += 1
+            self.waited += waited
+            self.silence += silence_period
+
+    def report(self):
+        if not self.waits:
+            return
+        print(
+            "Stub servers: waited %.2fs for %i conversations to come to "
+            "rest. Waiting for silence would have taken at least %.2fs "
+            "(%.2fs saved)."
+            % (self.waited, self.waits, self.silence,
+               self.silence - self.waited)
+        )
+
+
+_rest_wait_stats = _RestWaitStats()
+if _env_flag("TEST_STUB_TIMING"):
+    atexit.register(_rest_wait_stats.report)
+
+
+class _DaemonProcess:
+    """Stand-in for the process of a stub server run by the daemon.
+
+    Provides the part of the `Popen` interface `StubServer` uses. Output is
+    fetched from the daemon with every request and put into the queues the
+    pipe polling threads would fill. Its conversation events are added to the
+    conversation.
+    """
+
+    def __init__(self, daemon, stdout_buffer, stderr_buffer, conversation,
+                 **start_data):
+        self._daemon = daemon
+        self._conversation = conversation
+        self._stdout_buffer = stdout_buffer
+        self._stderr_buffer = stderr_buffer
+        self._stdout_count = 0
+        self._stderr_count = 0
+        self.returncode = None
+        self._id = None
+        self._update(daemon.request("StartServer", **start_data))
+
+    def _update(self, status):
+        self._id = status["serverId"]
+        for line in status["stdout"]:
+            self._stdout_buffer.put(line)
+        for line in status["stderr"]:
+            self._stderr_buffer.put(line)
+        self._stdout_count = status["stdoutNext"]
+        self._stderr_count = status["stderrNext"]
+        self._conversation.extend(status["events"])
+        self.returncode = status["exitCode"]
+        return self.returncode
+
+    def _request(self, name, **data):
+        return self._update(self._daemon.request(
+            name, serverId=self._id, stdoutFrom=self._stdout_count,
+            stderrFrom=self._stderr_count,
+            eventsFrom=len(self._conversation), **data
+        ))
+
+    def poll(self):
+        return self._request("GetServerStatus")
+
+    def wait(self, timeout=30):
+        return self._request("GetServerStatus", timeout=timeout)
+
+    def wait_for_events(self, timeout):
+        self._request("GetServerStatus", eventsTimeout=timeout)
+
+    def interrupt(self):
+        self._request("InterruptServer")
+
+    def kill(self):
+        self._request("KillServer")
+
+    def release(self):
+        self._request("ReleaseServer")
+
+
+def _get_listening_port(lines):
+    """Port the stub server reported to listen on, None if not yet."""
+    for line in lines:
+        if line.startswith("Listening on "):
+            return int(line.rstrip().rpartition(":")[2])
+    return None
+
+
+# Named stub servers, see `StubServer`
+_servers = weakref.WeakValueDictionary()
+# References to named stub servers in scripts: #ADDRESS:name#, #PORT:name#
+_SERVER_VAR_RE = re.compile(r"#(ADDRESS|PORT):([\w.-]+)#")
+
+
 class StubServer:
-    def __init__(self, port):
+    """A stub server for a test to talk to through the driver.
+
+    :param port: port to listen on. `0` lets the OS pick a free port when
+        the server is started first. The server reports the port it listens
+        on, so `port` and `address` are only known from then on. The server
+        keeps that port when restarted.
+    :param name: name scripts of other stub servers can refer to this server
+        by. `#ADDRESS:name#` and `#PORT:name#` are replaced with its address
+        and port when starting those servers, so it must have been started
+        before if it was created with port `0`. The last stub server created
+        with a name takes it.
+    """
+
+    def __init__(self, port, name=None):
         self.host = os.environ.get("TEST_STUB_HOST", "127.0.0.1")
-        self.address = "%s:%d" % (self.host, port)
-        self.port = port
+        self.name = name
+        self._port = port
+        self._port_offset = get_stub_port_offset()
+        if name is not None:
+            _servers[name] = self
         self._process = None
         self._stdout_buffer = Queue()
         self._stdout_lines = []
@@ -60,6 +456,45 @@ class StubServer:
         self._pipes_closed = False
         self._script_path = None
         self._last_rewritten_path = None
+        self._conversation = _Conversation(self._port_offset)
+        self._events_path = None
+        self._events_reader = None
+
+    @property
+    def port(self):
+        if not self._port:
+            raise StubServerError(
+                "Stub server %s has no port before it is started"
+                % (self.name or "with port 0")
+            )
+        return self._port
+
+    @property
+    def address(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def _listen_address(self):
+        port = self._port
+        if port in STUB_PORTS:
+            port += self._port_offset
+        return "0.0.0.0:%d" % port
+
+    def _rewrite_script(self, script, vars_):
+        for v in vars_ or ():
+            script = script.replace(v, str(vars_[v]))
+
+        def resolve(match):
+            try:
+                server = _servers[match.group(2)]
+            except KeyError:
+                raise ValueError("Script refers to unknown stub server %r"
+                                 % match.group(2)) from None
+            if match.group(1) == "PORT":
+                return str(server.port)
+            return server.address
+
+        script = _SERVER_VAR_RE.sub(resolve, script)
+        return shift_stub_ports(script, self._port_offset)
 
     def start(self, path=None, script=None, vars_=None):
         if self._process:
@@ -70,20 +505,24 @@ class StubServer:
         self._stderr_buffer = Queue()
         self._stderr_lines = []
         self._pipes_closed = False
+        self._conversation = _Conversation(self._port_offset)
 
         if path and script:
             raise ValueError("Specify either path or script.")
 
         script_fn = "temp.script"
         self._last_rewritten_path = None
-        if vars_:
-            if path:
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                original = f.read()
+            script = self._rewrite_script(original, vars_)
+            if script == original:
+                script = None
+            else:
                 self._last_rewritten_path = path
                 script_fn = os.path.basename(path)
-                with open(path, "r", encoding="utf-8") as f:
-                    script = f.read()
-            for v in vars_:
-                script = script.replace(v, str(vars_[v]))
+        else:
+            script = self._rewrite_script(script, vars_)
         if script:
             tempdir = tempfile.gettempdir()
             path = os.path.join(tempdir, script_fn)
@@ -93,32 +532,51 @@ class StubServer:
                 os.fsync(f)
             self._script_path = path
 
-        self._process = subprocess.Popen(
-            [
-                sys.executable, "-m", "boltstub", "-l",
-                "0.0.0.0:%d" % self.port, "-v", path
-            ],
-            **POPEN_EXTRA_KWARGS,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True,
-            encoding="utf-8"
-        )
+        daemon = _get_daemon()
+        if daemon is not None:
+            if not script:
+                with open(path, "r", encoding="utf-8") as f:
+                    script = f.read()
+            self._process = _DaemonProcess(
+                daemon, self._stdout_buffer, self._stderr_buffer,
+                self._conversation, script=script,
+                listenAddr=self._listen_address(),
+                filename=path
+            )
+        else:
+            fd, self._events_path = tempfile.mkstemp(suffix=".events")
+            os.close(fd)
+            self._events_reader = _EventsReader(self._events_path,
+                                                self._conversation)
+            self._process = subprocess.Popen(
+                [
+                    sys.executable, "-m", "boltstub", "-l",
+                    self._listen_address(), "-v",
+                    "--events", self._events_path, path
+                ],
+                **POPEN_EXTRA_KWARGS,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True, encoding="utf-8"
+            )
 
-        Thread(target=_poll_pipe,
-               daemon=True,
-               args=(self._process.stdout, self._stdout_buffer)).start()
-        Thread(target=_poll_pipe,
-               daemon=True,
-               args=(self._process.stderr, self._stderr_buffer)).start()
+            Thread(target=_poll_pipe,
+                   daemon=True,
+                   args=(self._process.stdout, self._stdout_buffer)).start()
+            Thread(target=_poll_pipe,
+                   daemon=True,
+                   args=(self._process.stderr, self._stderr_buffer)).start()
 
         # Wait until something is written to know it started, requires
         polls = 100
         self._read_pipes()
         while (self._process.poll() is None
                and polls
-               and "Listening\n" not in self._stdout_lines):
+               and _get_listening_port(self._stdout_lines) is None):
             time.sleep(0.1)
             self._read_pipes()
             polls -= 1
+        if not self._port:
+            self._port = _get_listening_port(self._stdout_lines)
 
         # Double check that the process started, a missing script would exit
         # process immediately
@@ -144,12 +602,32 @@ class StubServer:
             self._script_path = None
 
     def _clean_up(self):
-        if self._process:
+        if isinstance(self._process, _DaemonProcess):
+            try:
+                self._process.release()
+            except (OSError, ValueError, StubServerError):
+                # daemon gone, e.g., at interpreter shutdown
+                pass
+        elif self._process:
             self._process.kill()
+            self._process.wait()
         self._process = None
         self._rm_tmp_script()
+        if self._events_reader:
+            self._events_reader.close()
+            self._events_reader = None
+        if self._events_path:
+            try:
+                os.remove(self._events_path)
+            except OSError:
+                pass
+            self._events_path = None
 
     def _read_pipes(self):
+        if isinstance(self._process, _DaemonProcess):
+            self._process.poll()
+        elif self._events_reader:
+            self._events_reader.read()
         while True:
             try:
                 self._stdout_lines.append(self._stdout_buffer.get(False))
@@ -166,15 +644,17 @@ class StubServer:
             print(f"Original stub script file: {self._last_rewritten_path}")
         self._read_pipes()
         sys.stdout.flush()
-        print(">>>> Captured stub server %s stdout" % self.address)
+        # don't allocate a port just for this
+        address = "%s:%d" % (self.host, self._port)
+        print(">>>> Captured stub server %s stdout" % address)
         for line in self._stdout_lines:
             print(line, end="")
-        print("<<<< Captured stub server %s stdout" % self.address)
+        print("<<<< Captured stub server %s stdout" % address)
 
-        print(">>>> Captured stub server %s stderr" % self.address)
+        print(">>>> Captured stub server %s stderr" % address)
         for line in self._stderr_lines:
             print(line, end="")
-        print("<<<< Captured stub server %s stderr" % self.address)
+        print("<<<< Captured stub server %s stderr" % address)
 
         # self._close_pipes()
         sys.stdout.flush()
@@ -189,6 +669,8 @@ class StubServer:
         self._clean_up()
 
     def _poll(self, timeout):
+        if isinstance(self._process, _DaemonProcess):
+            return self._process.wait(timeout) is not None
         polls = int(timeout * 50)
         while True:
             self._process.poll()
@@ -203,6 +685,9 @@ class StubServer:
         return False
 
     def _interrupt(self, timeout=5.):
+        if isinstance(self._process, _DaemonProcess):
+            self._process.interrupt()
+            return self._poll(timeout)
         try:
             os.kill(self._process.pid, INTERRUPT)
         except OSError as e:
@@ -280,23 +765,45 @@ class StubServer:
             self._interrupt(0)
             self._kill()
 
-    def _wait_for_silence(self, seconds, max_wait_seconds=5):
-        max_wait = int(max_wait_seconds / (seconds / 2) + .5)
+    def _wait_for_events(self, timeout):
+        # Wait at most `timeout` seconds for new events or the server to exit.
+        if isinstance(self._process, _DaemonProcess):
+            self._process.wait_for_events(timeout)
+            return
+        count = len(self._conversation)
+        deadline = time.perf_counter() + timeout
+        while (self._process.poll() is None
+               and len(self._conversation) == count
+               and time.perf_counter() < deadline):
+            time.sleep(0.005)
+            self._events_reader.read()
+
+    def _wait_for_rest(self, silence_period, max_wait_seconds=5):
+        # Wait until the server has caught up with the driver on every
+        # connection, as shown by events after this call began. An older
+        # <WAITING> may precede data the driver just sent. As a fallback,
+        # e.g., when the script makes the server sleep or nothing happens,
+        # stop waiting once nothing happened for `silence_period` seconds.
         self._read_pipes()
-        buf_lens = len(self._stdout_lines), len(self._stderr_lines)
-        last_change_before = 0
-        while self._process and max_wait:
-            max_wait -= 1
-            time.sleep(seconds / 2)
-            self._read_pipes()
-            new_buf_lens = len(self._stdout_lines), len(self._stderr_lines)
-            if buf_lens != new_buf_lens:
-                last_change_before = 0
+        if not self._process:
+            return
+        start = last_change = time.perf_counter()
+        count = start_count = len(self._conversation)
+        while self._process.returncode is None:
+            if self._conversation.settled_since(start_count):
+                period = _REST_CONFIRMATION_PERIOD
             else:
-                last_change_before += 1
-            if last_change_before >= 2:
+                period = silence_period
+            timeout = (min(last_change + period, start + max_wait_seconds)
+                       - time.perf_counter())
+            if timeout <= 0:
                 break
-            buf_lens = new_buf_lens
+            self._wait_for_events(timeout)
+            if len(self._conversation) != count:
+                count = len(self._conversation)
+                last_change = time.perf_counter()
+        self._read_pipes()
+        _rest_wait_stats.add(time.perf_counter() - start, silence_period)
 
     def get_negotiated_bolt_version(self):
         handshake_prefix = "<HANDSHAKE>"
@@ -319,28 +826,12 @@ class StubServer:
                                    silence_period=silence_period)
 
     def count_requests(self, pattern, silence_period=0.1):
-        return len(self.get_requests(pattern, silence_period))
+        self._wait_for_rest(silence_period)
+        return self._conversation.count("C", pattern)
 
     def get_requests(self, pattern, silence_period=0.1):
-        self._wait_for_silence(silence_period)
-        res = []
-        for line in self._stdout_lines:
-            # lines start with something like "10:08:33.420  [#EBE0>#2332]  "
-            # plus some color escape sequences and ends on a newline
-            line = re.sub(r"\x1b\[[\d;]+m", "", line[:-1])
-            line = re.sub(r"^\d{2}:\d{2}:\d{2}\.\d{3}\s+\[[0-9A-Fa-f#>]+\]\s+",
-                          "", line)
-            match = re.match(r"^(C: )|(\(\s*\d+\) C: )", line)
-            if not match:
-                continue
-            line = line[match.end():]
-            if isinstance(pattern, re.Pattern):
-                if pattern.match(line):
-                    res.append(line)
-            else:
-                if line.startswith(pattern):
-                    res.append(line)
-        return res
+        self._wait_for_rest(silence_period)
+        return self._conversation.find("C", pattern)
 
     def count_responses_re(self, pattern, silence_period=0.1):
         if isinstance(pattern, re.Pattern):
@@ -349,49 +840,17 @@ class StubServer:
                                     silence_period=silence_period)
 
     def get_responses(self, pattern, silence_period=0.1):
-        self._wait_for_silence(silence_period)
-        res = []
-        for line in self._stdout_lines:
-            # lines start with something like "10:08:33.420  [#EBE0>#2332]  "
-            # plus some color escape sequences and ends on a newline
-            line = re.sub(r"\x1b\[[\d;]+m", "", line[:-1])
-            line = re.sub(r"^\d{2}:\d{2}:\d{2}\.\d{3}\s+\[[0-9A-Fa-f#>]+\]\s+",
-                          "", line)
-            match = re.match(r"^(S: )|(\(\s*\d+\) S: )|(\(\s*\d+\)\s+)", line)
-            if not match:
-                continue
-            line = line[match.end():]
-            if isinstance(pattern, re.Pattern):
-                if pattern.match(line):
-                    res.append(line)
-            else:
-                if line.startswith(pattern):
-                    res.append(line)
-        return res
+        self._wait_for_rest(silence_period)
+        return self._conversation.find("S", pattern)
 
     def count_responses(self, pattern, silence_period=0.1):
-        return len(self.get_responses(pattern, silence_period))
+        self._wait_for_rest(silence_period)
+        return self._conversation.count("S", pattern)
 
     def get_conversation(self, silence_period=0.1):
-        self._wait_for_silence(silence_period)
-        lines = []
-        for line in self._stdout_lines:
-            # lines start with something like "10:08:33.420  [#EBE0>#2332]  "
-            # plus some color escape sequences and ends on a newline
-            line = re.sub(r"\x1b\[[\d;]+m", "", line[:-1])
-            line = re.sub(r"^\d{2}:\d{2}:\d{2}\.\d{3}\s+\[[0-9A-Fa-f#>]+\]\s+",
-                          "", line)
-            match = re.match(
-                r"^((?:C: )|(?:\(\s*\d+\) C: ))"
-                r"|((?:S: )|(?:\(\s*\d+\) S: )|(?:\(\s*\d+\)\s+))",
-                line
-            )
-            if not match:
-                continue
-            # print(match)
-            header = "S: " if match.group(1) else "C: "
-            lines.append(f"{header} {line[match.end():]}")
-        return lines
+        self._wait_for_rest(silence_period)
+        return [f"{direction}:  {message}"
+                for direction, message in self._conversation.messages()]
 
     @property
     def stdout(self):
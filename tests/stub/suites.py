@@ -4,6 +4,12 @@ import os
 import sys
 import unittest
 
+from tests.shared import fetch_test_decisions
+from tests.stub.parallel import (
+    get_worker_count,
+    ParallelSuite,
+    replaying,
+)
 from tests.testenv import get_test_result_class
 
 loader = unittest.TestLoader()
@@ -19,10 +25,17 @@ stub_suite.addTest(loader.discover(
 
 if __name__ == "__main__":
     suite_name = "Stub tests"
+    result_class = get_test_result_class(suite_name)
+    suite = stub_suite
+    workers = get_worker_count()
+    if workers > 1:
+        result_class = replaying(result_class)
+        suite = ParallelSuite(workers)
+    else:
+        fetch_test_decisions(suite)
     runner = unittest.TextTestRunner(
-        resultclass=get_test_result_class(suite_name),
-        verbosity=100, stream=sys.stdout,
+        resultclass=result_class, verbosity=100, stream=sys.stdout,
     )
-    result = runner.run(stub_suite)
+    result = runner.run(suite)
     if result.errors or result.failures:
         sys.exit(-1)
@@ -3,6 +3,7 @@
 import sys
 import unittest
 
+from tests.shared import fetch_test_decisions
 from tests.testenv import get_test_result_class
 from tests.tls import (
     test_client_certificate,
@@ -27,6 +28,7 @@ if __name__ == "__main__":
         resultclass=get_test_result_class(suite_name),
         verbosity=100, stream=sys.stdout,
     )
+    fetch_test_decisions(tls_suite)
     result = runner.run(tls_suite)
     if result.errors or result.failures:
         sys.exit(-1)